@@ -0,0 +1,311 @@
+"""Choose which routes to fetch to make the most of a given number of elements.
+
+With a radius, Grid.compute_sparsified_distance_matrix() fetches the routes between
+all pairs of locations closer than the radius, no matter whether the travel times
+between them would already be approximated well by the shortest paths through the
+other routes. Dense city centers get more routes than they need, and gaps like
+rivers get too few.
+
+Instead, this starts from a cheap spanner: routes from each location to its nearest
+neighbors, optionally plus a few random long ones. Then it fetches more routes in
+rounds. For each pair that hasn't been fetched, the shortest path through the known
+routes is an upper bound on its travel time, and the straight-line distance at the
+fastest observed speed is a lower bound. Their ratio bounds how far off the
+approximation can be. Each round fetches the pairs where it's largest relative to
+their distance, since a route between close locations also fixes the many longer
+shortest paths that go through it.
+
+Each round also fetches a few random pairs as spot checks. How far their
+approximated travel times were from the real ones estimates the error of the pairs
+that are still approximated. Once that's below the target, or the elements run
+out, the selection stops.
+
+Like with the radius-based selection, routes are treated as symmetric, so each pair
+is only fetched in one direction and costs 1 element.
+"""
+
+from dataclasses import dataclass
+import logging
+import math
+from typing import Callable
+
+import numpy as np
+
+from backend import spatial_index, travel_times
+from backend.defaults import DEFAULT_TARGET_ERROR
+from backend.location import pairwise_spherical_distances
+from backend.route_matrix import RouteMatrix
+
+DEFAULT_N_NEIGHBORS = 4
+# Off by default: on existing exports, random long routes were a worse use of the
+# elements than the ones chosen by get_scores().
+DEFAULT_N_LONG_EDGES = 0
+DEFAULT_N_ROUNDS = 4
+# Which fraction of the pairs of each round are random spot checks.
+DEFAULT_SPOT_CHECK_FRACTION = 0.1
+# The estimated error is this percentile of the errors of the spot checks.
+ERROR_PERCENTILE = 90
+# The speed used for the lower bounds is this percentile of the observed speeds,
+# so that a few routes with bogus speeds don't make all the bounds useless.
+MAX_SPEED_PERCENTILE = 95
+# How strongly get_scores() prefers close pairs.
+DISTANCE_EXPONENT = 2
+SEED = 0
+
+logger = logging.getLogger(__name__)
+
+# Fetches the routes for (k, 2) pairs of (origin, destination) indices and returns
+# the ones that exist.
+FetchRoutes = Callable[[np.ndarray], RouteMatrix]
+
+
+@dataclass
+class Round:
+    n_pairs: int
+    # The estimated error before the round's routes were added, None for the
+    # spanner.
+    estimated_error: float | None
+
+
+def get_spanner_pairs(
+    coordinates: np.ndarray,
+    n_neighbors: int = DEFAULT_N_NEIGHBORS,
+    n_long_edges: int = DEFAULT_N_LONG_EDGES,
+    seed: int = SEED,
+) -> np.ndarray:
+    """Pairs of each location with its nearest neighbors and some random others.
+
+    Args:
+        coordinates: (n, 2) normalized coordinates of the locations.
+        n_neighbors: How many of the nearest locations to pair each location with.
+        n_long_edges: How many random locations to pair each location with.
+        seed: For choosing the random locations.
+
+    Returns:
+        (k, 2) array of unique pairs (i, j) with i < j. Locations at the same place
+        are never paired.
+    """
+    n = len(coordinates)
+    pairs = [spatial_index.find_nearest_pairs(coordinates, n_neighbors)]
+
+    rng = np.random.default_rng(seed)
+    for _ in range(n_long_edges):
+        others = rng.integers(0, n, size=n)
+        pairs.append(np.stack([np.arange(n), others], 1))
+
+    pairs = np.concatenate(pairs)
+    # Locations at the same place, including each location itself.
+    pairs = pairs[np.any(coordinates[pairs[:, 0]] != coordinates[pairs[:, 1]], axis=1)]
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+
+def get_max_speed(route_matrix: RouteMatrix, distances: np.ndarray) -> float:
+    """A robust maximum of the straight-line speeds of the routes, in m/s."""
+    durations = route_matrix.duration_seconds
+    valid = durations > 0
+    speeds = (
+        distances[route_matrix.origin_index, route_matrix.destination_index][valid]
+        / durations[valid]
+    )
+    if len(speeds) == 0:
+        raise ValueError("No routes to estimate the speed from")
+    return float(np.percentile(speeds, MAX_SPEED_PERCENTILE))
+
+
+def get_scores(
+    estimated: np.ndarray,
+    distances: np.ndarray,
+    route_matrix: RouteMatrix,
+    pairs: np.ndarray,
+) -> np.ndarray:
+    """How much fetching each of the pairs is expected to help, higher is better.
+
+    Args:
+        estimated: (n, n) shortest travel times through the known routes.
+        distances: (n, n) straight-line distances in meters.
+        route_matrix: The known routes.
+        pairs: (k, 2) pairs to score, of locations at different places.
+    """
+    estimated = estimated[pairs[:, 0], pairs[:, 1]].astype(np.float64)
+    estimated[estimated >= travel_times.INF] = np.inf
+    max_speed = get_max_speed(route_matrix, distances)
+    distances = distances[pairs[:, 0], pairs[:, 1]]
+
+    # How many times longer the estimated travel time can be than the real one.
+    max_ratio = estimated / (distances / max_speed)
+    return max_ratio / distances**DISTANCE_EXPONENT
+
+
+def select_spread_out(
+    pairs: np.ndarray, scores: np.ndarray, n_select: int, n_locations: int
+) -> np.ndarray:
+    """Choose up to n_select of the highest scoring pairs.
+
+    The best pairs tend to cluster around a few badly connected locations, but
+    after a few routes to such a location, the rest of its pairs improve too. So
+    each location is only used in a limited number of pairs per round.
+
+    Returns:
+        Indices into pairs.
+    """
+    max_per_location = max(2, math.ceil(4 * n_select / n_locations))
+    counts = np.zeros(n_locations, dtype=np.int64)
+    selected = []
+    for k in np.argsort(-scores, kind="stable").tolist():
+        if len(selected) == n_select:
+            break
+        i, j = pairs[k]
+        if counts[i] < max_per_location and counts[j] < max_per_location:
+            selected.append(k)
+            counts[i] += 1
+            counts[j] += 1
+
+    return np.array(selected, dtype=np.int64)
+
+
+def get_relative_errors(
+    estimated: np.ndarray, route_matrix: RouteMatrix, pairs: np.ndarray
+) -> np.ndarray:
+    """How much the estimated travel times of pairs overestimate the real ones.
+
+    Args:
+        estimated: (n, n) shortest travel times, from before the routes were known.
+        route_matrix: The routes fetched for the pairs.
+        pairs: (k, 2) pairs (i, j) with i < j. Pairs without a route are skipped.
+    """
+    n = len(estimated)
+    actual = np.full((n, n), travel_times.INF, dtype=np.int64)
+    np.minimum.at(
+        actual,
+        (
+            np.minimum(route_matrix.origin_index, route_matrix.destination_index),
+            np.maximum(route_matrix.origin_index, route_matrix.destination_index),
+        ),
+        route_matrix.duration_seconds,
+    )
+    actual = actual[pairs[:, 0], pairs[:, 1]]
+    estimated = estimated[pairs[:, 0], pairs[:, 1]].astype(np.float64)
+    estimated[estimated >= travel_times.INF] = np.inf
+
+    has_route = (actual < travel_times.INF) & (actual > 0)
+    return estimated[has_route] / actual[has_route] - 1
+
+
+def select_and_fetch(
+    coordinates: np.ndarray,
+    lat_lng: np.ndarray,
+    fetch_routes: FetchRoutes,
+    target_elements: int,
+    target_error: float = DEFAULT_TARGET_ERROR,
+    n_neighbors: int = DEFAULT_N_NEIGHBORS,
+    n_long_edges: int = DEFAULT_N_LONG_EDGES,
+    n_rounds: int = DEFAULT_N_ROUNDS,
+    spot_check_fraction: float = DEFAULT_SPOT_CHECK_FRACTION,
+    seed: int = SEED,
+) -> tuple[RouteMatrix, list[Round]]:
+    """Fetch routes between up to target_elements pairs of locations.
+
+    Args:
+        coordinates: (n, 2) normalized coordinates of the locations.
+        lat_lng: (n, 2) latitudes and longitudes of the locations.
+        fetch_routes: Fetches the routes between the chosen pairs.
+        target_elements: The most route matrix elements to use.
+        target_error: Stop early once the estimated relative error of the
+            approximated travel times is below this.
+        n_neighbors: See get_spanner_pairs().
+        n_long_edges: See get_spanner_pairs().
+        n_rounds: In how many rounds to spend the elements left after the spanner.
+        spot_check_fraction: Which fraction of each round to spend on spot checks.
+        seed: For the random choices.
+
+    Returns:
+        All the fetched routes and a summary of each round.
+    """
+    n = len(coordinates)
+    rng = np.random.default_rng(seed)
+    distances = pairwise_spherical_distances(lat_lng)
+
+    # Pairs that don't need to be fetched: each location with itself, locations
+    # at the same place, and the pairs that were already fetched.
+    done = np.tril(np.ones((n, n), dtype=bool))
+    _, place = np.unique(coordinates, axis=0, return_inverse=True)
+    # The shape of the inverse differs between NumPy versions.
+    place = place.reshape(-1)
+    done |= place[:, np.newaxis] == place[np.newaxis, :]
+
+    spanner = get_spanner_pairs(coordinates, n_neighbors, n_long_edges, seed)
+    n_pairs_left = target_elements - len(spanner)
+    if n_pairs_left < 0:
+        raise ValueError(
+            f"The initial {len(spanner)} pairs already take {len(spanner)} "
+            f"elements, more than the target of {target_elements}. Use fewer "
+            "neighbors or a larger target."
+        )
+
+    route_matrices = [fetch_routes(spanner)]
+    done[spanner[:, 0], spanner[:, 1]] = True
+    rounds = [Round(n_pairs=len(spanner), estimated_error=None)]
+
+    for round_index in range(n_rounds):
+        if n_pairs_left <= 0:
+            break
+
+        route_matrix = RouteMatrix.concatenate(route_matrices)
+        estimated = travel_times.all_pairs(route_matrix.to_array(n), progress=False)
+
+        candidates = np.stack(np.nonzero(~done), axis=1)
+        if len(candidates) == 0:
+            break
+
+        scores = get_scores(estimated, distances, route_matrix, candidates)
+
+        n_round_pairs = min(
+            len(candidates), math.ceil(n_pairs_left / (n_rounds - round_index))
+        )
+        n_spot_checks = max(1, round(n_round_pairs * spot_check_fraction))
+        is_spot_check = np.zeros(len(candidates), dtype=bool)
+        is_spot_check[rng.choice(len(candidates), n_spot_checks, replace=False)] = True
+
+        rest = np.nonzero(~is_spot_check)[0]
+        selected = rest[
+            select_spread_out(
+                candidates[rest], scores[rest], n_round_pairs - n_spot_checks, n
+            )
+        ]
+        spot_checks = candidates[is_spot_check]
+        pairs = np.concatenate([spot_checks, candidates[selected]])
+
+        new_routes = fetch_routes(pairs)
+        route_matrices.append(new_routes)
+        done[pairs[:, 0], pairs[:, 1]] = True
+        n_pairs_left -= len(pairs)
+
+        errors = get_relative_errors(estimated, new_routes, spot_checks)
+        estimated_error = (
+            float(np.percentile(errors, ERROR_PERCENTILE)) if len(errors) else None
+        )
+        rounds.append(Round(n_pairs=len(pairs), estimated_error=estimated_error))
+        logger.info(
+            f"Round {round_index + 1}: fetched {len(pairs)} pairs, the error was "
+            f"estimated at {estimated_error} from {len(errors)} spot checks"
+        )
+        if estimated_error is not None and estimated_error <= target_error:
+            break
+
+    return RouteMatrix.concatenate(route_matrices), rounds
+
+
+def format_rounds(rounds: list[Round]) -> str:
+    lines = []
+    for i, x in enumerate(rounds):
+        if i == 0:
+            lines.append(f"Spanner: {x.n_pairs} pairs")
+        else:
+            error = (
+                "unknown" if x.estimated_error is None else f"{x.estimated_error:.1%}"
+            )
+            lines.append(
+                f"Round {i}: {x.n_pairs} pairs, "
+                f"{ERROR_PERCENTILE}th percentile error before: {error}"
+            )
+    return "\n".join(lines)
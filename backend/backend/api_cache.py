@@ -0,0 +1,238 @@
+"""Persistent caches of Google Maps API results.
+
+The API calls cost money, so results that were already fetched are stored in a local
+SQLite database and reused, e.g. when re-exporting the same city with a different
+--max-normalized-distance or after a crash.
+"""
+
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from backend.defaults import DEFAULT_TTL_SECONDS
+from backend.location import Location
+
+# Coordinates are rounded to this many degrees (about a meter) for the route cache key.
+QUANTIZATION_DEGREES = 1e-5
+# Snapping is coarser: points within about 10 meters of each other snap to the same
+# road anyway, and this way grids at different zoom levels can share more results.
+SNAP_QUANTIZATION_DEGREES = 1e-4
+
+DEFAULT_MAX_ENTRIES = 1_000_000
+# When the cache is full, it's shrunk to this fraction of max_entries, so that the
+# eviction doesn't run again on the next write.
+EVICTION_TARGET_FRACTION = 0.9
+
+RouteCacheKey = tuple[int, int, int, int, str, str]
+SnapCacheKey = tuple[int, int]
+
+
+def get_default_cache_path() -> Path:
+    cache_dir = os.getenv("SPACETIME_MAPS_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = Path.home() / ".cache" / "spacetime-maps"
+    return Path(cache_dir) / "api_cache.sqlite"
+
+
+def quantize(degrees: float, quantization: float = QUANTIZATION_DEGREES) -> int:
+    return round(degrees / quantization)
+
+
+def make_route_key(
+    origin: Location,
+    destination: Location,
+    travel_mode: str,
+    routing_preference: str | None,
+) -> RouteCacheKey:
+    return (
+        quantize(origin.lat),
+        quantize(origin.lng),
+        quantize(destination.lat),
+        quantize(destination.lng),
+        str(travel_mode),
+        routing_preference or "",
+    )
+
+
+def make_snap_key(location: Location) -> SnapCacheKey:
+    return (
+        quantize(location.lat, SNAP_QUANTIZATION_DEGREES),
+        quantize(location.lng, SNAP_QUANTIZATION_DEGREES),
+    )
+
+
+class SqliteCache:
+    # Subclasses define the table name and the columns that make up the key.
+    table: str
+    key_columns: list[str]
+
+    def __init__(
+        self,
+        path: str | Path | None = None,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        """A cache of JSON values stored in a SQLite table.
+
+        Safe to use from multiple threads. Several caches can share one database
+        file, each in its own table.
+
+        Args:
+            path: Where to store the SQLite database. Defaults to
+                get_default_cache_path().
+            ttl_seconds: Entries older than this are ignored and eventually deleted.
+            max_entries: When the cache grows larger than this, the least recently
+                used entries are deleted, see EVICTION_TARGET_FRACTION.
+        """
+        self.path = Path(path) if path is not None else get_default_cache_path()
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        key_columns = ", ".join(self.key_columns)
+        self._key_condition = " AND ".join(f"{c} = ?" for c in self.key_columns)
+        with self._connection:
+            self._connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    {", ".join(f"{c} NOT NULL" for c in self.key_columns)},
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY ({key_columns})
+                )
+                """)
+            self._connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_accessed_at "
+                f"ON {self.table} (accessed_at)"
+            )
+            # Counting the entries takes a full scan, so it's only done here and in
+            # _evict(). In between, put_many() keeps a running count.
+            self._n_entries = 0
+            self._evict()
+
+    def get(self, key: tuple, count_miss: bool = True) -> dict | None:
+        """Get the cached value, or None if there is none.
+
+        Args:
+            count_miss: Whether a miss counts towards self.misses. Pass False if
+                another key is tried next.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                f"SELECT value FROM {self.table} "
+                f"WHERE {self._key_condition} AND created_at >= ?",
+                (*key, now - self.ttl_seconds),
+            ).fetchone()
+
+            if row is None:
+                self.misses += count_miss
+                return None
+
+            self.hits += 1
+            self._connection.execute(
+                f"UPDATE {self.table} SET accessed_at = ? WHERE {self._key_condition}",
+                (now, *key),
+            )
+            return json.loads(row[0])
+
+    def put_many(self, items: list[tuple[tuple, dict]]):
+        if not items:
+            return
+
+        now = time.time()
+        rows = [(*key, json.dumps(value), now, now) for key, value in items]
+        placeholders = ", ".join("?" * (len(self.key_columns) + 3))
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})", rows
+            )
+            # Replaced entries are counted as new ones, so this is an upper bound.
+            # _evict() recounts exactly.
+            self._n_entries += len(rows)
+            if self._n_entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """Delete expired entries and, if there are too many, the least recently used."""
+        self._connection.execute(
+            f"DELETE FROM {self.table} WHERE created_at < ?",
+            (time.time() - self.ttl_seconds,),
+        )
+        (n_entries,) = self._connection.execute(
+            f"SELECT COUNT(*) FROM {self.table}"
+        ).fetchone()
+        if n_entries > self.max_entries:
+            n_to_keep = int(self.max_entries * EVICTION_TARGET_FRACTION)
+            self._connection.execute(
+                f"""
+                DELETE FROM {self.table} WHERE rowid IN (
+                    SELECT rowid FROM {self.table} ORDER BY accessed_at LIMIT ?
+                )
+                """,
+                (n_entries - n_to_keep,),
+            )
+            n_entries = n_to_keep
+        self._n_entries = n_entries
+
+    def close(self):
+        self._connection.close()
+
+
+class RouteCache(SqliteCache):
+    """Route matrix elements, keyed by origin, destination and travel mode."""
+
+    table = "route_matrix_elements"
+    key_columns = [
+        "origin_lat",
+        "origin_lng",
+        "destination_lat",
+        "destination_lng",
+        "travel_mode",
+        "routing_preference",
+    ]
+
+    def get(self, key: RouteCacheKey, count_miss: bool = True) -> dict | None:
+        """Get the cached entry for a key, without originIndex and destinationIndex."""
+        return super().get(key, count_miss=count_miss)
+
+    def put_many(self, items: list[tuple[RouteCacheKey, dict]]):
+        """Store entries. originIndex and destinationIndex are not stored."""
+        super().put_many(
+            [
+                (
+                    key,
+                    {
+                        k: v
+                        for k, v in entry.items()
+                        if k not in ["originIndex", "destinationIndex"]
+                    },
+                )
+                for key, entry in items
+            ]
+        )
+
+    def summary(self, dollars_per_element: float) -> str:
+        return (
+            f"Route cache: {self.hits} hits, {self.misses} misses "
+            f"(saved {self.hits * dollars_per_element:.2f}$)"
+        )
+
+
+class SnapCache(SqliteCache):
+    """Results of snapping locations to roads, keyed by the rounded location."""
+
+    table = "snapped_locations"
+    key_columns = ["lat", "lng"]
+
+    def summary(self) -> str:
+        return f"Snap cache: {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,316 @@
+"""Run many exports non-interactively, as described by a manifest.
+
+The manifest is a JSON file with a list of cities, e.g.
+
+    {"cities": [
+        {"name": "prague", "center": [50.07981, 14.42974], "zoom": 14,
+         "grid_size": 19, "travel_mode": "DRIVE", "max_normalized_distance": 0.12}
+    ]}
+
+Only name and center are required, the rest default to the defaults of export.py.
+Cities that were already exported with the same parameters are skipped, and
+interrupted exports are resumed. A city can build on the export of another one with
+"coarse": "<name>", which is then exported first.
+
+The cities are exported in parallel threads. They share the rate limits of the API
+clients (see http_client.py) and a single budget, so the total cost of a batch can't
+go over --max-dollars.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+import logging
+from pathlib import Path
+import time
+
+from backend import adaptive_sparsification, export, export_journal, gmaps, json_stream
+from backend.location import Location
+
+DEFAULT_MANIFEST_PATH = Path(__file__).parents[1] / "cities.json"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class City:
+    name: str
+    center: Location
+    zoom: int = export.DEFAULT_ZOOM
+    grid_size: int = export.DEFAULT_GRID_SIZE
+    travel_mode: gmaps.TravelMode = gmaps.TravelMode.DRIVE
+    # None for the default of export.get_export_params().
+    max_normalized_distance: float | None = None
+    # If given, used instead of max_normalized_distance, see export.py.
+    target_elements: int | None = None
+    target_error: float = adaptive_sparsification.DEFAULT_TARGET_ERROR
+    # The name of a coarser city of the same area to build on, see hierarchical.py.
+    coarse: str | None = None
+
+    def get_params(self) -> dict:
+        return export.get_export_params(
+            self.center,
+            self.zoom,
+            self.grid_size,
+            self.max_normalized_distance,
+            self.travel_mode,
+            target_elements=self.target_elements,
+            target_error=self.target_error,
+            coarse=self.coarse,
+        )
+
+
+@dataclass
+class CityResult:
+    name: str
+    # "exported", "skipped", "over budget" or "failed".
+    status: str
+    seconds: float = 0.0
+    dollars: float = 0.0
+    error: str | None = None
+
+
+def read_manifest(path: str | Path) -> list[City]:
+    with Path(path).open() as f:
+        manifest = json.load(f)
+
+    cities = []
+    for entry in manifest["cities"]:
+        lat, lng = entry.pop("center")
+        if "travel_mode" in entry:
+            entry["travel_mode"] = gmaps.TravelMode(entry["travel_mode"])
+        cities.append(City(center=Location(lat=lat, lng=lng), **entry))
+
+    names = [city.name for city in cities]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate city names in {path}: {sorted(duplicates)}")
+
+    return cities
+
+
+def get_existing_params(output_dir: Path) -> dict | None:
+    """The parameters of an existing export, or None if there is none.
+
+    Exports made before export.EXPORT_PARAMS_FILENAME existed only record some of
+    the parameters in grid_data.json. They were made with the defaults for the
+    others, except maybe for max_normalized_distance, which is assumed to be the
+    default too.
+    """
+    params_path = output_dir / export.EXPORT_PARAMS_FILENAME
+    if params_path.exists():
+        with params_path.open() as f:
+            return json.load(f)
+
+    grid_data_path = output_dir / "grid_data.json"
+    if not grid_data_path.exists():
+        return None
+
+    with grid_data_path.open() as f:
+        metadata = dict(
+            json_stream.iter_object(
+                f, streamed_keys=["locations", "route_matrix", "dense_travel_times"]
+            )
+        )
+    return export.get_export_params(
+        Location(**metadata["center"]),
+        metadata["zoom"],
+        metadata["size"],
+        max_normalized_distance=None,
+        # Exports from before there was a choice were all driving.
+        travel_mode=gmaps.TravelMode(
+            metadata.get("travel_mode", gmaps.TravelMode.DRIVE)
+        ),
+        size_pixels=metadata["size_pixels"],
+    )
+
+
+def is_up_to_date(city: City) -> bool:
+    return get_existing_params(export.ASSETS_DIR / city.name) == city.get_params()
+
+
+def can_resume(city: City) -> bool:
+    """Whether there's an interrupted export of the city with the same parameters."""
+    journal_path = export_journal.get_journal_path(export.ASSETS_DIR / city.name)
+    if not journal_path.exists():
+        return False
+    try:
+        return export_journal.read_params(journal_path) == city.get_params()
+    except ValueError:
+        return False
+
+
+def export_city(city: City, budget: gmaps.Budget, **kwargs) -> CityResult:
+    """Export one city, catching errors so that the other cities can continue.
+
+    Args:
+        city: The city to export.
+        budget: The budget shared by all cities.
+        **kwargs: Passed to export.main().
+    """
+    city_budget = gmaps.Budget(parent=budget)
+    start = time.monotonic()
+
+    def result(status: str, error: str | None = None) -> CityResult:
+        return CityResult(
+            city.name,
+            status,
+            seconds=time.monotonic() - start,
+            dollars=city_budget.spent_dollars,
+            error=error,
+        )
+
+    try:
+        export.main(
+            output_name=city.name,
+            center=city.center,
+            zoom=city.zoom,
+            grid_size=city.grid_size,
+            max_normalized_distance=city.max_normalized_distance,
+            preview=False,
+            travel_modes=[city.travel_mode],
+            resume=can_resume(city),
+            budget=city_budget,
+            confirm_overwrite=False,
+            target_elements=city.target_elements,
+            target_error=city.target_error,
+            coarse=city.coarse,
+            **kwargs,
+        )
+    except gmaps.BudgetExceededError as e:
+        logger.warning(f"Skipping {city.name}: {e}")
+        return result("over budget", str(e))
+    except Exception as e:
+        logger.exception(f"Exporting {city.name} failed")
+        return result("failed", repr(e))
+
+    return result("exported")
+
+
+def format_summary(results: list[CityResult]) -> str:
+    lines = [f"{'city':<30} {'status':<12} {'time':>9} {'cost':>9}"]
+    for x in results:
+        lines.append(f"{x.name:<30} {x.status:<12} {x.seconds:8.1f}s {x.dollars:8.2f}$")
+    lines.append(
+        f"{'total':<30} {'':<12} {sum(x.seconds for x in results):8.1f}s "
+        f"{sum(x.dollars for x in results):8.2f}$"
+    )
+    return "\n".join(lines)
+
+
+def get_waves(cities: list[City]) -> list[list[City]]:
+    """Split the cities into groups that can be exported in parallel.
+
+    Cities that build on a coarse city come in a later group than the coarse one.
+    """
+    waves = []
+    remaining = list(cities)
+    while remaining:
+        names = {city.name for city in remaining}
+        wave = [city for city in remaining if city.coarse not in names]
+        if not wave:
+            raise ValueError(f"Cycle in the coarse cities of {sorted(names)}")
+        waves.append(wave)
+        remaining = [city for city in remaining if city not in wave]
+    return waves
+
+
+def main(
+    manifest_path: Path,
+    max_dollars: float,
+    parallel: int = 2,
+    names: list[str] | None = None,
+    force: bool = False,
+    **kwargs,
+) -> list[CityResult]:
+    """Export the cities of a manifest.
+
+    Args:
+        manifest_path: The manifest, see the module docstring.
+        max_dollars: The most that all the exports together can spend.
+        parallel: How many cities to export at the same time.
+        names: Only export these cities. Defaults to all of them.
+        force: Export cities even if they are up to date.
+        **kwargs: Passed to export.main(), e.g. use_cache.
+
+    Returns:
+        The result for each city, in the order of the manifest.
+    """
+    cities = read_manifest(manifest_path)
+    if names is not None:
+        unknown = set(names) - {city.name for city in cities}
+        if unknown:
+            raise ValueError(f"Cities not in {manifest_path}: {sorted(unknown)}")
+        cities = [city for city in cities if city.name in names]
+
+    budget = gmaps.Budget(max_dollars)
+    results: dict[str, CityResult] = {}
+    to_export = []
+    for city in cities:
+        if not force and is_up_to_date(city):
+            results[city.name] = CityResult(city.name, "skipped")
+        else:
+            to_export.append(city)
+
+    print(
+        f"Exporting {len(to_export)} of {len(cities)} cities, "
+        f"the rest are up to date."
+    )
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        for wave in get_waves(to_export):
+            for result in executor.map(
+                lambda city: export_city(city, budget, **kwargs), wave
+            ):
+                results[result.name] = result
+
+    results = [results[city.name] for city in cities]
+    print(format_summary(results))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("manifest", type=Path, nargs="?", default=DEFAULT_MANIFEST_PATH)
+    parser.add_argument(
+        "--max-dollars",
+        type=float,
+        required=True,
+        help="Stop starting new requests once the batch would cost more than this.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=2,
+        help="How many cities to export at the same time.",
+    )
+    parser.add_argument("--only", nargs="+", help="Only export these cities.")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Export cities even if their parameters haven't changed.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=gmaps.DEFAULT_MAX_IN_FLIGHT,
+        help="How many Google Maps API requests to send concurrently per city.",
+    )
+    parser.add_argument("--max-waste-fraction", type=float, default=0.0)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--binary", action="store_true")
+    args = parser.parse_args()
+
+    results = main(
+        manifest_path=args.manifest,
+        max_dollars=args.max_dollars,
+        parallel=args.parallel,
+        names=args.only,
+        force=args.force,
+        max_in_flight=args.max_in_flight,
+        max_waste_fraction=args.max_waste_fraction,
+        use_cache=not args.no_cache,
+        binary=args.binary,
+    )
+    if any(x.status in ["failed", "over budget"] for x in results):
+        exit(1)
@@ -0,0 +1,348 @@
+"""Benchmarks for the hot paths of the export, on synthetic data.
+
+Everything runs offline. The grids and route matrices are generated from a fixed
+seed, so every run measures the same work. Results can be saved as a baseline and
+later runs compared against it to catch slowdowns, see scripts/benchmark.py.
+
+Timings depend on the machine, so baselines should only be compared on the machine
+they were recorded on.
+"""
+
+from dataclasses import dataclass
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import time
+import tracemalloc
+from typing import Any, Callable
+
+import numpy as np
+
+from backend import request_planner, spatial_index, travel_times
+from backend.grid import (
+    Grid,
+    compute_dense_travel_times,
+    get_dense_travel_times,
+    make_grid,
+)
+from backend.location import Location, Polyline, spherical_distances
+from backend.route_matrix import MISSING_DISTANCE, RouteMatrix
+
+DEFAULT_SIZES = [5, 11, 19, 29, 41]
+SEED = 0
+
+CENTER = Location(lat=50.0755, lng=14.4378)
+ZOOM = 13
+SIZE_PIXELS = 640
+# The defaults of export.py.
+MAX_NORMALIZED_DISTANCE = 0.12
+N_POLYLINE_SAMPLES = 1000
+# The limits for driving, see gmaps.get_request_limits().
+ROUTES_LIMITS = request_planner.RequestLimits(
+    max_elements=625, max_origins=25, max_destinations=25
+)
+
+# Keep repeating a benchmark until it has run for this long in total...
+MIN_TOTAL_SECONDS = 0.5
+# ...but not more often than this.
+MAX_REPEATS = 50
+
+# Timings shorter than this are too noisy to compare, see find_regressions().
+MIN_COMPARED_SECONDS = 1e-3
+
+
+def make_synthetic_grid(size: int, seed: int = SEED) -> Grid:
+    """A grid with snapping results and a route matrix, without calling any API.
+
+    The locations are moved by a small random amount as if they were snapped to
+    roads, and the route matrix connects the same pairs as
+    Grid.compute_sparsified_distance_matrix() would, with travel times
+    proportional to the distance.
+    """
+    rng = np.random.default_rng(seed)
+    grid = Grid(
+        CENTER, zoom=ZOOM, size=size, snap_to_roads=False, size_pixels=SIZE_PIXELS
+    )
+
+    spacing_lat = abs(grid.locations.raw_lat[0] - grid.locations.raw_lat[-1]) / size
+    spacing_lng = abs(grid.locations.raw_lng[0] - grid.locations.raw_lng[-1]) / size
+    n_locations = len(grid.locations)
+    grid.locations.snapped_lat += rng.uniform(-0.2, 0.2, n_locations) * spacing_lat
+    grid.locations.snapped_lng += rng.uniform(-0.2, 0.2, n_locations) * spacing_lng
+    grid.locations.snap_result_types = [["route"]] * n_locations
+    grid.locations.snap_result_place_id = [f"place{i}" for i in range(n_locations)]
+
+    coordinates = grid.get_normalized_coordinates(
+        grid.locations.snapped_lat, grid.locations.snapped_lng
+    )
+    pairs = spatial_index.find_close_pairs(coordinates, MAX_NORMALIZED_DISTANCE)
+    pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+
+    snapped = np.stack([grid.locations.snapped_lat, grid.locations.snapped_lng], 1)
+    distances = spherical_distances(snapped[pairs[:, 0]], snapped[pairs[:, 1]])
+    # Roads aren't straight and speeds vary.
+    distance_meters = distances * rng.uniform(1.1, 1.6, len(pairs))
+    duration_seconds = distance_meters / rng.uniform(5, 15, len(pairs))
+    distance_meters = distance_meters.astype(np.int64)
+    # The API leaves out distanceMeters when it's 0.
+    distance_meters[distance_meters == 0] = MISSING_DISTANCE
+
+    grid.route_matrix = RouteMatrix(
+        origin_index=pairs[:, 0].astype(np.int32),
+        destination_index=pairs[:, 1].astype(np.int32),
+        duration_seconds=duration_seconds.astype(np.int64),
+        distance_meters=distance_meters,
+    )
+    return grid
+
+
+def make_synthetic_polyline(n_points: int, seed: int = SEED) -> Polyline:
+    """A random walk around the center, like the polyline of a route."""
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(scale=1e-4, size=(n_points, 2))
+    coordinates = np.cumsum(steps, axis=0) + [CENTER.lat, CENTER.lng]
+    return Polyline(points=[Location(lat=a, lng=b) for a, b in coordinates.tolist()])
+
+
+def _setup_make_grid(size: int) -> Callable[[], Any]:
+    return lambda: make_grid(CENTER, ZOOM, size, SIZE_PIXELS)
+
+
+def _setup_close_pairs(size: int) -> Callable[[], Any]:
+    grid = make_synthetic_grid(size)
+    coordinates = grid.get_normalized_coordinates(
+        grid.locations.snapped_lat, grid.locations.snapped_lng
+    )
+    return lambda: spatial_index.find_close_pairs(coordinates, MAX_NORMALIZED_DISTANCE)
+
+
+def _setup_plan_requests(size: int) -> Callable[[], Any]:
+    grid = make_synthetic_grid(size)
+    pairs = grid.get_close_pairs(MAX_NORMALIZED_DISTANCE)
+    # Only one orientation of each pair is fetched.
+    pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+    return lambda: request_planner.plan_requests(pairs, ROUTES_LIMITS, symmetric=True)
+
+
+def _setup_dense_travel_times(size: int) -> Callable[[], Any]:
+    route_matrix = make_synthetic_grid(size).route_matrix
+    return lambda: get_dense_travel_times(route_matrix, progress=False)
+
+
+def _setup_add_locations(size: int) -> Callable[[], Any]:
+    # Like panning a grid by one column: the locations of the last column are new.
+    m = make_synthetic_grid(size).route_matrix.to_array(size * size)
+    new = np.arange(size - 1, size * size, size)
+    old = np.setdiff1d(np.arange(size * size), new)
+    dist = np.full_like(m, travel_times.INF)
+    dist[np.ix_(old, old)] = travel_times.all_pairs(m[np.ix_(old, old)], progress=False)
+    return lambda: travel_times.add_locations(dist.copy(), m, new, progress=False)
+
+
+def _setup_polyline_sampling(size: int) -> Callable[[], Any]:
+    # As many points as the grid has locations, to get comparable sizes.
+    polyline = make_synthetic_polyline(size * size)
+    fractions = np.linspace(0, 1, N_POLYLINE_SAMPLES)
+
+    def run():
+        # A fresh copy, so that the cached lengths are computed as part of the run.
+        return Polyline.model_construct(points=polyline.points).sample_fractions(
+            fractions
+        )
+
+    return run
+
+
+def _setup_grid_to_json(size: int) -> Callable[[], Any]:
+    grid = make_synthetic_grid(size)
+    dense_travel_times = compute_dense_travel_times(grid.route_matrix, progress=False)
+    return lambda: grid.to_json(dense_travel_times)
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Prepares the data for a grid of the given size (not timed) and returns the
+    # function to time.
+    setup: Callable[[int], Callable[[], Any]]
+
+
+BENCHMARKS = [
+    Benchmark("make_grid", _setup_make_grid),
+    Benchmark("close_pairs", _setup_close_pairs),
+    Benchmark("plan_requests", _setup_plan_requests),
+    Benchmark("dense_travel_times", _setup_dense_travel_times),
+    Benchmark("add_locations", _setup_add_locations),
+    Benchmark("polyline_sampling", _setup_polyline_sampling),
+    Benchmark("grid_to_json", _setup_grid_to_json),
+]
+
+
+def measure(f: Callable[[], Any]) -> dict:
+    """Time f and measure its peak memory usage.
+
+    Returns:
+        The fastest of several runs in seconds, the number of runs, and the peak
+        memory allocated by Python and NumPy during a separate run, in bytes.
+    """
+    times = []
+    while len(times) < MAX_REPEATS and sum(times) < MIN_TOTAL_SECONDS:
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+
+    # Tracing allocations slows things down, so it's not done while timing.
+    tracemalloc.start()
+    try:
+        f()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": min(times), "repeats": len(times), "peak_bytes": peak_bytes}
+
+
+def get_metadata() -> dict:
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run(
+    sizes: list[int] = DEFAULT_SIZES,
+    names: list[str] | None = None,
+    on_result: Callable[[str, int, dict], None] | None = None,
+) -> dict:
+    """Run the benchmarks.
+
+    Args:
+        sizes: The grid sizes to run each benchmark with.
+        names: Which benchmarks to run. Defaults to all of them.
+        on_result: Called with the name, size and result of each measurement as
+            soon as it's done.
+
+    Returns:
+        A JSON-serializable dict with the metadata of the run and, for each
+        benchmark and size, the result of measure().
+    """
+    unknown = set(names or []) - {b.name for b in BENCHMARKS}
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {sorted(unknown)}")
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names is not None and benchmark.name not in names:
+            continue
+
+        results[benchmark.name] = {}
+        for size in sizes:
+            result = measure(benchmark.setup(size))
+            # JSON keys are strings.
+            results[benchmark.name][str(size)] = result
+            if on_result is not None:
+                on_result(benchmark.name, size, result)
+
+    return {"metadata": get_metadata(), "results": results}
+
+
+def get_scaling_exponent(results: dict[str, dict]) -> float | None:
+    """Fit time ~ n_locations ** exponent to the results of one benchmark.
+
+    Returns None if there are fewer than two sizes.
+    """
+    if len(results) < 2:
+        return None
+
+    n_locations = np.array([int(size) ** 2 for size in results], dtype=np.float64)
+    seconds = np.array([x["seconds"] for x in results.values()])
+    slope, _ = np.polyfit(np.log(n_locations), np.log(seconds), 1)
+    return float(slope)
+
+
+def format_report(run_results: dict) -> str:
+    """A table of the times and peak memory of each benchmark and size."""
+    lines = []
+    for name, results in run_results["results"].items():
+        lines.append(name)
+        for size, result in results.items():
+            lines.append(
+                f"  {size:>3}x{size:<3} {result['seconds'] * 1000:10.2f} ms "
+                f"{result['peak_bytes'] / 1e6:10.2f} MB"
+            )
+        exponent = get_scaling_exponent(results)
+        if exponent is not None:
+            lines.append(f"  time ~ n_locations^{exponent:.2f}")
+    return "\n".join(lines)
+
+
+def find_regressions(
+    run_results: dict, baseline: dict, threshold: float
+) -> list[tuple[str, str, float]]:
+    """Compare the times of a run against a baseline.
+
+    Only benchmarks and sizes present in both are compared. Times below
+    MIN_COMPARED_SECONDS are rounded up to it, since they're mostly noise.
+
+    Args:
+        run_results: The output of run().
+        baseline: An earlier output of run().
+        threshold: How much slower is still acceptable, e.g. 0.25 for 25%.
+
+    Returns:
+        (name, size, slowdown) for each regression, where slowdown is the ratio of
+        the new time to the baseline time.
+    """
+    regressions = []
+    for name, results in run_results["results"].items():
+        for size, result in results.items():
+            baseline_result = baseline["results"].get(name, {}).get(size)
+            if baseline_result is None:
+                continue
+
+            slowdown = max(result["seconds"], MIN_COMPARED_SECONDS) / max(
+                baseline_result["seconds"], MIN_COMPARED_SECONDS
+            )
+            if slowdown > 1 + threshold:
+                regressions.append((name, size, slowdown))
+
+    return regressions
+
+
+def save(run_results: dict, path: str | Path):
+    with Path(path).open("w") as f:
+        json.dump(run_results, f, indent=2)
+
+
+def load(path: str | Path) -> dict:
+    with Path(path).open() as f:
+        return json.load(f)
+
+
+def plot_scaling(run_results: dict, baseline: dict | None = None):
+    """A log-log plot of time against the number of locations, for each benchmark."""
+    # Plotly is slow to import and not needed otherwise.
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    for label, data, dash in [("", run_results, None), ("baseline ", baseline, "dot")]:
+        if data is None:
+            continue
+        for name, results in data["results"].items():
+            fig.add_trace(
+                go.Scatter(
+                    x=[int(size) ** 2 for size in results],
+                    y=[x["seconds"] for x in results.values()],
+                    name=f"{label}{name}",
+                    line={"dash": dash},
+                )
+            )
+
+    fig.update_xaxes(type="log", title="Locations")
+    fig.update_yaxes(type="log", title="Seconds")
+    return fig
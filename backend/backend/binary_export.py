@@ -0,0 +1,294 @@
+"""A compact binary alternative to grid_data.json.
+
+Layout, all little-endian:
+
+    magic      8 bytes, b"STMGRID\\0" (other files in this layout have their own)
+    version    uint32
+    length     uint32, the length of the header in bytes
+    header     UTF-8 JSON, padded with spaces to a multiple of 8 bytes
+    arrays     the typed arrays listed in the header, each starting at an offset
+               that is a multiple of 8 bytes
+
+The header contains the small fields of grid_data.json (center, zoom etc.), the
+snapping results, and for each array its dtype, shape and byte offset from the end
+of the header. Since the arrays are aligned, they can be memory-mapped with NumPy or
+viewed in the browser as typed arrays over the ArrayBuffer without copying.
+
+Travel times are stored as uint16 when they fit and uint32 otherwise, with the
+largest value of the type standing for "no route". Coordinates are float32 by
+default, which is precise to about a meter.
+"""
+
+import json
+from pathlib import Path
+import struct
+
+import numpy as np
+
+from backend import json_stream, tracing, travel_times
+from backend.route_matrix import RouteMatrix
+
+MAGIC = b"STMGRID\0"
+VERSION = 1
+ALIGNMENT = 8
+
+# The fields of grid_data.json that are stored as arrays rather than in the header.
+ARRAY_FIELDS = ["locations", "route_matrix", "dense_travel_times"]
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _smallest_uint(max_value: int) -> np.dtype:
+    """The smallest unsigned type that can hold max_value and a sentinel above it."""
+    for dtype in [np.uint16, np.uint32]:
+        if max_value < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Value too large to store: {max_value}")
+
+
+def json_to_arrays(
+    grid_data: dict, coordinate_dtype: str = "float32"
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """Split the contents of grid_data.json into a header and typed arrays."""
+    locations = grid_data["locations"]
+    n_locations = len(locations)
+    index_dtype = _smallest_uint(n_locations)
+
+    arrays = {}
+    for kind in ["raw", "snapped"]:
+        for coordinate in ["lat", "lng"]:
+            arrays[f"{kind}_{coordinate}"] = np.array(
+                [x[f"{kind}_location"][coordinate] for x in locations],
+                dtype=coordinate_dtype,
+            )
+    arrays["grid_x"] = np.array([x["grid_x"] for x in locations], dtype=index_dtype)
+    arrays["grid_y"] = np.array([x["grid_y"] for x in locations], dtype=index_dtype)
+
+    route_matrix = RouteMatrix.from_entries(grid_data["route_matrix"])
+    arrays["origin_index"] = route_matrix.origin_index.astype(index_dtype)
+    arrays["destination_index"] = route_matrix.destination_index.astype(index_dtype)
+    arrays["duration_seconds"] = route_matrix.duration_seconds.astype(
+        _smallest_uint(int(route_matrix.duration_seconds.max(initial=0)))
+    )
+    arrays["distance_meters"] = route_matrix.distance_meters.astype(np.int32)
+
+    if "dense_travel_times" in grid_data:
+        # Until fill_in_dense_travel_times.py runs, the dense travel times can cover
+        # fewer locations. The others are stored as unreachable.
+        dense = travel_times.pad(
+            travel_times.from_nested_list(grid_data["dense_travel_times"]), n_locations
+        )
+        reachable = dense < travel_times.INF
+        dense_dtype = _smallest_uint(int(dense.max(initial=0, where=reachable)))
+        no_route = np.iinfo(dense_dtype).max
+        arrays["dense_travel_times"] = np.where(reachable, dense, no_route).astype(
+            dense_dtype
+        )
+
+    header = {
+        "keys": list(grid_data.keys()),
+        "metadata": {k: v for k, v in grid_data.items() if k not in ARRAY_FIELDS},
+        "snap_result_types": [x["snap_result_types"] for x in locations],
+        "snap_result_place_id": [x["snap_result_place_id"] for x in locations],
+    }
+    return header, arrays
+
+
+def write_arrays(
+    path: str | Path, header: dict, arrays: dict[str, np.ndarray], magic: bytes = MAGIC
+):
+    """Write a JSON header and typed arrays in the layout described above.
+
+    Args:
+        path: Where to write the file.
+        header: JSON-serializable fields. An "arrays" field is added to it.
+        arrays: The arrays to store, by name.
+        magic: The first 8 bytes of the file, to tell different kinds of files apart.
+    """
+    offset = 0
+    header = {**header, "arrays": {}}
+    for name, array in arrays.items():
+        header["arrays"][name] = {
+            "dtype": array.dtype.name,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode()
+    header_bytes = header_bytes.ljust(_align(len(header_bytes)), b" ")
+
+    with json_stream.atomic_write(path, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<II", VERSION, len(header_bytes)))
+        f.write(header_bytes)
+
+        data_start = f.tell()
+        for name, array in arrays.items():
+            f.write(b"\0" * (data_start + header["arrays"][name]["offset"] - f.tell()))
+            f.write(array.astype(array.dtype.newbyteorder("<")).tobytes())
+
+
+@tracing.traced("write binary")
+def write(path: str | Path, grid_data: dict, coordinate_dtype: str = "float32"):
+    """Write the contents of grid_data.json in the binary format.
+
+    Args:
+        path: Where to write the file.
+        grid_data: The contents of grid_data.json, e.g. from Grid.to_json().
+        coordinate_dtype: "float32", or "float64" to store the coordinates exactly.
+    """
+    header, arrays = json_to_arrays(grid_data, coordinate_dtype=coordinate_dtype)
+    write_arrays(path, header, arrays)
+
+
+def read_header(path: str | Path, magic: bytes = MAGIC) -> tuple[dict, int]:
+    """Read the header of a file written by write_arrays().
+
+    Returns:
+        The header and the position in the file where the arrays start.
+    """
+    with Path(path).open("rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} doesn't start with {magic!r}")
+
+        version, header_length = struct.unpack("<II", f.read(8))
+        if version != VERSION:
+            raise ValueError(
+                f"{path} has version {version}, only version {VERSION} is supported"
+            )
+
+        return json.loads(f.read(header_length)), f.tell()
+
+
+def read_arrays(
+    path: str | Path, magic: bytes = MAGIC, mmap: bool = True
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """Read a file written by write_arrays().
+
+    Args:
+        path: The file to read.
+        magic: The magic bytes the file is expected to start with.
+        mmap: Whether to memory-map the arrays instead of reading them into
+            memory. With mmap, the arrays are read-only.
+
+    Returns:
+        The header and the arrays, by name.
+    """
+    header, data_start = read_header(path, magic=magic)
+    arrays: dict[str, np.ndarray] = {}
+
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"]).newbyteorder("<")
+        shape = tuple(info["shape"])
+        if mmap:
+            if np.prod(shape) == 0:
+                # np.memmap refuses to map empty arrays.
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    path,
+                    dtype=dtype,
+                    mode="r",
+                    offset=data_start + info["offset"],
+                    shape=shape,
+                )
+        else:
+            with Path(path).open("rb") as f:
+                f.seek(data_start + info["offset"])
+                arrays[name] = np.fromfile(
+                    f, dtype=dtype, count=int(np.prod(shape))
+                ).reshape(shape)
+
+    return header, arrays
+
+
+class BinaryGridData:
+    def __init__(self, path: str | Path, mmap: bool = True):
+        """Read a file written by write().
+
+        Args:
+            path: The file to read.
+            mmap: Whether to memory-map the arrays instead of reading them into
+                memory. With mmap, the arrays are read-only.
+        """
+        self.path = Path(path)
+        self.header, self.arrays = read_arrays(self.path, mmap=mmap)
+
+    @property
+    def n_locations(self) -> int:
+        return len(self.arrays["raw_lat"])
+
+    def get_route_matrix(self) -> RouteMatrix:
+        return RouteMatrix(
+            origin_index=self.arrays["origin_index"].astype(np.int32),
+            destination_index=self.arrays["destination_index"].astype(np.int32),
+            duration_seconds=self.arrays["duration_seconds"].astype(np.int64),
+            distance_meters=self.arrays["distance_meters"].astype(np.int64),
+        )
+
+    def get_dense_travel_times(self) -> list[list[int | None]] | None:
+        """The dense travel times as in grid_data.json, with None for no route."""
+        dense = self.arrays.get("dense_travel_times")
+        if dense is None:
+            return None
+
+        no_route = np.iinfo(dense.dtype).max
+        return [[None if x == no_route else x for x in row] for row in dense.tolist()]
+
+    def get_locations(self) -> list[dict]:
+        a = self.arrays
+        return [
+            {
+                "raw_location": {"lat": raw_lat, "lng": raw_lng},
+                "snapped_location": {"lat": snapped_lat, "lng": snapped_lng},
+                "grid_x": grid_x,
+                "grid_y": grid_y,
+                "snap_result_types": snap_result_types,
+                "snap_result_place_id": snap_result_place_id,
+            }
+            for (
+                raw_lat,
+                raw_lng,
+                snapped_lat,
+                snapped_lng,
+                grid_x,
+                grid_y,
+                snap_result_types,
+                snap_result_place_id,
+            ) in zip(
+                # Going through float64 so that float32 coordinates are converted
+                # to the closest Python floats.
+                a["raw_lat"].astype(np.float64).tolist(),
+                a["raw_lng"].astype(np.float64).tolist(),
+                a["snapped_lat"].astype(np.float64).tolist(),
+                a["snapped_lng"].astype(np.float64).tolist(),
+                a["grid_x"].tolist(),
+                a["grid_y"].tolist(),
+                self.header["snap_result_types"],
+                self.header["snap_result_place_id"],
+            )
+        ]
+
+    def to_json(self) -> dict:
+        """Convert back to the contents of grid_data.json.
+
+        The result is identical to the original if the coordinates were stored as
+        float64.
+        """
+        fields = {
+            **self.header["metadata"],
+            "locations": self.get_locations(),
+            "route_matrix": self.get_route_matrix().to_entries(),
+        }
+        dense = self.get_dense_travel_times()
+        if dense is not None:
+            fields["dense_travel_times"] = dense
+
+        return {k: fields[k] for k in self.header["keys"]}
+
+
+def read(path: str | Path, mmap: bool = True) -> BinaryGridData:
+    return BinaryGridData(path, mmap=mmap)
@@ -0,0 +1,25 @@
+"""Defaults of the export parameters that are used in several modules.
+
+This module mustn't import anything heavy, since the export CLI needs these values
+just to build its argument parser, and e.g. `--help` shouldn't have to wait for
+numpy, pydantic and requests to be imported. The modules that use the defaults
+re-export them, like gmaps.DEFAULT_MAX_IN_FLIGHT.
+"""
+
+# How many Routes API requests to have in flight at once by default.
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# How long the API cache keeps results, see api_cache.py.
+DEFAULT_TTL_SECONDS = 90 * 24 * 60 * 60
+
+# The relative error of the approximated travel times to stop at, see
+# adaptive_sparsification.py.
+DEFAULT_TARGET_ERROR = 0.05
+
+# Only fetch routes between fine locations closer than this many grid spacings, see
+# hierarchical.py.
+DEFAULT_LOCAL_RADIUS_SPACINGS = 2.5
+
+# New locations closer than this many grid spacings to a seed location reuse it, see
+# incremental.py.
+DEFAULT_TOLERANCE_SPACINGS = 0.25
@@ -1,16 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import copy
 import json
+import math
 from pathlib import Path
 import shutil
 import subprocess
 import tempfile
 import argparse
+from typing import TYPE_CHECKING
 
-from backend import gmaps
-from backend.grid import Grid
-from backend.location import Location
+from backend import defaults
+from backend.travel_mode import TravelMode
+
+# The rest of the backend is imported in the functions that use it, so that the CLI
+# starts quickly. Importing numpy, pydantic and requests takes longer than --help or
+# --dry-run themselves.
+if TYPE_CHECKING:
+    from backend.export_journal import ExportJournal
+    from backend.gmaps import Budget
+    from backend.location import Location
 
 ASSETS_DIR = Path(__file__).parents[2] / "frontend" / "src" / "assets"
+# Written next to grid_data.json, so that we know how an export was made.
+EXPORT_PARAMS_FILENAME = "export_params.json"
+
+DEFAULT_ZOOM = 14
+DEFAULT_GRID_SIZE = 19
+DEFAULT_MAX_NORMALIZED_DISTANCE = 0.12
+# The size of the static map. Exports of the same area need the same size to be
+# combined, see hierarchical.check_compatible().
+SIZE_PIXELS = 640
 
 
 def is_qlmanage_available():
@@ -44,28 +64,220 @@ def save_image_bytes(image: bytes):
         return Path(f.name)
 
 
+def get_export_params(
+    center: "Location",
+    zoom: int,
+    grid_size: int,
+    max_normalized_distance: float | None,
+    travel_mode: TravelMode,
+    target_elements: int | None = None,
+    target_error: float = defaults.DEFAULT_TARGET_ERROR,
+    coarse: str | None = None,
+    seed: str | None = None,
+    seed_tolerance: float = defaults.DEFAULT_TOLERANCE_SPACINGS,
+    size_pixels: int = SIZE_PIXELS,
+) -> dict:
+    """The parameters that determine the result of an export.
+
+    Stored in the journal, since an interrupted export must be resumed with the same
+    parameters, and in EXPORT_PARAMS_FILENAME once it's done. With target_elements,
+    max_normalized_distance isn't used and is stored as None. Otherwise, if it's
+    None, it defaults to DEFAULT_MAX_NORMALIZED_DISTANCE, or if the export builds on
+    a coarse one, to only the nearby locations if that's less.
+    """
+    adaptive = target_elements is not None
+    if max_normalized_distance is None:
+        max_normalized_distance = DEFAULT_MAX_NORMALIZED_DISTANCE
+        if coarse is not None:
+            from backend import hierarchical
+
+            max_normalized_distance = min(
+                max_normalized_distance, hierarchical.get_local_radius(grid_size)
+            )
+    return {
+        "center": center.model_dump(),
+        "zoom": zoom,
+        "grid_size": grid_size,
+        "size_pixels": size_pixels,
+        "max_normalized_distance": None if adaptive else max_normalized_distance,
+        "travel_mode": str(travel_mode),
+        "target_elements": target_elements,
+        "target_error": target_error if adaptive else None,
+        "coarse": coarse,
+        "seed": seed,
+        "seed_tolerance": None if seed is None else seed_tolerance,
+    }
+
+
+def get_output_name(
+    output_name: str, travel_mode: TravelMode, n_travel_modes: int
+) -> str:
+    """Where to export one travel mode of an export of several.
+
+    With a single travel mode, that's just output_name. With several, driving goes
+    to output_name and the others get a suffix, like london and london_transit.
+    """
+    if n_travel_modes == 1 or travel_mode == TravelMode.DRIVE:
+        return output_name
+    return f"{output_name}_{str(travel_mode).lower()}"
+
+
+def share_snap_results(journals: list["ExportJournal"]):
+    """Record the snapping results of each journal in all the others.
+
+    The travel modes of an export share their snapping, so that any of them can be
+    resumed on its own.
+    """
+    snap_results = {}
+    for journal in journals:
+        snap_results.update(journal.snap_results)
+    for journal in journals:
+        for i, result in snap_results.items():
+            if i not in journal.snap_results:
+                journal.add_snap_result(i, result)
+
+
+def check_options(
+    travel_modes: list[TravelMode],
+    target_elements: int | None,
+    coarse: str | None,
+    seed: str | None,
+):
+    if len(set(travel_modes)) != len(travel_modes):
+        raise ValueError(f"Duplicate travel modes: {travel_modes}")
+    if seed is not None and (coarse is not None or target_elements is not None):
+        raise ValueError("A seed can't be combined with coarse or target_elements")
+
+
+def load_grid_data(output_name: str) -> dict:
+    with (ASSETS_DIR / output_name / "grid_data.json").open() as f:
+        return json.load(f)
+
+
 def main(
     output_name: str,
-    center: Location,
+    center: "Location",
     zoom: int,
     grid_size: int,
-    max_normalized_distance: float,
+    max_normalized_distance: float | None,
     preview: bool,
-    travel_mode: gmaps.TravelMode,
+    travel_modes: list[TravelMode],
+    max_in_flight: int = defaults.DEFAULT_MAX_IN_FLIGHT,
+    max_waste_fraction: float = 0.0,
+    use_cache: bool = True,
+    cache_ttl_days: float = defaults.DEFAULT_TTL_SECONDS / (24 * 60 * 60),
+    binary: bool = False,
+    resume: bool = False,
+    budget: "Budget | None" = None,
+    confirm_overwrite: bool = True,
+    target_elements: int | None = None,
+    target_error: float = defaults.DEFAULT_TARGET_ERROR,
+    coarse: str | None = None,
+    max_elements_per_mode: int | None = None,
+    seed: str | None = None,
+    seed_tolerance: float = defaults.DEFAULT_TOLERANCE_SPACINGS,
 ):
-    output_dir = ASSETS_DIR / output_name
+    """Export a grid to ASSETS_DIR / output_name.
+
+    The static map, snapping and the choice of pairs are the same for all travel
+    modes, so they're only done once. Then the route matrices of the travel modes
+    are fetched concurrently, and each is exported separately, see
+    get_output_name().
+
+    Args:
+        travel_modes: The travel modes to export.
+        coarse: The output name of an existing, coarser export of the same area to
+            build on, see hierarchical.py. With several travel modes, each builds on
+            the coarse export of its own mode, named like in get_output_name().
+        max_elements_per_mode: If given, each travel mode can use at most this many
+            route matrix elements, and there's no confirmation.
+        seed: The output name of an existing export to reuse the snapped locations,
+            routes and travel times of, see incremental.py. Named like coarse with
+            several travel modes. Can be the same as output_name.
+        seed_tolerance: How close, in grid spacings, a location needs to be to a
+            location of the seed to reuse it.
+    """
+    from backend import (
+        api_cache,
+        binary_export,
+        export_journal,
+        gmaps,
+        hierarchical,
+        http_client,
+        incremental,
+        tracing,
+    )
+    from backend.grid import Grid, compute_dense_travel_times
+    from backend.route_matrix import RouteMatrix
+
+    check_options(travel_modes, target_elements, coarse, seed)
+
+    n_modes = len(travel_modes)
+    output_dirs = {
+        mode: ASSETS_DIR / get_output_name(output_name, mode, n_modes)
+        for mode in travel_modes
+    }
+    coarse_names = {
+        mode: None if coarse is None else get_output_name(coarse, mode, n_modes)
+        for mode in travel_modes
+    }
+    seed_names = {
+        mode: None if seed is None else get_output_name(seed, mode, n_modes)
+        for mode in travel_modes
+    }
+    params = {
+        mode: get_export_params(
+            center,
+            zoom,
+            grid_size,
+            max_normalized_distance,
+            mode,
+            target_elements=target_elements,
+            target_error=target_error,
+            coarse=coarse_names[mode],
+            seed=seed_names[mode],
+            seed_tolerance=seed_tolerance,
+        )
+        for mode in travel_modes
+    }
+    # The same for all the modes.
+    max_normalized_distance = params[travel_modes[0]]["max_normalized_distance"]
 
-    if output_dir.exists():
-        print(f"{output_dir} already exists. Overwrite? [y/N]")
+    existing = [str(x) for x in output_dirs.values() if x.exists()]
+    if confirm_overwrite and not resume and existing:
+        print(f"{', '.join(existing)} already exist(s). Overwrite? [y/N]")
         if input() != "y":
             print("Aborting.")
             exit(1)
 
-    size_pixels = 640
+    coarse_data = {}
+    for mode, coarse_name in coarse_names.items():
+        if coarse_name is not None:
+            coarse_data[mode] = load_grid_data(coarse_name)
+            hierarchical.check_compatible(
+                coarse_data[mode], center, zoom, SIZE_PIXELS, mode
+            )
+
+    # Read before anything is written, since the seed can be the export that is
+    # being replaced.
+    seed_data = {}
+    for mode, seed_name in seed_names.items():
+        if seed_name is not None:
+            seed_data[mode] = load_grid_data(seed_name)
+            incremental.check_compatible(seed_data[mode], mode)
 
-    unmarked_image = gmaps.get_static_map(
-        center, zoom, markers=[], size_pixels=size_pixels
+    cache_ttl_seconds = cache_ttl_days * 24 * 60 * 60
+    snap_cache = (
+        api_cache.SnapCache(ttl_seconds=cache_ttl_seconds) if use_cache else None
+    )
+    route_cache = (
+        api_cache.RouteCache(ttl_seconds=cache_ttl_seconds) if use_cache else None
     )
+
+    with tracing.span("static map"):
+        unmarked_image = gmaps.get_static_map(
+            center, zoom, markers=[], size_pixels=SIZE_PIXELS
+        )
     unmarked_image_path = save_image_bytes(unmarked_image)
 
     if preview:
@@ -76,21 +288,64 @@ def main(
             )
             input()
 
+    # Everything we fetch from now on is recorded so that it's not lost if the
+    # export is interrupted, see export_journal.py.
+    journals = {}
+    for mode, output_dir in output_dirs.items():
+        output_dir.mkdir(exist_ok=True)
+        journals[mode] = export_journal.ExportJournal(
+            export_journal.get_journal_path(output_dir),
+            params=params[mode],
+            resume=resume,
+        )
+
     grid = Grid(
         center,
         zoom=zoom,
         size=grid_size,
-        snap_to_roads=True,
-        size_pixels=size_pixels,
-        travel_mode=travel_mode,
+        snap_to_roads=False,
+        size_pixels=SIZE_PIXELS,
+        travel_mode=travel_modes[0],
     )
+    known_snap_results = {}
+    if coarse_data:
+        first_coarse = next(iter(coarse_data.values()))
+        matches = hierarchical.match_locations(
+            first_coarse, grid.locations.raw_lat, grid.locations.raw_lng
+        )
+        known_snap_results = hierarchical.get_known_snap_results(first_coarse, matches)
+        print(
+            f"Reusing the snapped locations of {len(known_snap_results)} of "
+            f"{len(grid.locations)} locations from {coarse_names[travel_modes[0]]}."
+        )
+    seed_matches = None
+    if seed_data:
+        first_seed = next(iter(seed_data.values()))
+        seed_matches = incremental.match_locations(first_seed, grid, seed_tolerance)
+        known_snap_results = hierarchical.get_known_snap_results(
+            first_seed, seed_matches
+        )
+        print(
+            f"Reusing {len(known_snap_results)} of {len(grid.locations)} locations "
+            f"from {seed_names[travel_modes[0]]}."
+        )
+    for journal in journals.values():
+        known_snap_results.update(journal.snap_results)
+    grid.snap_to_roads(
+        max_in_flight=max_in_flight,
+        snap_cache=snap_cache,
+        journal=journals[travel_modes[0]],
+        known_results=known_snap_results,
+        budget=budget,
+    )
+    share_snap_results(list(journals.values()))
 
     if preview:
         marked_image = gmaps.get_static_map(
             center,
             zoom,
             markers=grid.get_snapped_locations(),
-            size_pixels=size_pixels,
+            size_pixels=SIZE_PIXELS,
         )
         marked_image_path = save_image_bytes(marked_image)
 
@@ -101,18 +356,221 @@ def main(
             )
             input()
 
-    grid.compute_sparsified_distance_matrix(
-        max_normalized_distance=max_normalized_distance
+    pairs = None
+    if target_elements is None:
+        pairs = grid.get_close_pairs(max_normalized_distance)
+        if seed_matches is not None:
+            pairs = incremental.get_pairs_to_fetch(
+                pairs, seed_matches, len(grid.locations)
+            )
+
+    budgets = {mode: budget for mode in travel_modes}
+    if max_elements_per_mode is not None:
+        budgets = {
+            mode: gmaps.Budget(
+                max_elements_per_mode * gmaps.DOLLARS_PER_ELEMENT, parent=budget
+            )
+            for mode in travel_modes
+        }
+    elif budget is None and n_modes > 1:
+        # The modes are fetched concurrently, so confirm once for all of them
+        # rather than in each of them.
+        if target_elements is None:
+            # Only one orientation of each pair is fetched.
+            n_elements = int((pairs[:, 0] < pairs[:, 1]).sum())
+        else:
+            n_elements = target_elements
+        gmaps.confirm_if_expensive_from_n(n_elements * n_modes)
+        budgets = {mode: gmaps.Budget() for mode in travel_modes}
+
+    @tracing.traced("export travel mode")
+    def export_mode(mode: TravelMode):
+        output_dir = output_dirs[mode]
+        journal = journals[mode]
+        mode_grid = copy.copy(grid)
+        mode_grid.travel_mode = mode
+
+        mode_grid.compute_sparsified_distance_matrix(
+            max_in_flight=max_in_flight,
+            max_waste_fraction=max_waste_fraction,
+            cache=route_cache,
+            journal=journal,
+            budget=budgets[mode],
+            target_elements=target_elements,
+            target_error=target_error,
+            pairs=pairs,
+        )
+
+        if mode in coarse_data:
+            dense_travel_times = hierarchical.get_dense_travel_times(
+                mode_grid, coarse_data[mode]
+            )
+        elif mode in seed_data:
+            mode_grid.route_matrix = RouteMatrix.concatenate(
+                [
+                    incremental.get_routes(seed_data[mode], seed_matches),
+                    mode_grid.route_matrix,
+                ]
+            ).sorted()
+            dense_travel_times = incremental.get_dense_travel_times(
+                mode_grid.route_matrix,
+                len(mode_grid.locations),
+                seed_data[mode],
+                seed_matches,
+            )
+        else:
+            dense_travel_times = compute_dense_travel_times(
+                mode_grid.route_matrix, n_locations=len(mode_grid.locations)
+            )
+        mode_grid.write_json(output_dir / "grid_data.json", dense_travel_times)
+        tracing.count("bytes written", (output_dir / "grid_data.json").stat().st_size)
+
+        if binary:
+            binary_export.write(
+                output_dir / "grid_data.bin", mode_grid.to_json(dense_travel_times)
+            )
+            tracing.count(
+                "bytes written", (output_dir / "grid_data.bin").stat().st_size
+            )
+
+        shutil.copy(unmarked_image_path, output_dir / "map.png")
+        with (output_dir / EXPORT_PARAMS_FILENAME).open("w") as f:
+            json.dump(params[mode], f, indent=2)
+        journal.remove()
+        print(f"Exported {mode} to {output_dir}")
+
+    if n_modes == 1:
+        export_mode(travel_modes[0])
+    else:
+        with ThreadPoolExecutor(max_workers=n_modes) as executor:
+            # list() to raise the first exception, if any.
+            list(executor.map(export_mode, travel_modes))
+
+    print(f"API usage: {http_client.summary()}")
+
+
+def dry_run(
+    output_name: str,
+    center: "Location",
+    zoom: int,
+    grid_size: int,
+    max_normalized_distance: float | None,
+    travel_modes: list[TravelMode],
+    max_in_flight: int = defaults.DEFAULT_MAX_IN_FLIGHT,
+    max_waste_fraction: float = 0.0,
+    target_elements: int | None = None,
+    coarse: str | None = None,
+    seed: str | None = None,
+    seed_tolerance: float = defaults.DEFAULT_TOLERANCE_SPACINGS,
+):
+    """Print the requests an export would send and what they'd cost, offline.
+
+    Plans the requests like main() does, but without snapping the locations to
+    roads, so the pairs are chosen by the raw locations. Neither the API cache nor
+    the journal of an interrupted export are taken into account, so an actual export
+    can be cheaper. With target_elements, the pairs are only chosen while fetching,
+    so only the upper bound on the elements is known.
+
+    Args:
+        See main().
+    """
+    from backend import gmaps, hierarchical, http_client, incremental, request_planner
+    from backend.grid import Grid
+
+    check_options(travel_modes, target_elements, coarse, seed)
+
+    n_modes = len(travel_modes)
+    first_mode = travel_modes[0]
+    params = get_export_params(
+        center,
+        zoom,
+        grid_size,
+        max_normalized_distance,
+        first_mode,
+        target_elements=target_elements,
+        coarse=coarse,
+        seed=seed,
+        seed_tolerance=seed_tolerance,
+    )
+    grid = Grid(
+        center,
+        zoom=zoom,
+        size=grid_size,
+        snap_to_roads=False,
+        size_pixels=SIZE_PIXELS,
+        travel_mode=first_mode,
     )
 
-    output_dir.mkdir(exist_ok=True)
+    # Like in main(), the snapping of the first mode's coarse or seed export is
+    # reused for all the modes.
+    n_reused = 0
+    seed_matches = None
+    if coarse is not None:
+        coarse_data = load_grid_data(get_output_name(coarse, first_mode, n_modes))
+        hierarchical.check_compatible(
+            coarse_data, center, zoom, SIZE_PIXELS, first_mode
+        )
+        matches = hierarchical.match_locations(
+            coarse_data, grid.locations.raw_lat, grid.locations.raw_lng
+        )
+        n_reused = int((matches >= 0).sum())
+    if seed is not None:
+        seed_data = load_grid_data(get_output_name(seed, first_mode, n_modes))
+        incremental.check_compatible(seed_data, first_mode)
+        seed_matches = incremental.match_locations(seed_data, grid, seed_tolerance)
+        n_reused = int((seed_matches >= 0).sum())
+    n_snapped = len(grid.locations) - n_reused
+    reused = f", {n_reused} locations reused from {coarse or seed}" if n_reused else ""
+    print(f"Snapping: {n_snapped} geocoding requests{reused}")
 
-    with open(output_dir / "grid_data.json", "w") as f:
-        json.dump(grid.to_json(), f)
+    pairs = None
+    if target_elements is None:
+        pairs = grid.get_close_pairs(params["max_normalized_distance"])
+        if seed_matches is not None:
+            pairs = incremental.get_pairs_to_fetch(
+                pairs, seed_matches, len(grid.locations)
+            )
+        # Only one orientation of each pair is fetched.
+        pairs = pairs[pairs[:, 0] <= pairs[:, 1]]
 
-    shutil.copy(unmarked_image_path, output_dir / "map.png")
+    n_requests = 0
+    n_elements = 0
+    # Modes with the same limits, like driving and walking, get the same plan.
+    plans = {}
+    for mode in travel_modes:
+        limits = gmaps.get_request_limits(mode)
+        name = get_output_name(output_name, mode, n_modes)
+        if pairs is not None:
+            if limits not in plans:
+                plans[limits] = request_planner.plan_requests(
+                    pairs, limits, max_waste_fraction, symmetric=True
+                )
+            plan = plans[limits]
+            n_requests += plan.n_requests
+            n_elements += plan.n_billed_elements
+            print(f"Routes for {name} ({mode}): {plan.summary()}")
+        else:
+            n_requests += math.ceil(target_elements / limits.max_elements)
+            n_elements += target_elements
+            print(
+                f"Routes for {name} ({mode}): at most {target_elements} billed "
+                "elements, chosen while fetching"
+            )
 
-    print(f"Exported to {output_dir}")
+    dollars = (
+        n_elements * gmaps.DOLLARS_PER_ELEMENT
+        + n_snapped * gmaps.DOLLARS_PER_GEOCODING_REQUEST
+    )
+    # The travel modes are fetched concurrently, but share the rate limit.
+    seconds = http_client.GEOCODING_SETTINGS.estimate_seconds(
+        n_snapped, n_snapped, max_in_flight
+    ) + http_client.ROUTES_SETTINGS.estimate_seconds(
+        n_requests, n_elements, max_in_flight * n_modes
+    )
+    print(
+        f"Total: {n_snapped + n_requests} requests, {n_elements} billed elements, "
+        f"about ${dollars:.2f} and {seconds / 60:.1f} minutes. Nothing was fetched."
+    )
 
 
 def float_with_trailing_comma_allowed(s: str) -> float:
@@ -131,21 +589,59 @@ def float_with_trailing_comma_allowed(s: str) -> float:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--output-name", type=str, required=True)
-    parser.add_argument(
-        "--center", nargs=2, type=float_with_trailing_comma_allowed, required=True
-    )
-    parser.add_argument("--zoom", type=int, default=14)
-    parser.add_argument("--grid-size", type=int, default=19)
+    parser.add_argument("--output-name", type=str)
+    parser.add_argument("--center", nargs=2, type=float_with_trailing_comma_allowed)
+    parser.add_argument("--zoom", type=int, default=DEFAULT_ZOOM)
+    parser.add_argument("--grid-size", type=int, default=DEFAULT_GRID_SIZE)
     parser.add_argument(
         "--max-normalized-distance",
         type=float,
-        default=0.12,
         help="Only compute travel times between points that are "
         "within this distance of each other, if we view the map under a "
         "[0,1]x[0,1] coordinate system. "
         "The other travel times are approximated from the sparse ones "
-        "using a all-pairs shortest path algorithm.",
+        "using a all-pairs shortest path algorithm. "
+        f"Defaults to {DEFAULT_MAX_NORMALIZED_DISTANCE}, and with --coarse, to at "
+        f"most {defaults.DEFAULT_LOCAL_RADIUS_SPACINGS} grid spacings.",
+    )
+    parser.add_argument(
+        "--target-elements",
+        type=int,
+        help="Instead of using --max-normalized-distance, choose which travel "
+        "times to compute adaptively, using at most this many route matrix "
+        "elements. See backend/adaptive_sparsification.py.",
+    )
+    parser.add_argument(
+        "--target-error",
+        type=float,
+        default=defaults.DEFAULT_TARGET_ERROR,
+        help="With --target-elements, stop early once the estimated relative error "
+        "of the approximated travel times is below this.",
+    )
+    parser.add_argument(
+        "--coarse",
+        type=str,
+        metavar="OUTPUT_NAME",
+        help="Build on an existing export of the same area with a smaller grid "
+        "size: reuse its snapped locations and use its travel times for long "
+        "distances, so that only routes between nearby locations are fetched. "
+        "See backend/hierarchical.py.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=str,
+        metavar="OUTPUT_NAME",
+        help="Reuse an existing export, e.g. with a smaller grid size or a slightly "
+        "different center: locations close to its locations reuse their snapping, "
+        "routes and travel times, and only routes to the other locations are "
+        "fetched. See backend/incremental.py.",
+    )
+    parser.add_argument(
+        "--seed-tolerance",
+        type=float,
+        default=defaults.DEFAULT_TOLERANCE_SPACINGS,
+        help="With --seed, how close a location needs to be to one of the seed's "
+        "to reuse it, in grid spacings.",
     )
     parser.add_argument(
         "--no-preview",
@@ -154,18 +650,158 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--travel-mode",
-        type=gmaps.TravelMode,
-        choices=list(gmaps.TravelMode),
-        default=gmaps.TravelMode.DRIVE,
+        type=TravelMode,
+        choices=list(TravelMode),
+        nargs="+",
+        default=[TravelMode.DRIVE],
+        help="With several travel modes, the snapping is shared and each mode is "
+        "exported separately: DRIVE to --output-name and the others to e.g. "
+        "<output-name>_transit.",
+    )
+    parser.add_argument(
+        "--max-elements-per-mode",
+        type=int,
+        help="Use at most this many route matrix elements for each travel mode, "
+        "without asking for confirmation.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=defaults.DEFAULT_MAX_IN_FLIGHT,
+        help="How many Google Maps API requests to send concurrently.",
+    )
+    parser.add_argument(
+        "--max-waste-fraction",
+        type=float,
+        default=0.0,
+        help="Allow up to this fraction of each Routes API request to be spent on "
+        "pairs of points that we don't need, in exchange for fewer requests.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not reuse or store travel times and snapped locations in the "
+        "local cache. "
+        "The cache location can be set with SPACETIME_MAPS_CACHE_DIR.",
+    )
+    parser.add_argument(
+        "--cache-ttl-days",
+        type=float,
+        default=defaults.DEFAULT_TTL_SECONDS / (24 * 60 * 60),
+        help="Ignore cached results older than this.",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="Also write grid_data.bin, a smaller binary version of grid_data.json.",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        metavar="PATH",
+        help="Record how long each stage and each API request takes, write it to "
+        "PATH as a Chrome trace (see chrome://tracing or ui.perfetto.dev) and print "
+        "a summary at the end.",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        metavar="OUTPUT_NAME",
+        help="Continue an interrupted export with this output name, without "
+        "fetching anything that was already fetched. The grid parameters are "
+        "taken from the interrupted export.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print how many requests and billed elements the export would "
+        "need, what that costs and roughly how long it takes, without sending any "
+        "requests. The locations aren't snapped to roads and nothing is taken from "
+        "the cache, so the actual export can differ a bit.",
     )
     args = parser.parse_args()
 
-    main(
-        output_name=args.output_name,
-        center=Location(lat=args.center[0], lng=args.center[1]),
-        zoom=args.zoom,
-        grid_size=args.grid_size,
-        max_normalized_distance=args.max_normalized_distance,
-        preview=not args.no_preview,
-        travel_mode=args.travel_mode,
-    )
+    from backend import export_journal, tracing
+    from backend.location import Location
+
+    if args.resume is not None:
+        journal_path = export_journal.get_journal_path(ASSETS_DIR / args.resume)
+        if not journal_path.exists():
+            parser.error(f"No interrupted export found at {journal_path}")
+
+        params = export_journal.read_params(journal_path)
+        output_name = args.resume
+        center = Location(**params["center"])
+        zoom = params["zoom"]
+        grid_size = params["grid_size"]
+        max_normalized_distance = params["max_normalized_distance"]
+        travel_modes = [TravelMode(params["travel_mode"])]
+        target_elements = params.get("target_elements")
+        target_error = params.get("target_error") or args.target_error
+        coarse = params.get("coarse")
+        seed = params.get("seed")
+        seed_tolerance = params.get("seed_tolerance") or args.seed_tolerance
+    else:
+        if args.output_name is None or args.center is None:
+            parser.error("--output-name and --center are required unless resuming")
+
+        output_name = args.output_name
+        center = Location(lat=args.center[0], lng=args.center[1])
+        zoom = args.zoom
+        grid_size = args.grid_size
+        max_normalized_distance = args.max_normalized_distance
+        travel_modes = args.travel_mode
+        target_elements = args.target_elements
+        target_error = args.target_error
+        coarse = args.coarse
+        seed = args.seed
+        seed_tolerance = args.seed_tolerance
+
+    if args.dry_run:
+        dry_run(
+            output_name=output_name,
+            center=center,
+            zoom=zoom,
+            grid_size=grid_size,
+            max_normalized_distance=max_normalized_distance,
+            travel_modes=travel_modes,
+            max_in_flight=args.max_in_flight,
+            max_waste_fraction=args.max_waste_fraction,
+            target_elements=target_elements,
+            coarse=coarse,
+            seed=seed,
+            seed_tolerance=seed_tolerance,
+        )
+        exit(0)
+
+    if args.trace is not None:
+        tracing.enable()
+    try:
+        main(
+            output_name=output_name,
+            center=center,
+            zoom=zoom,
+            grid_size=grid_size,
+            max_normalized_distance=max_normalized_distance,
+            preview=not args.no_preview,
+            travel_modes=travel_modes,
+            max_in_flight=args.max_in_flight,
+            max_waste_fraction=args.max_waste_fraction,
+            use_cache=not args.no_cache,
+            cache_ttl_days=args.cache_ttl_days,
+            binary=args.binary,
+            resume=args.resume is not None,
+            target_elements=target_elements,
+            target_error=target_error,
+            coarse=coarse,
+            max_elements_per_mode=args.max_elements_per_mode,
+            seed=seed,
+            seed_tolerance=seed_tolerance,
+        )
+    finally:
+        # Also when the export fails or is interrupted, since that's when it's
+        # most interesting where the time went.
+        if args.trace is not None:
+            tracing.write(args.trace)
+            print(tracing.summary())
+            print(f"Trace written to {args.trace}")
@@ -0,0 +1,135 @@
+"""A journal of the API results fetched during an export, for resuming after a crash.
+
+Every snapping result and every batch of route matrix entries is appended to a JSONL
+file and flushed to disk as soon as it arrives. If the export dies halfway through,
+`export.py --resume <output-name>` replays the journal and only fetches what's
+missing, so nothing that was already paid for is lost.
+"""
+
+import json
+import os
+from pathlib import Path
+import threading
+
+from backend.gmaps import ResolvedLocation
+from backend.location import Location
+
+JOURNAL_FILENAME = "export_journal.jsonl"
+
+
+def get_journal_path(output_dir: Path) -> Path:
+    return output_dir / JOURNAL_FILENAME
+
+
+def _read_records(path: Path) -> tuple[list[dict], int]:
+    """Read the records of a journal.
+
+    Returns:
+        The records and the length of the file up to the end of the last complete
+        record. A crash while writing can leave a partial record at the end.
+    """
+    records = []
+    valid_length = 0
+    with path.open("rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            valid_length += len(line)
+
+    return records, valid_length
+
+
+def read_params(path: Path) -> dict:
+    """Read the export parameters stored in a journal."""
+    records, _ = _read_records(path)
+    if not records or records[0]["type"] != "params":
+        raise ValueError(f"{path} doesn't start with the export parameters")
+    return records[0]["params"]
+
+
+class ExportJournal:
+    def __init__(self, path: Path, params: dict, resume: bool = False):
+        """Open a journal for an export.
+
+        Safe to use from multiple threads.
+
+        Args:
+            path: Where to store the journal.
+            params: The parameters of the export. When resuming, they must be the
+                same as the ones stored in the journal.
+            resume: Whether to replay an existing journal. Otherwise, any existing
+                journal at path is overwritten.
+        """
+        self.path = path
+        self.snap_results: dict[int, ResolvedLocation | None] = {}
+        self.route_entries: list[dict] = []
+        self._lock = threading.Lock()
+
+        if resume:
+            records, valid_length = _read_records(path)
+            if not records or records[0] != {"type": "params", "params": params}:
+                raise ValueError(f"{path} was written for different export parameters")
+            for record in records[1:]:
+                self._replay(record)
+
+            self._file = path.open("r+b")
+            self._file.truncate(valid_length)
+            self._file.seek(valid_length)
+        else:
+            self._file = path.open("wb")
+            self._append({"type": "params", "params": params})
+
+    def _replay(self, record: dict):
+        if record["type"] == "snap":
+            result = record["result"]
+            if result is not None:
+                result = {**result, "location": Location(**result["location"])}
+            self.snap_results[record["index"]] = result
+        elif record["type"] == "routes":
+            self.route_entries.extend(record["entries"])
+        else:
+            raise ValueError(f"Unknown journal record: {record}")
+
+    def _append(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record).encode() + b"\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def add_snap_result(self, index: int, result: ResolvedLocation | None):
+        """Record the result of snapping the location with the given index.
+
+        None means that there is no road nearby. Failures that might be transient
+        shouldn't be recorded, so that they're retried when resuming.
+        """
+        self._append(
+            {
+                "type": "snap",
+                "index": index,
+                "result": (
+                    None
+                    if result is None
+                    else {**result, "location": result["location"].model_dump()}
+                ),
+            }
+        )
+        with self._lock:
+            self.snap_results[index] = result
+
+    def add_route_entries(self, entries: list[dict]):
+        """Record a batch of route matrix entries."""
+        self._append({"type": "routes", "entries": entries})
+        with self._lock:
+            self.route_entries.extend(entries)
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """Delete the journal, once the export is done."""
+        self.close()
+        self.path.unlink()
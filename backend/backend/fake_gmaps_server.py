@@ -0,0 +1,418 @@
+"""A local stand-in for the Google Maps APIs that the export uses.
+
+Serves the Routes API's computeRouteMatrix, reverse geocoding and static maps with
+made-up but plausible data, so that the whole fetch pipeline can be run and load
+tested without paying for anything. Travel times are computed from the straight-line
+distance. Latency, quota limits, throttling, errors and malformed responses can be
+injected to see how the client copes.
+
+Start it with e.g.
+
+    python -m backend.fake_gmaps_server --port 8765 --quota-per-second 100
+
+and point export.py at it with
+
+    GMAPS_ROUTES_BASE_URL=http://localhost:8765 \\
+    GMAPS_MAPS_BASE_URL=http://localhost:8765 \\
+    python -m backend.export --output-name fake_test --center 50.08 14.43
+
+Request statistics, including requests per second, are served at /stats and printed
+when the server stops.
+"""
+
+import argparse
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import random
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+from backend.location import spherical_distances
+
+# Roads aren't straight lines.
+DETOUR_FACTOR = 1.3
+SPEED_METERS_PER_SECOND = {"DRIVE": 10.0, "WALK": 1.4, "TRANSIT": 6.0}
+# Time spent e.g. parking or waiting for the first bus, regardless of the distance.
+FIXED_DURATION_SECONDS = {"DRIVE": 60, "WALK": 0, "TRANSIT": 300}
+
+# The fake roads form a square lattice with this spacing.
+ROAD_SPACING_DEGREES = 0.001
+
+
+@dataclass
+class FakeServerSettings:
+    # Each response is delayed by a random time between 0.5x and 1.5x of this.
+    latency_seconds: float = 0.05
+    # Additional delay for each element of a route matrix.
+    latency_per_element_seconds: float = 0.0
+    # Requests over this many units per second get a 429 with Retry-After. A unit is
+    # an element for the Routes API and a request for the other APIs. None means
+    # unlimited.
+    quota_per_second: float | None = None
+    # Fractions of requests that randomly fail with 429 and 503, respectively.
+    throttle_rate: float = 0.0
+    error_rate: float = 0.0
+    # Fraction of route matrix responses where some of the entries are left out.
+    partial_rate: float = 0.0
+    # Fraction of route matrix entries without originIndex or destinationIndex.
+    missing_index_rate: float = 0.0
+    # Fraction of route matrix entries with an error status instead of a route.
+    element_error_rate: float = 0.0
+    # Fraction of geocoding requests that return ZERO_RESULTS.
+    zero_results_rate: float = 0.0
+    seed: int = 0
+
+
+def make_png(width: int, height: int, gray: int = 224) -> bytes:
+    """A PNG image of a single shade of gray."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    # Each row starts with the filter type, 0 for none.
+    rows = (b"\0" + bytes([gray]) * width) * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+def snap_to_fake_road(lat: float, lng: float) -> tuple[float, float]:
+    """Move a location onto the nearest line of the road lattice."""
+    snapped_lat = round(lat / ROAD_SPACING_DEGREES) * ROAD_SPACING_DEGREES
+    snapped_lng = round(lng / ROAD_SPACING_DEGREES) * ROAD_SPACING_DEGREES
+    if abs(snapped_lat - lat) < abs(snapped_lng - lng):
+        return snapped_lat, lng
+    return lat, snapped_lng
+
+
+class Quota:
+    def __init__(self, units_per_second: float):
+        """Allows units_per_second units in any one-second window."""
+        self.units_per_second = units_per_second
+        self._used: deque[tuple[float, float]] = deque()
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def try_use(self, units: float) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            while self._used and self._used[0][0] <= now - 1:
+                self._total -= self._used.popleft()[1]
+
+            # Always let a request through when nothing else is going on, even if
+            # it's bigger than the quota.
+            if self._used and self._total + units > self.units_per_second:
+                return False
+
+            self._used.append((now, units))
+            self._total += units
+            return True
+
+
+class FakeGmapsServer:
+    def __init__(
+        self,
+        settings: FakeServerSettings | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """A fake Google Maps server, see the module docstring.
+
+        Args:
+            settings: What to inject into the responses.
+            host: The host to listen on.
+            port: The port to listen on, 0 to pick a free one.
+        """
+        self.settings = settings or FakeServerSettings()
+        self.quota = (
+            Quota(self.settings.quota_per_second)
+            if self.settings.quota_per_second is not None
+            else None
+        )
+        self._rng = random.Random(self.settings.seed)
+        self._lock = threading.Lock()
+        self._stats: dict[str, dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self._thread: threading.Thread | None = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                server._handle(self, self.rfile.read(length))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeGmapsServer":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "FakeGmapsServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def _count(self, endpoint: str, key: str, amount: float = 1):
+        with self._lock:
+            stats = self._stats[endpoint]
+            now = time.monotonic()
+            if "first_request" not in stats:
+                stats["first_request"] = now
+            stats["last_request"] = now
+            stats[key] += amount
+
+    def get_stats(self) -> dict[str, dict[str, float]]:
+        """Counts of requests, units, throttled requests and errors per endpoint."""
+        with self._lock:
+            result = {}
+            for endpoint, stats in self._stats.items():
+                duration = stats["last_request"] - stats["first_request"]
+                result[endpoint] = {
+                    key: stats[key]
+                    for key in ["requests", "units", "throttled", "errors"]
+                }
+                # Between the first and the last request.
+                result[endpoint]["requests_per_second"] = (
+                    (stats["requests"] - 1) / duration if duration > 0 else 0.0
+                )
+            return result
+
+    def summary(self) -> str:
+        lines = []
+        for endpoint, stats in self.get_stats().items():
+            lines.append(
+                f"{endpoint}: {stats['requests']:.0f} requests "
+                f"({stats['requests_per_second']:.1f}/s), "
+                f"{stats['units']:.0f} units, {stats['throttled']:.0f} throttled, "
+                f"{stats['errors']:.0f} errors"
+            )
+        return "\n".join(lines)
+
+    def _handle(self, handler: BaseHTTPRequestHandler, body: bytes | None):
+        url = urllib.parse.urlparse(handler.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/stats":
+            self._respond(handler, 200, json.dumps(self.get_stats()).encode())
+            return
+
+        if url.path.endswith(":computeRouteMatrix") and body is not None:
+            endpoint = "routes"
+            payload = json.loads(body)
+            units = len(payload["origins"]) * len(payload["destinations"])
+            respond = lambda: self._route_matrix(payload)
+        elif url.path == "/maps/api/geocode/json":
+            endpoint, units = "geocoding", 1
+            respond = lambda: self._geocode(query)
+        elif url.path == "/maps/api/staticmap":
+            endpoint, units = "static_maps", 1
+            respond = lambda: self._static_map(query)
+        else:
+            self._respond(handler, 404, b'{"error": "Not found"}')
+            return
+
+        self._count(endpoint, "requests")
+
+        if self.quota is not None and not self.quota.try_use(units):
+            self._count(endpoint, "throttled")
+            self._respond(handler, 429, b'{"error": "Quota exceeded"}', retry_after=1)
+            return
+        if self._random() < self.settings.throttle_rate:
+            self._count(endpoint, "throttled")
+            self._respond(handler, 429, b'{"error": "Too many requests"}')
+            return
+        if self._random() < self.settings.error_rate:
+            self._count(endpoint, "errors")
+            self._respond(handler, 503, b'{"error": "Backend unavailable"}')
+            return
+
+        self._count(endpoint, "units", units)
+        latency = self.settings.latency_seconds * (0.5 + self._random())
+        if endpoint == "routes":
+            latency += self.settings.latency_per_element_seconds * units
+        time.sleep(latency)
+
+        content_type, content = respond()
+        self._respond(handler, 200, content, content_type=content_type)
+
+    def _respond(
+        self,
+        handler: BaseHTTPRequestHandler,
+        status: int,
+        content: bytes,
+        content_type: str = "application/json",
+        retry_after: float | None = None,
+    ):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(content)))
+        if retry_after is not None:
+            handler.send_header("Retry-After", str(retry_after))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def _route_matrix(self, payload: dict) -> tuple[str, bytes]:
+        def coordinates(waypoints: list[dict]) -> list[list[float]]:
+            lat_lngs = [x["waypoint"]["location"]["latLng"] for x in waypoints]
+            return [[x["latitude"], x["longitude"]] for x in lat_lngs]
+
+        origins = coordinates(payload["origins"])
+        destinations = coordinates(payload["destinations"])
+        travel_mode = payload.get("travelMode", "DRIVE")
+
+        partial = self._random() < self.settings.partial_rate
+        entries = []
+        for i, origin in enumerate(origins):
+            distances = spherical_distances(origin, destinations) * DETOUR_FACTOR
+            for j, distance in enumerate(distances.tolist()):
+                if partial and self._random() < 0.5:
+                    continue
+
+                entry = {"originIndex": i, "destinationIndex": j}
+                if self._random() < self.settings.element_error_rate:
+                    entry["status"] = {"code": 14, "message": "Fake element error"}
+                else:
+                    entry["status"] = {}
+                    # Like the real API, leave out distanceMeters when it's 0.
+                    if round(distance) > 0:
+                        entry["distanceMeters"] = round(distance)
+                    duration = FIXED_DURATION_SECONDS[travel_mode] * (distance > 0)
+                    duration += distance / SPEED_METERS_PER_SECOND[travel_mode]
+                    entry["duration"] = f"{math.ceil(duration)}s"
+                    entry["condition"] = "ROUTE_EXISTS"
+
+                if self._random() < self.settings.missing_index_rate:
+                    del entry[
+                        "originIndex" if self._random() < 0.5 else "destinationIndex"
+                    ]
+                entries.append(entry)
+
+        # The real API doesn't return the entries in any particular order either.
+        with self._lock:
+            self._rng.shuffle(entries)
+        return "application/json", json.dumps(entries).encode()
+
+    def _geocode(self, query: dict[str, list[str]]) -> tuple[str, bytes]:
+        lat, lng = map(float, query["latlng"][0].split(","))
+        if self._random() < self.settings.zero_results_rate:
+            return "application/json", b'{"results": [], "status": "ZERO_RESULTS"}'
+
+        road_lat, road_lng = snap_to_fake_road(lat, lng)
+        response = {
+            "results": [
+                {
+                    "geometry": {"location": {"lat": road_lat, "lng": road_lng}},
+                    "place_id": f"fake-road-{road_lat:.6f},{road_lng:.6f}",
+                    "types": ["route"],
+                },
+                {
+                    "geometry": {"location": {"lat": lat, "lng": lng}},
+                    "place_id": "fake-city",
+                    "types": ["locality", "political"],
+                },
+            ],
+            "status": "OK",
+        }
+        return "application/json", json.dumps(response).encode()
+
+    def _static_map(self, query: dict[str, list[str]]) -> tuple[str, bytes]:
+        width, height = map(int, query.get("size", ["400x400"])[0].split("x"))
+        scale = int(query.get("scale", ["1"])[0])
+        return "image/png", make_png(width * scale, height * scale)
+
+
+if __name__ == "__main__":
+    defaults = FakeServerSettings()
+    parser = argparse.ArgumentParser(
+        description="Serve fake Google Maps APIs for testing the export locally."
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=defaults.latency_seconds)
+    parser.add_argument(
+        "--latency-per-element",
+        type=float,
+        default=defaults.latency_per_element_seconds,
+    )
+    parser.add_argument(
+        "--quota-per-second",
+        type=float,
+        help="Throttle requests over this many route matrix elements (or other "
+        "requests) per second.",
+    )
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--partial-rate", type=float, default=0.0)
+    parser.add_argument("--missing-index-rate", type=float, default=0.0)
+    parser.add_argument("--element-error-rate", type=float, default=0.0)
+    parser.add_argument("--zero-results-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    fake_server = FakeGmapsServer(
+        FakeServerSettings(
+            latency_seconds=args.latency,
+            latency_per_element_seconds=args.latency_per_element,
+            quota_per_second=args.quota_per_second,
+            throttle_rate=args.throttle_rate,
+            error_rate=args.error_rate,
+            partial_rate=args.partial_rate,
+            missing_index_rate=args.missing_index_rate,
+            element_error_rate=args.element_error_rate,
+            zero_results_rate=args.zero_results_rate,
+            seed=args.seed,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+    print(f"Serving fake Google Maps APIs at {fake_server.url}")
+    print(f"export GMAPS_ROUTES_BASE_URL={fake_server.url}")
+    print(f"export GMAPS_MAPS_BASE_URL={fake_server.url}")
+    try:
+        fake_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake_server.httpd.server_close()
+        print(fake_server.summary())
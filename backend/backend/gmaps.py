@@ -1,28 +1,52 @@
-from enum import StrEnum
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
 import os
-import time
-from typing import Callable, Iterable, TypedDict
+from typing import Callable, Iterable, TypeVar, TypedDict
 import logging
+import math
+import threading
 
-import tqdm.auto as tqdm
-import requests
+import numpy as np
 
+from . import api_cache, http_client, request_planner, tracing
+from .api_cache import RouteCache, SnapCache
+from .defaults import DEFAULT_MAX_IN_FLIGHT
 from .location import Location
+from .travel_mode import TravelMode
 
 
 logger = logging.getLogger(__name__)
 
+# Note: 1000 elements = 5 dollars
+# https://developers.google.com/maps/documentation/routes/usage-and-billing#rm-basic
+DOLLARS_PER_ELEMENT = 0.005
+# https://developers.google.com/maps/documentation/geocoding/usage-and-billing
+DOLLARS_PER_GEOCODING_REQUEST = 0.005
 
-class TravelMode(StrEnum):
-    DRIVE = "DRIVE"
-    TRANSIT = "TRANSIT"
-    WALK = "WALK"
+DEFAULT_MAPS_BASE_URL = "https://maps.googleapis.com"
+DEFAULT_ROUTES_BASE_URL = "https://routes.googleapis.com"
+
+T = TypeVar("T")
 
 
 def get_api_key():
     return os.getenv("GMAPS_API_KEY")
 
 
+def get_maps_base_url() -> str:
+    """The base URL of the Static Maps and Geocoding APIs.
+
+    Can be pointed somewhere else with GMAPS_MAPS_BASE_URL, e.g. at
+    fake_gmaps_server.py.
+    """
+    return os.getenv("GMAPS_MAPS_BASE_URL", DEFAULT_MAPS_BASE_URL).rstrip("/")
+
+
+def get_routes_base_url() -> str:
+    """The base URL of the Routes API, can be changed with GMAPS_ROUTES_BASE_URL."""
+    return os.getenv("GMAPS_ROUTES_BASE_URL", DEFAULT_ROUTES_BASE_URL).rstrip("/")
+
+
 def get_static_map(
     center: Location,
     zoom: int,
@@ -49,8 +73,8 @@ def get_static_map(
         "style": "feature:poi|visibility:off",
     }
     params_s = "&".join([f"{k}={v}" for k, v in params.items()])
-    response = requests.get(
-        f"https://maps.googleapis.com/maps/api/staticmap?{params_s}"
+    response = http_client.get_static_maps_client().get(
+        f"{get_maps_base_url()}/maps/api/staticmap?{params_s}"
     )
     response.raise_for_status()
 
@@ -74,19 +98,23 @@ def get_distance_matrix_api_payload(
         # https://developers.google.com/maps/documentation/routes/transit-route#options
     }
 
+    routing_preference = get_routing_preference(travel_mode)
+    if routing_preference is not None:
+        payload["routingPreference"] = routing_preference
+
+    return payload
+
+
+def get_routing_preference(travel_mode: TravelMode) -> str | None:
     # routingPreference doesn't apply for travel_mode=TRANSIT.
     if travel_mode == TravelMode.DRIVE:
         # Note: TRAFFIC_AWARE and TRAFFIC_AWARE_OPTIMAL are more expensive.
         # TRAFFIC_UNAWARE is the default.
-        payload["routingPreference"] = "TRAFFIC_UNAWARE"
-
-    return payload
+        return "TRAFFIC_UNAWARE"
+    return None
 
 
 def confirm_if_expensive_from_n(n: int):
-    # Note: 1000 elements = 5 dollars
-    # https://developers.google.com/maps/documentation/routes/usage-and-billing#rm-basic
-    DOLLARS_PER_ELEMENT = 0.005
     n_entries = n
     cost_dollars = n_entries * DOLLARS_PER_ELEMENT
     if cost_dollars >= 1:
@@ -103,6 +131,57 @@ def confirm_if_expensive(origins: list[Location], destinations: list[Location]):
     return confirm_if_expensive_from_n(len(origins) * len(destinations))
 
 
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+class Budget:
+    def __init__(self, max_dollars: float = math.inf, parent: "Budget | None" = None):
+        """A limit on how much can be spent on route matrix elements and geocoding.
+
+        Used instead of asking for confirmation when running non-interactively.
+        Safe to use from multiple threads.
+
+        Args:
+            max_dollars: How much can be spent in total.
+            parent: If given, spending also counts towards this budget and fails if
+                it would go over it. This way several exports can share one limit
+                while still keeping track of their own costs.
+        """
+        self.max_dollars = max_dollars
+        self.parent = parent
+        self.spent_dollars = 0.0
+        self._lock = threading.Lock()
+
+    def spend(self, n_elements: int):
+        """Reserve the cost of n_elements route matrix elements.
+
+        Raises:
+            BudgetExceededError: If this or a parent budget doesn't have enough left.
+                Nothing is reserved in that case.
+        """
+        self.spend_dollars(n_elements * DOLLARS_PER_ELEMENT, f"{n_elements} routes")
+
+    def spend_geocoding(self, n_requests: int):
+        """Reserve the cost of n_requests geocoding requests, like spend()."""
+        self.spend_dollars(
+            n_requests * DOLLARS_PER_GEOCODING_REQUEST,
+            f"{n_requests} geocoding requests",
+        )
+
+    def spend_dollars(self, cost_dollars: float, description: str):
+        """Reserve cost_dollars, like spend(). description is for the error."""
+        with self._lock:
+            if self.spent_dollars + cost_dollars > self.max_dollars:
+                raise BudgetExceededError(
+                    f"{description} would cost {cost_dollars:.2f}$, but only "
+                    f"{self.max_dollars - self.spent_dollars:.2f}$ of the budget is left"
+                )
+            if self.parent is not None:
+                self.parent.spend_dollars(cost_dollars, description)
+            self.spent_dollars += cost_dollars
+
+
 def call_distance_matrix_api(
     origins: list[Location],
     destinations: list[Location],
@@ -118,30 +197,154 @@ def call_distance_matrix_api(
         origins, destinations, travel_mode=travel_mode
     )
 
-    for attempt in range(3):
-        response = requests.post(
-            "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix",
-            json=data,
-            headers={
-                "X-Goog-Api-Key": get_api_key(),
-                "X-Goog-FieldMask": "originIndex,destinationIndex,"
-                "duration,distanceMeters,status,condition",
-            },
+    # Retries on 429 and raises RuntimeError if the rate limit is still exceeded
+    # after several attempts.
+    response = http_client.get_routes_client().post(
+        f"{get_routes_base_url()}/distanceMatrix/v2:computeRouteMatrix",
+        cost=len(origins) * len(destinations),
+        json=data,
+        headers={
+            "X-Goog-Api-Key": get_api_key(),
+            "X-Goog-FieldMask": "originIndex,destinationIndex,"
+            "duration,distanceMeters,status,condition",
+        },
+    )
+    response.raise_for_status()
+    return response
+
+
+def get_route_matrix_entries(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    cache: RouteCache | None = None,
+    budget: Budget | None = None,
+) -> list[dict]:
+    """Get route matrix entries for all origin x destination pairs.
+
+    Like call_distance_matrix_api(), but returns the parsed entries, indexed into
+    origins and destinations. If a cache is given, only the pairs missing from the
+    cache are sent to the API, see get_sparsified_distance_matrix(). Their cost is
+    then taken from the budget or confirmed if it's expensive.
+    """
+    if cache is None:
+        return call_distance_matrix_api(
+            origins, destinations, confirm=False, travel_mode=travel_mode
+        ).json()
+
+    return list(
+        get_sparsified_distance_matrix(
+            origins,
+            destinations,
+            pairs=get_all_pairs(len(origins), len(destinations)),
+            filter_mirrored=False,
+            travel_mode=travel_mode,
+            max_in_flight=1,
+            cache=cache,
+            budget=budget,
         )
-        if response.status_code == 429:
-            print("Rate limit exceeded, retrying...")
-            time.sleep(30)
-            continue
+    )
+
+
+def get_all_pairs(n_origins: int, n_destinations: int) -> np.ndarray:
+    """All (origin index, destination index) pairs, as a (k, 2) array."""
+    return np.argwhere(np.ones((n_origins, n_destinations), dtype=bool))
 
-        response.raise_for_status()
-        return response
 
-    raise RuntimeError("Rate limit exceeded")
+def has_error(entry: dict) -> bool:
+    """Whether a route matrix entry is an error rather than a result."""
+    return bool(entry.get("status", {}).get("code"))
+
+
+def add_to_cache(
+    cache: RouteCache,
+    matrix_entries: list[dict],
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode,
+):
+    routing_preference = get_routing_preference(travel_mode)
+    cache.put_many(
+        [
+            (
+                api_cache.make_route_key(
+                    origins[entry["originIndex"]],
+                    destinations[entry["destinationIndex"]],
+                    travel_mode,
+                    routing_preference,
+                ),
+                entry,
+            )
+            for entry in matrix_entries
+            if "originIndex" in entry and "destinationIndex" in entry
+            # Errors might be transient, so don't cache them.
+            and not has_error(entry)
+        ]
+    )
+
+
+def fetch_concurrently(
+    jobs: list[Callable[[], list[T]]],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ordered: bool = True,
+    desc: str | None = None,
+) -> Iterable[T]:
+    """Run jobs in a thread pool and yield the items from the lists they return.
+
+    Args:
+        jobs: Functions that each make a request and return a list of results.
+        max_in_flight: How many jobs to run at the same time.
+        ordered: If True, yield the results in the order of the jobs, as if they
+            were run one after another. Otherwise yield them as soon as they arrive.
+        desc: Description for the progress bar.
+    """
+    # Imported here, since it can take a while and isn't needed for e.g. planning.
+    import tqdm.auto as tqdm
+
+    with tqdm.tqdm(total=len(jobs), desc=desc) as pbar:
+        if max_in_flight == 1:
+            for job in jobs:
+                yield from job()
+                pbar.update()
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        try:
+            futures = [executor.submit(job) for job in jobs]
+            for future in futures:
+                # Count jobs as they finish, even if their results are yielded
+                # later because an earlier job is still running.
+                future.add_done_callback(
+                    lambda future: future.cancelled() or pbar.update()
+                )
+            for future in futures if ordered else as_completed(futures):
+                yield from future.result()
+        finally:
+            # Don't send the remaining requests if something failed or the consumer
+            # stopped early.
+            executor.shutdown(cancel_futures=True)
 
 
 def get_distance_matrix(
-    origins: list[Location], destinations: list[Location]
+    origins: list[Location],
+    destinations: list[Location],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ordered: bool = True,
+    cache: RouteCache | None = None,
 ) -> Iterable[dict]:
+    if cache is not None:
+        # Only the pairs missing from the cache are confirmed and fetched.
+        yield from get_sparsified_distance_matrix(
+            origins,
+            destinations,
+            pairs=get_all_pairs(len(origins), len(destinations)),
+            filter_mirrored=False,
+            max_in_flight=max_in_flight,
+            ordered=ordered,
+            cache=cache,
+        )
+        return
+
     confirm_if_expensive(origins, destinations)
 
     # This ROOT_MAX_ENTRIES assumes travel_mode=DRIVE. For TRANSIT, it's 10.
@@ -149,50 +352,93 @@ def get_distance_matrix(
     MAX_ENTRIES = ROOT_MAX_ENTRIES * 2
 
     if len(origins) * len(destinations) > MAX_ENTRIES:
-        for i in tqdm.trange(0, len(origins), ROOT_MAX_ENTRIES):
-            for j in range(0, len(destinations), ROOT_MAX_ENTRIES):
-                response = call_distance_matrix_api(
-                    origins[i : i + ROOT_MAX_ENTRIES],
-                    destinations[j : j + ROOT_MAX_ENTRIES],
-                    confirm=False,  # Already confirmed above
-                )
 
-                # Reindex to match the original indices
-                matrix_entries = response.json()
-                for entry in matrix_entries:
-                    # TODO: Some requests returned entries that didn't have
-                    # originIndex or destinationIndex, but I couldn't reproduce.
-                    if "originIndex" in entry:
-                        entry["originIndex"] += i
-                    if "destinationIndex" in entry:
-                        entry["destinationIndex"] += j
-                yield from matrix_entries
+        def fetch_tile(i: int, j: int) -> list[dict]:
+            # Already confirmed above
+            matrix_entries = get_route_matrix_entries(
+                origins[i : i + ROOT_MAX_ENTRIES],
+                destinations[j : j + ROOT_MAX_ENTRIES],
+            )
+
+            # Reindex to match the original indices
+            for entry in matrix_entries:
+                # TODO: Some requests returned entries that didn't have
+                # originIndex or destinationIndex, but I couldn't reproduce.
+                if "originIndex" in entry:
+                    entry["originIndex"] += i
+                if "destinationIndex" in entry:
+                    entry["destinationIndex"] += j
+            return matrix_entries
+
+        jobs = [
+            functools.partial(fetch_tile, i, j)
+            for i in range(0, len(origins), ROOT_MAX_ENTRIES)
+            for j in range(0, len(destinations), ROOT_MAX_ENTRIES)
+        ]
+        yield from fetch_concurrently(
+            jobs, max_in_flight=max_in_flight, ordered=ordered
+        )
     else:
-        response = call_distance_matrix_api(origins, destinations)
-        yield from response.json()
+        yield from get_route_matrix_entries(origins, destinations)
 
 
 def get_sparsified_distance_matrix(
     origins: list[Location],
     destinations: list[Location],
-    should_include: Callable[[Location, Location], bool],
+    should_include: Callable[[Location, Location], bool] | None = None,
     filter_mirrored: bool = True,
     travel_mode: TravelMode = TravelMode.DRIVE,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ordered: bool = True,
+    max_waste_fraction: float = 0.0,
+    cache: RouteCache | None = None,
+    pairs: np.ndarray | None = None,
+    on_fetched: Callable[[list[dict]], None] | None = None,
+    budget: Budget | None = None,
 ) -> Iterable[dict]:
-    """Get a distance matrix, but only for a select subset of location pairs."""
-    mask = [
-        [should_include(origin, destination) for destination in destinations]
-        for origin in origins
-    ]
+    """Get a distance matrix, but only for a select subset of location pairs.
+
+    The wanted pairs are packed into as few requests as possible, see
+    request_planner.plan_requests(). For a symmetrical matrix, a pair may be fetched
+    in either orientation. Up to max_in_flight requests run concurrently.
+    If ordered is True, the entries are yielded in the same order as if the requests
+    were sent one by one.
+
+    Args:
+        should_include: Whether to include a pair of locations. Called for every
+            origin x destination pair, so for many locations, pass pairs instead.
+        max_waste_fraction: How much of each request can be spent on unwanted pairs
+            in order to send fewer requests. 0 means only wanted pairs are paid for.
+        cache: If given, pairs found in the cache are not requested again. They are
+            yielded first, followed by the fetched entries, which are added to the
+            cache.
+        pairs: (k, 2) array of the (origin index, destination index) pairs to
+            include, e.g. from spatial_index.find_close_pairs().
+        on_fetched: Called with the entries of each request as soon as they arrive,
+            before they're yielded. Runs in a worker thread.
+        budget: If given, the cost of the requests is taken from this budget instead
+            of asking for confirmation when it's expensive.
+    """
+    if pairs is None:
+        if should_include is None:
+            raise ValueError("Either should_include or pairs must be given.")
+        pairs = np.array(
+            [
+                (i, j)
+                for i, origin in enumerate(origins)
+                for j, destination in enumerate(destinations)
+                if should_include(origin, destination)
+            ],
+            dtype=np.int64,
+        )
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
 
-    if filter_mirrored and origins == destinations:
+    symmetric = filter_mirrored and origins == destinations
+    if symmetric:
         # For a symmetrical matrix, we only need to compute one triangle.
-        for i in range(len(origins)):
-            for j in range(i):
-                mask[i][j] = False
+        pairs = pairs[pairs[:, 0] <= pairs[:, 1]]
 
-    n_elements = sum(sum(x) for x in mask)
-    confirm_if_expensive_from_n(n_elements)
+    n_elements = len(pairs)
 
     if n_elements == 0:
         raise ValueError("No elements to include.")
@@ -202,38 +448,99 @@ def get_sparsified_distance_matrix(
         f"down from {len(origins) * len(destinations)}."
     )
 
-    for i_origin, (origin, cur_mask) in tqdm.tqdm(
-        enumerate(zip(origins, mask)), total=len(origins), desc="Computing travel times"
-    ):
-        cur_destinations = [
-            destination
-            for destination, include in zip(destinations, cur_mask)
-            if include
-        ]
-
-        if not cur_destinations:
-            continue
-
-        reindexing = {}
-        for i, include in enumerate(cur_mask):
-            if include:
-                reindexing[len(reindexing)] = i
+    cached_entries = []
+    if cache is not None:
+        routing_preference = get_routing_preference(travel_mode)
+        is_cached = np.zeros(len(pairs), dtype=bool)
+        for k, (i, j) in enumerate(pairs.tolist()):
+            # The planner may have fetched the pair in the other orientation.
+            orientations = [(i, j), (j, i)] if symmetric and i != j else [(i, j)]
+            for a, b in orientations:
+                entry = cache.get(
+                    api_cache.make_route_key(
+                        origins[a], destinations[b], travel_mode, routing_preference
+                    ),
+                    count_miss=(a, b) == orientations[-1],
+                )
+                if entry is not None:
+                    cached_entries.append(
+                        {"originIndex": a, "destinationIndex": b, **entry}
+                    )
+                    is_cached[k] = True
+                    break
+
+        pairs = pairs[~is_cached]
+        print(f"{cache.summary(DOLLARS_PER_ELEMENT)}.")
+        tracing.count("routes cached elements", len(cached_entries))
+
+    with tracing.span("plan requests", n_pairs=len(pairs)):
+        plan = request_planner.plan_requests(
+            pairs,
+            get_request_limits(travel_mode),
+            max_waste_fraction=max_waste_fraction,
+            symmetric=symmetric,
+        )
+    print(f"Request plan: {plan.summary()}.")
+    tracing.count("routes billed elements", plan.n_billed_elements)
+    tracing.count("routes wasted elements", plan.n_wasted_elements)
+    if budget is not None:
+        budget.spend(plan.n_billed_elements)
+    else:
+        confirm_if_expensive_from_n(plan.n_billed_elements)
 
-        # We're assuming that the number of destinations is small enough that we can
-        # send them all in one request. This would break for large grids.
+    def fetch_block(request: request_planner.PlannedRequest) -> list[dict]:
         response = call_distance_matrix_api(
-            [origin], cur_destinations, confirm=False, travel_mode=travel_mode
+            [origins[i] for i in request.origin_indices],
+            [destinations[j] for j in request.destination_indices],
+            confirm=False,
+            travel_mode=travel_mode,
         )
 
-        matrix_entries = response.json()
-        for entry in matrix_entries:
-            if "originIndex" in entry:
-                assert entry["originIndex"] == 0
-                entry["originIndex"] = i_origin
-            if "destinationIndex" in entry:
-                entry["destinationIndex"] = reindexing[entry["destinationIndex"]]
+        matrix_entries = []
+        for entry in response.json():
+            if "originIndex" not in entry or "destinationIndex" not in entry:
+                # There's no way to tell which pair these belong to. The pair is
+                # treated as if it wasn't returned at all.
+                logger.warning(f"Skipping route matrix entry without indices: {entry}")
+                continue
+            # Skip pairs that we only got because they were in the same block as the
+            # ones we wanted.
+            if not request.wanted[entry["originIndex"], entry["destinationIndex"]]:
+                continue
+            entry["originIndex"] = request.origin_indices[entry["originIndex"]]
+            entry["destinationIndex"] = request.destination_indices[
+                entry["destinationIndex"]
+            ]
+            matrix_entries.append(entry)
+
+        if cache is not None:
+            add_to_cache(cache, matrix_entries, origins, destinations, travel_mode)
+        if on_fetched is not None:
+            on_fetched(matrix_entries)
+
+        return matrix_entries
+
+    yield from cached_entries
+
+    jobs = [functools.partial(fetch_block, request) for request in plan.requests]
+    yield from fetch_concurrently(
+        jobs,
+        max_in_flight=max_in_flight,
+        ordered=ordered,
+        desc="Computing travel times",
+    )
 
-        yield from matrix_entries
+
+def get_request_limits(travel_mode: TravelMode) -> request_planner.RequestLimits:
+    # https://developers.google.com/maps/documentation/routes/choose_fields#matrix
+    if travel_mode == TravelMode.TRANSIT:
+        return request_planner.RequestLimits(
+            max_elements=100, max_origins=25, max_destinations=25
+        )
+    else:
+        return request_planner.RequestLimits(
+            max_elements=625, max_origins=25, max_destinations=25
+        )
 
 
 class ResolvedLocation(TypedDict):
@@ -242,19 +549,52 @@ class ResolvedLocation(TypedDict):
     types: list[str]
 
 
-def snap_to_road(location: Location) -> ResolvedLocation:
+class NoRoadNearbyError(ValueError):
+    """Snapping failed because there is no road nearby, not because of an API error."""
+
+
+def snap_to_road(
+    location: Location, cache: SnapCache | None = None, budget: Budget | None = None
+) -> ResolvedLocation:
     """Resolve a lan/lng pair to a location close to a road using reverse geocoding.
 
     This is useful for snapping points in unreachable locations, like bodies of water,
     to the closest road.
+
+    Raises NoRoadNearbyError if there is no road nearby, and ValueError for other
+    failures, which might be transient. If a cache is given, both the results and
+    the locations with no road nearby are cached. If a budget is given, requests
+    that aren't answered from the cache are charged to it.
     """
-    response = requests.get(
-        f"https://maps.googleapis.com/maps/api/geocode/json?"
+    key = api_cache.make_snap_key(location)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            if "error" in cached:
+                raise NoRoadNearbyError(cached["error"])
+            return {
+                "location": Location(**cached["location"]),
+                "place_id": cached["place_id"],
+                "types": cached["types"],
+            }
+
+    def fail(message: str):
+        if cache is not None:
+            cache.put_many([(key, {"error": message})])
+        raise NoRoadNearbyError(message)
+
+    if budget is not None:
+        budget.spend_geocoding(1)
+    response = http_client.get_geocoding_client().get(
+        f"{get_maps_base_url()}/maps/api/geocode/json?"
         f"latlng={location}&key={get_api_key()}"
     )
     data = response.json()
 
-    if data["status"] != "OK":
+    if data.get("status") == "ZERO_RESULTS":
+        fail(f"No results when resolving {location}. Got: {data}")
+    if data.get("status") != "OK":
+        # Not cached, this might be a transient error like OVER_QUERY_LIMIT.
         raise ValueError(f"Got non-OK status when resolving {location}. Got: {data}")
 
     # https://developers.google.com/maps/documentation/geocoding/requests-reverse-geocoding
@@ -274,9 +614,9 @@ def snap_to_road(location: Location) -> ResolvedLocation:
             break
 
     if resolution is None:
-        raise ValueError(f"No location found when resolving {location}. Got: {data}")
+        fail(f"No location found when resolving {location}. Got: {data}")
 
-    return {
+    result: ResolvedLocation = {
         "location": Location(
             lat=resolution["geometry"]["location"]["lat"],
             lng=resolution["geometry"]["location"]["lng"],
@@ -284,3 +624,7 @@ def snap_to_road(location: Location) -> ResolvedLocation:
         "place_id": resolution["place_id"],
         "types": resolution["types"],
     }
+    if cache is not None:
+        cache.put_many([(key, {**result, "location": result["location"].model_dump()})])
+
+    return result
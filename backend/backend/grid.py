@@ -1,11 +1,35 @@
+from dataclasses import dataclass
+import functools
 import math
-from typing import Literal, TypedDict
+from pathlib import Path
+from typing import Iterator
 from pydantic import BaseModel
-import tqdm.auto as tqdm
+import numpy as np
 import logging
 
-from backend.gmaps import TravelMode, get_sparsified_distance_matrix, snap_to_road
+from backend import (
+    adaptive_sparsification,
+    json_stream,
+    spatial_index,
+    tracing,
+    travel_times,
+)
+from backend.gmaps import (
+    DEFAULT_MAX_IN_FLIGHT,
+    Budget,
+    NoRoadNearbyError,
+    ResolvedLocation,
+    TravelMode,
+    confirm_if_expensive_from_n,
+    fetch_concurrently,
+    get_sparsified_distance_matrix,
+    has_error,
+    snap_to_road,
+)
 from backend.location import Location, NormalizedLocation, get_mercator_scale_factor
+from backend.api_cache import RouteCache, SnapCache
+from backend.export_journal import ExportJournal
+from backend.route_matrix import RouteMatrix, RouteMatrixEntry
 
 STATIC_MAP_SIZE_COEF = 0.7
 MAX_SNAP_NORMALIZED_DISTANCE = 0.05
@@ -22,13 +46,90 @@ class GridLocation(BaseModel):
     snap_result_place_id: str | None
 
 
-class RouteMatrixEntry(TypedDict):
-    originIndex: int
-    destinationIndex: int
-    status: dict
-    distanceMeters: int
-    duration: str  # e.g. "123s"
-    condition: Literal["ROUTE_EXISTS"]
+@dataclass
+class GridLocations:
+    """The locations of a grid, stored as parallel arrays.
+
+    Behaves like a list of GridLocations, but the models are only created when
+    they're accessed.
+    """
+
+    raw_lat: np.ndarray
+    raw_lng: np.ndarray
+    snapped_lat: np.ndarray
+    snapped_lng: np.ndarray
+    grid_x: np.ndarray
+    grid_y: np.ndarray
+    snap_result_types: list[list[str] | None]
+    snap_result_place_id: list[str | None]
+
+    def __len__(self) -> int:
+        return len(self.raw_lat)
+
+    def __getitem__(self, i: int) -> GridLocation:
+        return GridLocation(
+            raw_location=Location(
+                lat=self.raw_lat[i].item(), lng=self.raw_lng[i].item()
+            ),
+            snapped_location=Location(
+                lat=self.snapped_lat[i].item(), lng=self.snapped_lng[i].item()
+            ),
+            grid_x=self.grid_x[i].item(),
+            grid_y=self.grid_y[i].item(),
+            snap_result_types=self.snap_result_types[i],
+            snap_result_place_id=self.snap_result_place_id[i],
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def get_raw_locations(self) -> list[Location]:
+        return [
+            Location(lat=lat, lng=lng)
+            for lat, lng in zip(self.raw_lat.tolist(), self.raw_lng.tolist())
+        ]
+
+    def get_snapped_locations(self) -> list[Location]:
+        return [
+            Location(lat=lat, lng=lng)
+            for lat, lng in zip(self.snapped_lat.tolist(), self.snapped_lng.tolist())
+        ]
+
+    def to_json(self) -> list[dict]:
+        """Same as [x.model_dump(mode="json") for x in self], but much faster."""
+        return list(self.iter_json())
+
+    def iter_json(self) -> Iterator[dict]:
+        """to_json(), one location at a time."""
+        return (
+            {
+                "raw_location": {"lat": raw_lat, "lng": raw_lng},
+                "snapped_location": {"lat": snapped_lat, "lng": snapped_lng},
+                "grid_x": grid_x,
+                "grid_y": grid_y,
+                "snap_result_types": snap_result_types,
+                "snap_result_place_id": snap_result_place_id,
+            }
+            for (
+                raw_lat,
+                raw_lng,
+                snapped_lat,
+                snapped_lng,
+                grid_x,
+                grid_y,
+                snap_result_types,
+                snap_result_place_id,
+            ) in zip(
+                self.raw_lat.tolist(),
+                self.raw_lng.tolist(),
+                self.snapped_lat.tolist(),
+                self.snapped_lng.tolist(),
+                self.grid_x.tolist(),
+                self.grid_y.tolist(),
+                self.snap_result_types,
+                self.snap_result_place_id,
+            )
+        )
 
 
 class Grid:
@@ -42,6 +143,9 @@ class Grid:
         # a bigger size_pixels covers a larger area
         size_pixels: int = 400,
         travel_mode: TravelMode = TravelMode.DRIVE,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        snap_cache: SnapCache | None = None,
+        journal: ExportJournal | None = None,
     ):
         """A grid of locations, possibly with distance information.
 
@@ -51,6 +155,13 @@ class Grid:
             size: The number of rows and columns in the grid.
             snap_to_roads: Whether to snap the grid locations to roads.
             size_pixels: The size of the static map image, in pixels.
+            travel_mode: The travel mode used for the route matrix.
+            max_in_flight: How many geocoding requests to send concurrently when
+                snapping to roads.
+            snap_cache: If given, snapping results are reused from and stored in
+                this cache.
+            journal: If given, snapping results are replayed from and recorded in
+                this journal.
         """
         self.center = center
         self.zoom = zoom
@@ -58,67 +169,154 @@ class Grid:
         self.size_pixels = size_pixels
         self.travel_mode = travel_mode
 
-        self.locations: list[GridLocation] = []
-        self.route_matrix: list[RouteMatrixEntry] | None = None
+        self.route_matrix: RouteMatrix | None = None
+
+        raw_lat, raw_lng = make_grid_arrays(center, zoom, size, size_pixels)
+        n_locations = len(raw_lat)
+        indices = np.arange(n_locations, dtype=np.int32)
+
+        self.locations = GridLocations(
+            raw_lat=raw_lat,
+            raw_lng=raw_lng,
+            # If snapping fails, this is a bit of a hack since it's not actually
+            # snapped.
+            snapped_lat=raw_lat.copy(),
+            snapped_lng=raw_lng.copy(),
+            grid_x=indices % size,
+            grid_y=indices // size,
+            snap_result_types=[None] * n_locations,
+            snap_result_place_id=[None] * n_locations,
+        )
+
+        if snap_to_roads:
+            self.snap_to_roads(
+                max_in_flight=max_in_flight, snap_cache=snap_cache, journal=journal
+            )
 
-        raw_grid = make_grid(center, zoom, size, size_pixels)
+    @tracing.traced("snap to roads")
+    def snap_to_roads(
+        self,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        snap_cache: SnapCache | None = None,
+        journal: ExportJournal | None = None,
+        known_results: dict[int, ResolvedLocation | None] | None = None,
+        budget: Budget | None = None,
+    ) -> None:
+        """Move the locations to the nearest road, unless it's too far away.
 
-        for y, row in tqdm.tqdm(
-            enumerate(raw_grid),
-            total=size,
-            desc="Snapping to roads",
-            disable=not snap_to_roads,
+        Args:
+            known_results: Snapping results that are already known, by location
+                index, e.g. from a coarser grid of the same area. These and the
+                ones in the journal aren't fetched again.
+            budget: If given, the geocoding requests are charged to this budget.
+        """
+        raw_locations = self.locations.get_raw_locations()
+        snap_results: list[ResolvedLocation | None] = [None] * len(raw_locations)
+
+        known_results = dict(known_results or {})
+        if journal is not None:
+            known_results.update(journal.snap_results)
+        for i, result in known_results.items():
+            snap_results[i] = result
+        to_fetch = [i for i in range(len(raw_locations)) if i not in known_results]
+
+        def snap(i: int) -> list[ResolvedLocation | None]:
+            try:
+                result = try_snap_to_road(raw_locations[i], snap_cache, budget)
+            except ValueError:
+                # Might be transient, so it's not journaled and the location is
+                # snapped again when the export is resumed.
+                logger.warning(f"Failed to snap location to road: {raw_locations[i]}")
+                return [None]
+            if journal is not None:
+                journal.add_snap_result(i, result[0])
+            return result
+
+        jobs = [functools.partial(snap, i) for i in to_fetch]
+        for i, result in zip(
+            to_fetch,
+            fetch_concurrently(
+                jobs, max_in_flight=max_in_flight, desc="Snapping to roads"
+            ),
         ):
-            for x, location in enumerate(row):
-                cur: GridLocation = GridLocation(
-                    raw_location=location,
-                    snapped_location=location,
-                    grid_x=x,
-                    grid_y=y,
-                    snap_result_types=None,
-                    snap_result_place_id=None,
+            snap_results[i] = result
+        if snap_cache is not None:
+            logger.info(snap_cache.summary())
+
+        snapped = [i for i, x in enumerate(snap_results) if x is not None]
+        if not snapped:
+            return
+
+        raw_coordinates = self.get_normalized_coordinates(
+            self.locations.raw_lat[snapped], self.locations.raw_lng[snapped]
+        )
+        snapped_coordinates = self.get_normalized_coordinates(
+            np.array([snap_results[i]["location"].lat for i in snapped]),
+            np.array([snap_results[i]["location"].lng for i in snapped]),
+        )
+        snap_distances = np.hypot(*(raw_coordinates - snapped_coordinates).T).tolist()
+
+        for i, snap_distance in zip(snapped, snap_distances):
+            snap_result = snap_results[i]
+            if snap_distance > MAX_SNAP_NORMALIZED_DISTANCE:
+                logger.warning(
+                    f"Snapped location is too far from original ({snap_distance:.3f}), "
+                    "skipping: "
+                    f"{raw_locations[i]}"
                 )
-                if snap_to_roads:
-                    try:
-                        snap_result = snap_to_road(location)
-
-                        snap_distance = self.get_normalized_distance(
-                            location, snap_result["location"]
-                        )
-                        if snap_distance > MAX_SNAP_NORMALIZED_DISTANCE:
-                            logger.warning(
-                                f"Snapped location is too far from original ({snap_distance:.3f}), "
-                                "skipping: "
-                                f"{location}"
-                            )
-                        else:
-                            cur.snapped_location = snap_result["location"]
-                            cur.snap_result_types = snap_result["types"]
-                            cur.snap_result_place_id = snap_result["place_id"]
-                    except ValueError:
-                        logger.warning(f"Failed to snap location to road: {location}")
-                        # A bit of a hack since it's not actually snapped
-                        cur.snapped_location = location
-
-                self.locations.append(cur)
-
-    def to_json(self):
+                continue
+
+            self.locations.snapped_lat[i] = snap_result["location"].lat
+            self.locations.snapped_lng[i] = snap_result["location"].lng
+            self.locations.snap_result_types[i] = snap_result["types"]
+            self.locations.snap_result_place_id[i] = snap_result["place_id"]
+
+    def get_json_fields(self, dense_travel_times: np.ndarray | None = None) -> dict:
+        """The fields of to_json(), with the large arrays as iterators.
+
+        For writing with json_stream.write_object() without building the whole
+        output in memory.
+
+        Args:
+            dense_travel_times: The output of compute_dense_travel_times(), if it
+                was already computed.
+        """
+        if dense_travel_times is None:
+            dense_travel_times = compute_dense_travel_times(
+                self.route_matrix, n_locations=len(self.locations)
+            )
+
         return {
             "center": self.center.model_dump(mode="json"),
             "zoom": self.zoom,
             "size": self.size,
             "size_pixels": self.size_pixels,
             "travel_mode": self.travel_mode,
-            "locations": [x.model_dump(mode="json") for x in self.locations],
-            "route_matrix": self.route_matrix,
-            "dense_travel_times": get_dense_travel_times(self.route_matrix),
+            "locations": self.locations.iter_json(),
+            "route_matrix": self.route_matrix.iter_entries(),
+            "dense_travel_times": travel_times.iter_nested_rows(dense_travel_times),
+        }
+
+    def to_json(self, dense_travel_times: np.ndarray | None = None):
+        return {
+            key: list(value) if isinstance(value, Iterator) else value
+            for key, value in self.get_json_fields(dense_travel_times).items()
         }
 
+    def write_json(
+        self, path: str | Path, dense_travel_times: np.ndarray | None = None
+    ):
+        """Write to_json() to a file, streaming it instead of building it in memory.
+
+        The file is replaced atomically, so it's never left half-written.
+        """
+        json_stream.write_object_file(path, self.get_json_fields(dense_travel_times))
+
     def get_snapped_locations(self) -> list[Location]:
-        return [x.snapped_location for x in self.locations]
+        return self.locations.get_snapped_locations()
 
     def get_raw_locations(self) -> list[Location]:
-        return [x.raw_location for x in self.locations]
+        return self.locations.get_raw_locations()
 
     def location_to_normalized(self, location: Location) -> NormalizedLocation:
         max_offset_lat = (
@@ -134,45 +332,151 @@ class Grid:
         y = (-location.lat + self.center.lat + max_offset_lat) / (2 * max_offset_lat)
         return NormalizedLocation(x=x, y=y)
 
+    def get_normalized_coordinates(
+        self, lat: np.ndarray, lng: np.ndarray
+    ) -> np.ndarray:
+        """location_to_normalized() for many locations, as an (n, 2) array of x, y."""
+        # Same as get_mercator_scale_factor(), vectorized.
+        max_offset_lat = (
+            STATIC_MAP_SIZE_COEF
+            * self.size_pixels
+            / 2**self.zoom
+            * np.cos(lat / 180 * math.pi)
+        )
+        max_offset_lng = STATIC_MAP_SIZE_COEF * self.size_pixels / 2**self.zoom
+
+        x = (lng - self.center.lng + max_offset_lng) / (2 * max_offset_lng)
+        y = (-lat + self.center.lat + max_offset_lat) / (2 * max_offset_lat)
+        return np.stack([x, y], axis=1)
+
+    @tracing.traced("fetch routes")
     def compute_sparsified_distance_matrix(
-        self, max_normalized_distance: float
+        self,
+        max_normalized_distance: float | None = None,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        max_waste_fraction: float = 0.0,
+        cache: RouteCache | None = None,
+        journal: ExportJournal | None = None,
+        budget: Budget | None = None,
+        target_elements: int | None = None,
+        target_error: float = adaptive_sparsification.DEFAULT_TARGET_ERROR,
+        pairs: np.ndarray | None = None,
     ) -> None:
         """Compute a distance matrix where we only compute distance nearby points.
 
         Specifically, we measure "normalized distance" - Euclidean distance of the
         points when projected onto the map, normalized to [0, 1] along both axes.
-        """
+        Alternatively, the pairs can be chosen adaptively to fit a number of
+        elements, see adaptive_sparsification.py, or given explicitly. Exactly one
+        of max_normalized_distance, target_elements and pairs must be given.
 
-        def should_include(a: Location, b: Location):
-            if a == b:
-                return False
-            a_normalized = self.location_to_normalized(a)
-            b_normalized = self.location_to_normalized(b)
-            distance = math.hypot(
-                a_normalized.x - b_normalized.x, a_normalized.y - b_normalized.y
-            )
-            return distance < max_normalized_distance
-
-        distance_matrix = list(
-            get_sparsified_distance_matrix(
-                self.get_snapped_locations(),
-                self.get_snapped_locations(),
-                should_include=should_include,
-                travel_mode=self.travel_mode,
+        Args:
+            max_normalized_distance: Only compute distances between points closer
+                than this.
+            max_in_flight: How many Routes API requests to send concurrently.
+            max_waste_fraction: How much of each request can be spent on pairs that
+                we don't need, in exchange for sending fewer requests.
+            cache: If given, route matrix elements are reused from and stored in this
+                cache.
+            journal: If given, route matrix elements are replayed from and recorded
+                in this journal.
+            budget: If given, the cost is taken from this budget instead of asking
+                for confirmation.
+            target_elements: Choose the pairs adaptively, using at most this many
+                route matrix elements.
+            target_error: With target_elements, stop early once the estimated
+                relative error of the approximated travel times is below this.
+            pairs: (k, 2) pairs of location indices to compute the distances of,
+                e.g. from get_close_pairs() of a grid with the same locations.
+        """
+        n_given = sum(
+            x is not None for x in [max_normalized_distance, target_elements, pairs]
+        )
+        if n_given != 1:
+            raise ValueError(
+                "Exactly one of max_normalized_distance, target_elements and pairs "
+                "must be given"
             )
+
+        locations = self.get_snapped_locations()
+        coordinates = self.get_normalized_coordinates(
+            self.locations.snapped_lat, self.locations.snapped_lng
         )
-        original_len = len(distance_matrix)
-        distance_matrix = [
-            entry for entry in distance_matrix if entry["condition"] == "ROUTE_EXISTS"
-        ]
-        if len(distance_matrix) != original_len:
-            logger.info(
-                f"Filtered away {original_len - len(distance_matrix)} distance matrix "
-                "entries for which routes were not found. "
-                f"{len(distance_matrix)} entries remain."
+
+        journaled = {}
+        if journal is not None:
+            # Errors might be transient, so those pairs are requested again.
+            # Keyed by the unordered pair, the planner may have fetched either
+            # orientation.
+            journaled = {
+                _get_pair_key(x["originIndex"], x["destinationIndex"]): x
+                for x in journal.route_entries
+                if not has_error(x)
+            }
+            if journaled:
+                print(
+                    f"Replaying {len(journaled)} route matrix elements from "
+                    f"{journal.path}."
+                )
+
+        def fetch(to_fetch: np.ndarray) -> list[dict]:
+            # Each pair once, even if to_fetch has both orientations.
+            keys = dict.fromkeys(_get_pair_key(i, j) for i, j in to_fetch.tolist())
+            entries = [journaled[x] for x in keys if x in journaled]
+            to_fetch = remove_pairs(
+                to_fetch, list(journaled), n_locations=len(locations)
+            )
+            if len(to_fetch) > 0:
+                entries += get_sparsified_distance_matrix(
+                    locations,
+                    locations,
+                    pairs=to_fetch,
+                    travel_mode=self.travel_mode,
+                    max_in_flight=max_in_flight,
+                    max_waste_fraction=max_waste_fraction,
+                    cache=cache,
+                    on_fetched=(
+                        journal.add_route_entries if journal is not None else None
+                    ),
+                    budget=budget,
+                )
+            return get_found_routes(entries)
+
+        if target_elements is not None:
+            if budget is None:
+                # Confirm once for everything, rather than once per round.
+                confirm_if_expensive_from_n(target_elements)
+                budget = Budget()
+            route_matrix, rounds = adaptive_sparsification.select_and_fetch(
+                coordinates,
+                np.stack([self.locations.snapped_lat, self.locations.snapped_lng], 1),
+                lambda pairs: RouteMatrix.from_entries(fetch(pairs)),
+                target_elements=target_elements,
+                target_error=target_error,
             )
+            print(adaptive_sparsification.format_rounds(rounds))
+        else:
+            if pairs is None:
+                pairs = self.get_close_pairs(max_normalized_distance)
+            route_matrix = RouteMatrix.from_entries(fetch(pairs))
+
+        self.route_matrix = route_matrix.sorted()
 
-        self.route_matrix = distance_matrix
+    def get_close_pairs(self, max_normalized_distance: float) -> np.ndarray:
+        """The pairs of locations that are closer than max_normalized_distance.
+
+        Returns:
+            (k, 2) array with both orientations of each pair. Locations that
+            snapped to the same place aren't paired, since they don't need a route.
+        """
+        coordinates = self.get_normalized_coordinates(
+            self.locations.snapped_lat, self.locations.snapped_lng
+        )
+        pairs = spatial_index.find_close_pairs(coordinates, max_normalized_distance)
+        same_place = np.all(
+            coordinates[pairs[:, 0]] == coordinates[pairs[:, 1]], axis=1
+        )
+        return pairs[~same_place]
 
     def get_normalized_distance(self, a: Location, b: Location) -> float:
         """Get the normalized distance between two locations."""
@@ -183,8 +487,156 @@ class Grid:
         )
 
 
-def get_dense_travel_times(route_matrix: list[RouteMatrixEntry]):
-    """Fills in the sparse route matrix to get a dense matrix of travel times."""
+def get_found_routes(entries: list[dict]) -> list[dict]:
+    """Leave out the route matrix entries for which no route was found."""
+    found = [x for x in entries if x.get("condition") == "ROUTE_EXISTS"]
+    if len(found) != len(entries):
+        logger.info(
+            f"Filtered away {len(entries) - len(found)} distance matrix "
+            "entries for which routes were not found. "
+            f"{len(found)} entries remain."
+        )
+    return found
+
+
+def _get_pair_key(i: int, j: int) -> tuple[int, int]:
+    return min(i, j), max(i, j)
+
+
+def remove_pairs(
+    pairs: np.ndarray, to_remove: list[tuple[int, int]], n_locations: int
+) -> np.ndarray:
+    """Remove pairs of indices that are in to_remove, in either orientation."""
+    to_remove = np.array(to_remove, dtype=np.int64).reshape(-1, 2)
+    # Encode each unordered pair as a single integer.
+    keys = pairs.min(axis=1) * n_locations + pairs.max(axis=1)
+    keys_to_remove = to_remove.min(axis=1) * n_locations + to_remove.max(axis=1)
+    return pairs[~np.isin(keys, keys_to_remove)]
+
+
+def try_snap_to_road(
+    location: Location, cache: SnapCache | None = None, budget: Budget | None = None
+) -> list[ResolvedLocation | None]:
+    """snap_to_road(), but returns [None] if there is no road nearby.
+
+    For use with fetch_concurrently(). Other failures might be transient, so they
+    are raised.
+    """
+    try:
+        return [snap_to_road(location, cache=cache, budget=budget)]
+    except NoRoadNearbyError:
+        logger.warning(f"No road near location: {location}")
+        return [None]
+
+
+def get_dense_travel_times(
+    route_matrix: RouteMatrix | list[RouteMatrixEntry],
+    method: travel_times.DenseMethod = "auto",
+    max_workers: int | None = None,
+    progress: bool = True,
+):
+    """Fills in the sparse route matrix to get a dense matrix of travel times.
+
+    Unreachable pairs are None.
+
+    Args:
+        route_matrix: The sparse route matrix, either as a RouteMatrix or as a list
+            of entries in the format returned by the Routes API.
+        method: The all-pairs shortest path algorithm to use, see
+            travel_times.all_pairs().
+        max_workers: Number of processes to use if the method is "dijkstra".
+        progress: Whether to show a progress bar.
+    """
+    if not isinstance(route_matrix, RouteMatrix):
+        route_matrix = RouteMatrix.from_entries(route_matrix)
+    m = compute_dense_travel_times(route_matrix, method, max_workers, progress)
+    return travel_times.to_nested_list(m)
+
+
+@tracing.traced("dense travel times")
+def compute_dense_travel_times(
+    route_matrix: RouteMatrix,
+    method: travel_times.DenseMethod = "auto",
+    max_workers: int | None = None,
+    progress: bool = True,
+    n_locations: int | None = None,
+) -> np.ndarray:
+    """get_dense_travel_times(), as an array with travel_times.INF if unreachable.
+
+    Args:
+        n_locations: The size of the result. Defaults to one more than the largest
+            index in the route matrix, which leaves out trailing locations without
+            any routes, so pass it when the number of locations is known.
+    """
+    return travel_times.all_pairs(
+        route_matrix.to_array(n_locations),
+        method=method,
+        max_workers=max_workers,
+        progress=progress,
+    )
+
+
+def update_dense_travel_times(
+    route_matrix: RouteMatrix,
+    dense_travel_times: np.ndarray,
+    new_entries: RouteMatrix,
+    method: travel_times.DenseMethod = "auto",
+    max_workers: int | None = None,
+) -> tuple[RouteMatrix, np.ndarray]:
+    """Update a dense matrix of travel times after adding entries to the route matrix.
+
+    Equivalent to compute_dense_travel_times() of both route matrices together, but
+    if the new entries only add routes or make existing ones shorter, the dense
+    matrix is updated incrementally instead of being recomputed from scratch. If
+    some route gets longer, falls back to recomputing everything.
+
+    Args:
+        route_matrix: The route matrix that dense_travel_times was computed from.
+        dense_travel_times: The output of compute_dense_travel_times(route_matrix).
+            Not modified.
+        new_entries: Entries to add. They replace existing entries for the same
+            pair of locations.
+        method: Passed to compute_dense_travel_times() if a recompute is needed.
+        max_workers: Passed to compute_dense_travel_times() if a recompute is
+            needed.
+
+    Returns:
+        The new route matrix and the new dense travel times.
+    """
+    new_route_matrix = RouteMatrix.concatenate(
+        [route_matrix, new_entries]
+    ).deduplicated()
+    if len(new_entries) == 0:
+        return new_route_matrix, dense_travel_times
+
+    n_locations = max(new_route_matrix.get_n_locations(), len(dense_travel_times))
+    old_direct = route_matrix.to_array(n_locations)
+    new_direct = new_route_matrix.to_array(n_locations)
+
+    # The direct travel times are symmetric, so only look at one triangle.
+    origins, destinations = np.nonzero(np.triu(old_direct != new_direct))
+    old_durations = old_direct[origins, destinations]
+    new_durations = new_direct[origins, destinations]
+
+    if (new_durations > old_durations).any():
+        logger.info("Some routes got longer, recomputing the dense matrix.")
+        return new_route_matrix, compute_dense_travel_times(
+            new_route_matrix, method=method, max_workers=max_workers
+        )
+
+    dist = travel_times.pad(dense_travel_times.copy(), n_locations)
+    travel_times.add_shorter_routes(
+        dist,
+        list(zip(origins.tolist(), destinations.tolist(), new_durations.tolist())),
+    )
+    return new_route_matrix, dist
+
+
+def get_dense_travel_times_reference(route_matrix: list[RouteMatrixEntry]):
+    """Pure-Python version of get_dense_travel_times().
+
+    Much slower, kept around to check the NumPy version against.
+    """
     n_locations = (
         max(max(x["originIndex"], x["destinationIndex"]) for x in route_matrix) + 1
     )
@@ -199,6 +651,8 @@ def get_dense_travel_times(route_matrix: list[RouteMatrixEntry]):
         m[origin][destination] = duration
         m[destination][origin] = duration
 
+    import tqdm.auto as tqdm
+
     # Run the Floyd-Warshall algorithm to fill in the rest of the matrix.
     for k in tqdm.trange(len(m), desc="Computing dense matrix"):
         for i in range(len(m)):
@@ -211,7 +665,7 @@ def get_dense_travel_times(route_matrix: list[RouteMatrixEntry]):
 
 
 def linspace(a, b, n):
-    return [a + (b - a) / (n - 1) * i for i in range(n)]
+    return a + (b - a) / (n - 1) * np.arange(n)
 
 
 def get_map_dimensions(
@@ -231,10 +685,10 @@ def get_map_dimensions(
     return max_offset_lat, max_offset_lng
 
 
-def make_grid(
+def make_grid_arrays(
     center: Location, zoom: int, size: int = 5, size_pixels: int = 400
-) -> list[list[Location]]:
-    """Make a grid of locations around a center location, for plotting on a map."""
+) -> tuple[np.ndarray, np.ndarray]:
+    """make_grid(), as flat arrays of latitudes and longitudes, row by row."""
 
     # If place markers on the map returned get_static_map() such that you move
     # from the center by STATIC_MAP_SIZE_COEF (adjusted for zoom and Mercator)
@@ -244,17 +698,23 @@ def make_grid(
         center=center, zoom=zoom, size_pixels=size_pixels
     )
 
-    locations = []
     # Reverse the latitude so that the markers go "top to bottom" (north to south)
-    for lat in reversed(
-        linspace(center.lat - map_size_lat / 2, center.lat + map_size_lat / 2, size)
-    ):
-        locations_row = []
-        for lng in linspace(
-            center.lng - map_size_lng / 2, center.lng + map_size_lng / 2, size
-        ):
-            locations_row.append(Location(lat=lat, lng=lng))
+    lats = linspace(center.lat - map_size_lat / 2, center.lat + map_size_lat / 2, size)[
+        ::-1
+    ]
+    lngs = linspace(center.lng - map_size_lng / 2, center.lng + map_size_lng / 2, size)
+    lat, lng = np.meshgrid(lats, lngs, indexing="ij")
+    return lat.ravel(), lng.ravel()
 
-        locations.append(locations_row)
 
-    return locations
+def make_grid(
+    center: Location, zoom: int, size: int = 5, size_pixels: int = 400
+) -> list[list[Location]]:
+    """Make a grid of locations around a center location, for plotting on a map."""
+    lat, lng = make_grid_arrays(center, zoom, size, size_pixels)
+    return [
+        [Location(lat=a, lng=b) for a, b in zip(row_lat, row_lng)]
+        for row_lat, row_lng in zip(
+            lat.reshape(size, size).tolist(), lng.reshape(size, size).tolist()
+        )
+    ]
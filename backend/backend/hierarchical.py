@@ -0,0 +1,268 @@
+"""Build a fine grid on top of an existing, coarser export of the same area.
+
+Making a fine grid from scratch means snapping every location and fetching routes
+between all nearby pairs, and with more locations, more pairs are nearby at the same
+radius. Instead, the travel times of a coarse export are used as long-range
+"highway" estimates, and only short routes between neighboring fine locations are
+fetched:
+
+- Fine locations at the same place as a coarse location reuse its snapping result.
+  That's a quarter of them if the fine grid has twice the resolution, i.e. if
+  (fine size - 1) is a multiple of (coarse size - 1).
+- Each coarse location is a "portal" into the coarse travel times, attached to the
+  fine location at the same place or, if the grids don't line up, the closest one.
+- Travel times between nearby fine locations come from paths of a few short routes.
+  Far apart locations are connected through their nearest portals:
+  time(i, j) = min over portals p of i and q of j of
+  time(i, p) + coarse time(p, q) + time(q, j).
+
+Both steps only need a handful of operations per pair of fine locations, which is
+much less than running an all-pairs shortest path algorithm on the fine grid.
+"""
+
+import numpy as np
+
+from backend import tracing, travel_times
+from backend.defaults import DEFAULT_LOCAL_RADIUS_SPACINGS
+from backend.gmaps import ResolvedLocation, TravelMode
+from backend.grid import Grid
+from backend.location import Location
+from backend.route_matrix import RouteMatrix
+
+# Travel times between fine locations are made of paths of up to this many routes.
+DEFAULT_MAX_HOPS = 16
+# How many of the nearest portals to consider for each fine location.
+DEFAULT_N_PORTALS = 4
+# Raw locations closer than this, in degrees, are considered the same place.
+SAME_PLACE_DEGREES = 1e-9
+
+
+def get_local_radius(
+    grid_size: int, spacings: float = DEFAULT_LOCAL_RADIUS_SPACINGS
+) -> float:
+    """The max_normalized_distance for routes between neighboring fine locations."""
+    # The grid spans [0, 1] in normalized coordinates.
+    return spacings / (grid_size - 1)
+
+
+def check_compatible(
+    coarse: dict,
+    center: Location,
+    zoom: int,
+    size_pixels: int,
+    travel_mode: TravelMode,
+):
+    """Raise a ValueError if the coarse export isn't of the same area and mode.
+
+    Args:
+        coarse: The contents of the coarse export's grid_data.json.
+    """
+    differences = []
+    if Location(**coarse["center"]) != center:
+        differences.append(f"center {coarse['center']} != {center}")
+    if coarse["zoom"] != zoom:
+        differences.append(f"zoom {coarse['zoom']} != {zoom}")
+    # Exports from before size_pixels was stored used 400.
+    if coarse.get("size_pixels", 400) != size_pixels:
+        differences.append(f"size_pixels {coarse.get('size_pixels')} != {size_pixels}")
+    # Exports from before there was a choice were all driving.
+    if coarse.get("travel_mode", str(TravelMode.DRIVE)) != str(travel_mode):
+        differences.append(f"travel_mode {coarse.get('travel_mode')} != {travel_mode}")
+    if differences:
+        raise ValueError(
+            "The coarse export doesn't match the fine grid: " + ", ".join(differences)
+        )
+
+
+def get_location_coordinates(grid_data: dict, kind: str) -> np.ndarray:
+    """The (n, 2) latitudes and longitudes of kind, e.g. "raw_location"."""
+    return np.array(
+        [[x[kind]["lat"], x[kind]["lng"]] for x in grid_data["locations"]],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+
+
+def match_locations(
+    coarse: dict, raw_lat: np.ndarray, raw_lng: np.ndarray
+) -> np.ndarray:
+    """For each coarse location, the fine location at the same place, or -1."""
+    coarse_raw = get_location_coordinates(coarse, "raw_location")
+    delta = np.maximum(
+        np.abs(coarse_raw[:, 0, np.newaxis] - raw_lat[np.newaxis, :]),
+        np.abs(coarse_raw[:, 1, np.newaxis] - raw_lng[np.newaxis, :]),
+    )
+    closest = np.argmin(delta, axis=1)
+    matched = delta[np.arange(len(coarse_raw)), closest] <= SAME_PLACE_DEGREES
+    return np.where(matched, closest, -1)
+
+
+def get_known_snap_results(
+    coarse: dict, matches: np.ndarray
+) -> dict[int, ResolvedLocation | None]:
+    """The snapping results of the coarse locations, by fine location index.
+
+    Coarse locations that weren't snapped, because there's no road nearby or the
+    road was too far away, map to None so that they aren't snapped again either.
+    """
+    results = {}
+    for location, fine_index in zip(coarse["locations"], matches.tolist()):
+        if fine_index < 0:
+            continue
+        if location["snap_result_place_id"] is None:
+            results[fine_index] = None
+        else:
+            results[fine_index] = {
+                "location": Location(**location["snapped_location"]),
+                "place_id": location["snap_result_place_id"],
+                "types": location["snap_result_types"],
+            }
+    return results
+
+
+def get_portals(coarse: dict, grid: Grid, matches: np.ndarray) -> np.ndarray:
+    """For each coarse location, the fine location its travel times are attached to.
+
+    That's the matching fine location if there is one, otherwise the one whose
+    snapped location is closest on the map.
+    """
+    coarse_snapped = get_location_coordinates(coarse, "snapped_location")
+    coarse_coordinates = grid.get_normalized_coordinates(
+        coarse_snapped[:, 0], coarse_snapped[:, 1]
+    )
+    fine_coordinates = grid.get_normalized_coordinates(
+        grid.locations.snapped_lat, grid.locations.snapped_lng
+    )
+    delta = coarse_coordinates[:, np.newaxis, :] - fine_coordinates[np.newaxis, :, :]
+    closest = np.argmin(np.hypot(delta[..., 0], delta[..., 1]), axis=1)
+    return np.where(matches >= 0, matches, closest)
+
+
+def get_coarse_travel_times(coarse: dict) -> np.ndarray:
+    """The coarse travel times as an array, with travel_times.INF if unreachable.
+
+    The stored dense travel times can be smaller than the number of locations if
+    the last locations have no routes, so they're padded.
+    """
+    n_locations = len(coarse["locations"])
+    if "dense_travel_times" in coarse:
+        return travel_times.pad(
+            travel_times.from_nested_list(coarse["dense_travel_times"]), n_locations
+        )
+
+    route_matrix = RouteMatrix.from_entries(coarse["route_matrix"])
+    return travel_times.all_pairs(route_matrix.to_array(n_locations), progress=False)
+
+
+def get_local_travel_times(
+    route_matrix: RouteMatrix, n_locations: int, max_hops: int = DEFAULT_MAX_HOPS
+) -> np.ndarray:
+    """Shortest travel times using paths of at most max_hops routes.
+
+    Each hop relaxes every pair (i, j) through each neighbor k of j at once,
+    like a Bellman-Ford step for all sources. With few routes per location, that's
+    much cheaper than a full all-pairs computation.
+
+    Returns:
+        (n, n) array with travel_times.INF for pairs that aren't connected by a
+        short enough path.
+    """
+    m = route_matrix.to_array(n_locations)
+    has_route = m < travel_times.INF
+    np.fill_diagonal(has_route, False)
+
+    # neighbors[j, s] is the s-th location with a route to j, padded with j itself
+    # and an INF travel time.
+    degrees = has_route.sum(axis=0)
+    max_degree = int(degrees.max(initial=0))
+    neighbors = np.tile(np.arange(n_locations)[:, np.newaxis], (1, max_degree))
+    weights = np.full((n_locations, max_degree), travel_times.INF, dtype=np.int64)
+    sources, targets = np.nonzero(has_route)
+    order = np.argsort(targets, kind="stable")
+    sources, targets = sources[order], targets[order]
+    slots = np.arange(len(targets)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    neighbors[targets, slots] = sources
+    weights[targets, slots] = m[sources, targets]
+
+    # Paths of a single route, each hop below adds one more.
+    dist = m.copy()
+    for _ in range(max_hops - 1):
+        previous = dist.copy()
+        for s in range(max_degree):
+            via = previous[:, neighbors[:, s]] + weights[np.newaxis, :, s]
+            np.minimum(dist, via, out=dist)
+        # Clip so that sums of INF can't overflow in the next hop.
+        np.minimum(dist, travel_times.INF, out=dist)
+        if np.array_equal(dist, previous):
+            break
+
+    return dist
+
+
+def combine_with_coarse(
+    local: np.ndarray,
+    coarse_travel_times: np.ndarray,
+    portals: np.ndarray,
+    n_portals: int = DEFAULT_N_PORTALS,
+) -> np.ndarray:
+    """Combine local fine travel times with the coarse ones.
+
+    Args:
+        local: (n, n) fine travel times, from get_local_travel_times().
+        coarse_travel_times: (c, c) coarse travel times.
+        portals: For each coarse location, the index of its fine location.
+        n_portals: How many of the closest portals to consider for each fine
+            location.
+
+    Returns:
+        (n, n) travel times, the shorter of the local path and the path through
+        the coarse travel times.
+    """
+    n_portals = min(n_portals, len(portals))
+    # The travel times from each fine location to each portal.
+    to_portals = local[:, portals]
+    # nearest[i, a] is the coarse index of the a-th closest portal to i.
+    nearest = np.argsort(to_portals, axis=1, kind="stable")[:, :n_portals]
+    to_nearest = np.take_along_axis(to_portals, nearest, axis=1)
+
+    result = local.copy()
+    for a in range(n_portals):
+        for b in range(n_portals):
+            # Clipped in between, since a sum of three INFs would overflow.
+            to_b = np.minimum(
+                to_nearest[:, a, np.newaxis]
+                + coarse_travel_times[nearest[:, a, np.newaxis], nearest[:, b]],
+                travel_times.INF,
+            )
+            np.minimum(result, to_b + to_nearest[np.newaxis, :, b], out=result)
+
+    np.minimum(result, travel_times.INF, out=result)
+    return result
+
+
+@tracing.traced("dense travel times")
+def get_dense_travel_times(
+    grid: Grid,
+    coarse: dict,
+    max_hops: int = DEFAULT_MAX_HOPS,
+    n_portals: int = DEFAULT_N_PORTALS,
+) -> np.ndarray:
+    """Dense travel times of a fine grid, using the travel times of a coarse one.
+
+    Args:
+        grid: The fine grid, with its local routes in grid.route_matrix.
+        coarse: The contents of the coarse export's grid_data.json.
+        max_hops: See get_local_travel_times().
+        n_portals: See combine_with_coarse().
+
+    Returns:
+        (n, n) array with travel_times.INF if unreachable, like
+        compute_dense_travel_times() in grid.py.
+    """
+    matches = match_locations(coarse, grid.locations.raw_lat, grid.locations.raw_lng)
+    local = get_local_travel_times(grid.route_matrix, len(grid.locations), max_hops)
+    return combine_with_coarse(
+        local,
+        get_coarse_travel_times(coarse),
+        get_portals(coarse, grid, matches),
+        n_portals,
+    )
@@ -0,0 +1,320 @@
+"""A shared HTTP layer for the Google Maps APIs.
+
+All requests go through one requests.Session so that connections are kept alive and
+reused. Each API gets its own rate limiting: a token bucket that keeps the request
+rate under the quota, and an AIMD (additive increase, multiplicative decrease) limit
+on the number of concurrent requests that backs off when the API starts returning
+429s and slowly ramps back up while responses are clean.
+
+requests is only imported when the session is created, so that e.g. planning an
+export doesn't wait for it.
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+import email.utils
+import logging
+import math
+import random
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from backend import tracing
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """Allows on average `rate` units per second, in bursts of up to `capacity`."""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost: float = 1.0):
+        """Block until `cost` tokens are available and take them."""
+        # A request bigger than the bucket would wait forever otherwise.
+        cost = min(cost, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return
+                wait = (cost - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class AimdConcurrencyLimit:
+    def __init__(
+        self,
+        max_limit: int,
+        initial_limit: int | None = None,
+        decrease_factor: float = 0.5,
+        decrease_cooldown_seconds: float = 1.0,
+    ):
+        """Limits the number of requests in flight, adapting to throttling.
+
+        Every clean response raises the limit by 1/limit, so about one per "round" of
+        requests. Every throttled response multiplies it by decrease_factor, but at
+        most once per decrease_cooldown_seconds, since a single overload usually
+        causes several 429s at once.
+        """
+        self.max_limit = max_limit
+        self.limit = float(initial_limit if initial_limit is not None else max_limit)
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+
+        self._in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.decrease_cooldown_seconds:
+                return
+            self._last_decrease = now
+            self.limit = max(1.0, self.limit * self.decrease_factor)
+            logger.info(f"Throttled, reducing concurrency to {int(self.limit)}")
+
+
+@dataclass
+class ClientSettings:
+    # Token bucket, in units of the request cost (e.g. route matrix elements).
+    rate: float
+    burst: float
+    max_concurrency: int
+    max_retries: int = 5
+    base_backoff_seconds: float = 1.0
+    max_backoff_seconds: float = 60.0
+    # Only used to estimate how long a number of requests takes.
+    expected_latency_seconds: float = 1.0
+
+    def estimate_seconds(
+        self, n_requests: int, total_cost: float, max_in_flight: int
+    ) -> float:
+        """Roughly how long sending the requests takes, without retries.
+
+        That's the slower of waiting for the token bucket and of sending the
+        requests in batches of max_in_flight.
+        """
+        concurrency = max(1, min(max_in_flight, self.max_concurrency))
+        rate_limited = max(0.0, total_cost - self.burst) / self.rate
+        latency_limited = (
+            math.ceil(n_requests / concurrency) * self.expected_latency_seconds
+        )
+        return max(rate_limited, latency_limited)
+
+
+# https://developers.google.com/maps/documentation/routes/usage-and-billing#rate-limits
+# Compute Route Matrix is limited to 3000 elements per minute.
+ROUTES_SETTINGS = ClientSettings(
+    rate=3000 / 60, burst=625, max_concurrency=32, expected_latency_seconds=2.0
+)
+GEOCODING_SETTINGS = ClientSettings(
+    rate=50, burst=50, max_concurrency=32, expected_latency_seconds=0.2
+)
+STATIC_MAPS_SETTINGS = ClientSettings(
+    rate=10, burst=10, max_concurrency=4, expected_latency_seconds=0.5
+)
+
+
+class ApiClient:
+    def __init__(
+        self, session: "requests.Session", settings: ClientSettings, name: str = "api"
+    ):
+        """Sends requests to one API, with rate limiting and retries.
+
+        Args:
+            name: Used in the names of the tracing spans and counts.
+        """
+        self.session = session
+        self.settings = settings
+        self.name = name
+        self.bucket = TokenBucket(settings.rate, settings.burst)
+        self.concurrency = AimdConcurrencyLimit(settings.max_concurrency)
+
+        self.n_requests = 0
+        self.n_retries = 0
+        self.n_throttled = 0
+        self._stats_lock = threading.Lock()
+
+    def request(
+        self, method: str, url: str, cost: float = 1.0, **kwargs
+    ) -> "requests.Response":
+        """Send a request, retrying on throttling, server errors and network errors.
+
+        Args:
+            method: The HTTP method.
+            url: The URL.
+            cost: How many tokens of the rate limit the request uses.
+            **kwargs: Passed to requests.Session.request().
+
+        Raises:
+            RuntimeError: If the request was still throttled after all retries.
+        """
+        import requests
+
+        for attempt in range(self.settings.max_retries + 1):
+            with self._stats_lock:
+                self.n_requests += 1
+                self.n_retries += attempt > 0
+            if attempt > 0:
+                tracing.count(f"{self.name} retries")
+
+            with tracing.span(f"{self.name} rate limit wait"):
+                self.bucket.acquire(cost)
+            try:
+                with self.concurrency.slot():
+                    with tracing.span(f"{self.name} request", attempt=attempt):
+                        response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.settings.max_retries:
+                    raise
+                delay = self.get_backoff(attempt)
+                logger.warning(f"{e!r}, retrying in {delay:.1f}s")
+                with tracing.span(f"{self.name} backoff"):
+                    time.sleep(delay)
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                self.concurrency.on_success()
+                return response
+
+            if response.status_code == 429:
+                with self._stats_lock:
+                    self.n_throttled += 1
+                tracing.count(f"{self.name} throttled")
+                self.concurrency.on_throttle()
+            if attempt == self.settings.max_retries:
+                break
+
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = self.get_backoff(attempt)
+            print(f"Got HTTP {response.status_code}, retrying in {delay:.1f}s...")
+            with tracing.span(f"{self.name} backoff", status=response.status_code):
+                time.sleep(delay)
+
+        if response.status_code == 429:
+            raise RuntimeError("Rate limit exceeded")
+        return response
+
+    def get(self, url: str, cost: float = 1.0, **kwargs) -> "requests.Response":
+        return self.request("GET", url, cost=cost, **kwargs)
+
+    def post(self, url: str, cost: float = 1.0, **kwargs) -> "requests.Response":
+        return self.request("POST", url, cost=cost, **kwargs)
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_requests} requests, {self.n_retries} retries, "
+            f"{self.n_throttled} throttled"
+        )
+
+    def get_backoff(self, attempt: int) -> float:
+        """Exponential backoff with jitter, so that threads don't retry in lockstep."""
+        backoff = min(
+            self.settings.max_backoff_seconds,
+            self.settings.base_backoff_seconds * 2**attempt,
+        )
+        return backoff * random.uniform(0.5, 1.0)
+
+
+def get_retry_after(response: "requests.Response") -> float | None:
+    """Parse the Retry-After header, which is either in seconds or an HTTP date."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+_session: "requests.Session | None" = None
+_clients: dict[str, ApiClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_session() -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # The default pool only keeps 10 connections per host, fewer than the number
+        # of concurrent requests we might send.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=64)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def get_client(name: str, settings: ClientSettings) -> ApiClient:
+    """Get the shared client for an API, creating it on first use."""
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = ApiClient(get_session(), settings, name=name)
+        return _clients[name]
+
+
+def summary() -> str:
+    """Request statistics of all the clients used so far."""
+    with _clients_lock:
+        return "; ".join(
+            f"{name}: {client.summary()}" for name, client in _clients.items()
+        )
+
+
+def get_routes_client() -> ApiClient:
+    return get_client("routes", ROUTES_SETTINGS)
+
+
+def get_geocoding_client() -> ApiClient:
+    return get_client("geocoding", GEOCODING_SETTINGS)
+
+
+def get_static_maps_client() -> ApiClient:
+    return get_client("static_maps", STATIC_MAPS_SETTINGS)
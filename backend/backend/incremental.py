@@ -0,0 +1,147 @@
+"""Reuse an existing export when the grid changes only a little.
+
+Growing the grid, nudging the center or panning a bit moves some of the grid
+locations, but many of the new ones are at the same place as old ones or next to
+them. Given an existing export as a seed:
+
+- New locations within a tolerance of an old location are matched to it and reuse
+  its snapping result, so they end up at the same snapped location.
+- Routes between two matched locations are taken from the seed. Only pairs that
+  involve at least one new location are fetched.
+- The seed's dense travel times between matched locations are kept, and only the
+  paths through the new locations are added, see travel_times.add_locations().
+
+The travel times through seed locations that aren't in the new grid are kept too.
+They are real paths, even if the new grid can't represent them.
+
+A matched location whose seed location wasn't snapped stays at its own raw
+location, so its reused routes start up to the tolerance away from it.
+"""
+
+import numpy as np
+
+from backend import hierarchical, tracing, travel_times
+from backend.defaults import DEFAULT_TOLERANCE_SPACINGS
+from backend.gmaps import TravelMode
+from backend.grid import Grid
+from backend.route_matrix import RouteMatrix
+
+
+def check_compatible(seed: dict, travel_mode: TravelMode):
+    """Raise a ValueError if the seed's travel times can't be reused.
+
+    Args:
+        seed: The contents of the seed export's grid_data.json.
+    """
+    # Exports from before there was a choice were all driving.
+    seed_mode = seed.get("travel_mode", str(TravelMode.DRIVE))
+    if seed_mode != str(travel_mode):
+        raise ValueError(
+            f"The seed export is for {seed_mode}, but the grid is for {travel_mode}"
+        )
+
+
+def match_locations(
+    seed: dict, grid: Grid, tolerance_spacings: float = DEFAULT_TOLERANCE_SPACINGS
+) -> np.ndarray:
+    """For each seed location, the grid location it's reused for, or -1.
+
+    Like hierarchical.match_locations(), but with a tolerance, so that
+    hierarchical.get_known_snap_results() can be used on the result.
+
+    Args:
+        seed: The contents of the seed export's grid_data.json.
+        grid: The new grid.
+        tolerance_spacings: How close, in spacings of the new grid, the raw
+            locations need to be to match. Must be less than half a spacing, so
+            that no two grid locations match the same seed location.
+    """
+    if not 0 <= tolerance_spacings < 0.5:
+        raise ValueError(
+            f"The tolerance must be less than half a spacing, got {tolerance_spacings}"
+        )
+
+    seed_raw = hierarchical.get_location_coordinates(seed, "raw_location")
+    seed_coordinates = grid.get_normalized_coordinates(seed_raw[:, 0], seed_raw[:, 1])
+    grid_coordinates = grid.get_normalized_coordinates(
+        grid.locations.raw_lat, grid.locations.raw_lng
+    )
+
+    delta = grid_coordinates[:, np.newaxis, :] - seed_coordinates[np.newaxis, :, :]
+    distances = np.hypot(delta[..., 0], delta[..., 1])
+    closest = np.argmin(distances, axis=1)
+    # The grid spans [0, 1] in normalized coordinates.
+    tolerance = tolerance_spacings / (grid.size - 1)
+    matched = np.flatnonzero(distances[np.arange(len(closest)), closest] <= tolerance)
+
+    matches = np.full(len(seed_raw), -1, dtype=np.int64)
+    matches[closest[matched]] = matched
+    return matches
+
+
+def get_matched_mask(matches: np.ndarray, n_locations: int) -> np.ndarray:
+    """Which grid locations have a seed location."""
+    is_matched = np.zeros(n_locations, dtype=bool)
+    is_matched[matches[matches >= 0]] = True
+    return is_matched
+
+
+def get_pairs_to_fetch(
+    pairs: np.ndarray, matches: np.ndarray, n_locations: int
+) -> np.ndarray:
+    """Leave out the pairs between two matched locations.
+
+    Their routes are reused from the seed if it had them. Otherwise, the seed's
+    travel time between them is used.
+    """
+    is_matched = get_matched_mask(matches, n_locations)
+    return pairs[~(is_matched[pairs[:, 0]] & is_matched[pairs[:, 1]])]
+
+
+def get_routes(seed: dict, matches: np.ndarray) -> RouteMatrix:
+    """The seed's routes between matched locations, with the grid's indices."""
+    route_matrix = RouteMatrix.from_entries(seed["route_matrix"])
+    origins = matches[route_matrix.origin_index]
+    destinations = matches[route_matrix.destination_index]
+    keep = (origins >= 0) & (destinations >= 0)
+    return RouteMatrix(
+        origin_index=origins[keep].astype(np.int32),
+        destination_index=destinations[keep].astype(np.int32),
+        duration_seconds=route_matrix.duration_seconds[keep],
+        distance_meters=route_matrix.distance_meters[keep],
+    )
+
+
+@tracing.traced("dense travel times")
+def get_dense_travel_times(
+    route_matrix: RouteMatrix, n_locations: int, seed: dict, matches: np.ndarray
+) -> np.ndarray:
+    """Dense travel times of the new grid, starting from the seed's.
+
+    Args:
+        route_matrix: All the routes of the new grid, the reused and the fetched
+            ones.
+        n_locations: The number of locations of the new grid.
+        seed: The contents of the seed export's grid_data.json.
+        matches: From match_locations().
+
+    Returns:
+        (n, n) array with travel_times.INF if unreachable, like
+        compute_dense_travel_times() in grid.py.
+    """
+    # Exports can have stored fewer rows if their last locations have no routes.
+    seed_dense = travel_times.pad(
+        travel_times.from_nested_list(seed["dense_travel_times"]),
+        len(seed["locations"]),
+    )
+    seed_indices = np.flatnonzero(matches >= 0)
+    grid_indices = matches[seed_indices]
+
+    dist = np.full((n_locations, n_locations), travel_times.INF, dtype=np.int64)
+    dist[np.ix_(grid_indices, grid_indices)] = seed_dense[
+        np.ix_(seed_indices, seed_indices)
+    ]
+
+    m = route_matrix.to_array(n_locations)
+    new = np.flatnonzero(~get_matched_mask(matches, n_locations))
+    return travel_times.add_locations(dist, m, new)
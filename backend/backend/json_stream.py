@@ -0,0 +1,256 @@
+"""Writing and reading large JSON objects without holding all of them in memory.
+
+grid_data.json is an object whose big fields are arrays: the locations, the route
+matrix and the rows of the dense travel time matrix. The writer takes those arrays as
+iterators and writes them one element at a time, and the reader yields them one
+element at a time, so only a single element (e.g. one row of the dense matrix) needs
+to be in memory at once.
+
+The output is byte-for-byte the same as json.dump() with the default settings.
+"""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import re
+import tempfile
+from typing import IO, Any, Iterable
+
+from backend import tracing
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+# What _Tokenizer._read_value() looks for outside of strings and inside them. Whole
+# strings are skipped at once if they're complete.
+_STRUCTURAL = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|["\[\]{}]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+def _get_umask() -> int:
+    # There's no way to read the umask without setting it, and it's process-wide,
+    # so this mustn't run while other threads might be creating files.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once at import time, since exports write files from several threads.
+_UMASK = _get_umask()
+
+
+@contextmanager
+def atomic_write(path: str | Path, mode: str = "w"):
+    """Open a temporary file that replaces path once it's fully written.
+
+    If anything fails along the way, path is left untouched.
+    """
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        # mkstemp() makes the file private, give it the usual permissions instead.
+        os.chmod(temp_path, 0o666 & ~_UMASK)
+
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def write_object(f: IO[str], fields: dict[str, Any]):
+    """Write a JSON object, streaming the values that are iterators.
+
+    Args:
+        f: The file to write to.
+        fields: The fields of the object. Values that are iterators (e.g.
+            generators) are written as JSON arrays, one element at a time. Other
+            values are serialized with json.dumps().
+    """
+    f.write("{")
+    for i, (key, value) in enumerate(fields.items()):
+        if i > 0:
+            f.write(", ")
+        f.write(json.dumps(key))
+        f.write(": ")
+
+        if isinstance(value, Iterator):
+            f.write("[")
+            for j, item in enumerate(value):
+                if j > 0:
+                    f.write(", ")
+                f.write(json.dumps(item))
+            f.write("]")
+        else:
+            f.write(json.dumps(value))
+    f.write("}")
+
+
+@tracing.traced("write json")
+def write_object_file(path: str | Path, fields: dict[str, Any]):
+    """write_object() to a file, atomically replacing it."""
+    with atomic_write(path) as f:
+        write_object(f, fields)
+
+
+class _Tokenizer:
+    def __init__(self, f: IO[str]):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """Read more data. Returns False if there's nothing more to read."""
+        if self.eof:
+            return False
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Invalid JSON: expected {char!r}, found {found!r}")
+        self.pos += 1
+
+    def _read_value(self):
+        """Read until the string, array or object at self.pos is all in the buffer.
+
+        Only looks for where the value ends, so that a large value is decoded once
+        instead of again after every chunk. Invalid JSON is left to the decoder.
+        """
+        chunks = [self.buffer[self.pos :]]
+        depth = 0
+        in_string = False
+        # Position in the last chunk. Can be past its end after an escape.
+        i = 0
+        while True:
+            pattern = _STRING_SPECIAL if in_string else _STRUCTURAL
+            match = pattern.search(chunks[-1], i)
+            if match is None:
+                chunk = "" if self.eof else self.f.read(CHUNK_SIZE)
+                if not chunk:
+                    self.eof = True
+                    break
+                i = max(0, i - len(chunks[-1]))
+                chunks.append(chunk)
+                continue
+
+            char = match.group()
+            i = match.end()
+            if len(char) > 1:
+                # A complete string.
+                if depth == 0:
+                    break
+            elif char == "\\":
+                # Skip the escaped character, which might be in the next chunk.
+                i += 1
+            elif char == '"':
+                in_string = not in_string
+                if not in_string and depth == 0:
+                    break
+            elif char in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth <= 0:
+                    break
+
+        self.buffer = "".join(chunks)
+        self.pos = 0
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        # Strings, arrays and objects are read whole before decoding them. Numbers
+        # and literals like true are short, so they're just retried with more data.
+        is_scanned = self.peek() in ['"', "[", "{"]
+        if is_scanned:
+            self._read_value()
+
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if is_scanned or not self._fill():
+                    raise
+                continue
+
+            # A number at the end of the buffer might continue in the next chunk.
+            if not is_scanned and end == len(self.buffer) and self._fill():
+                continue
+
+            self.pos = end
+            return value
+
+
+def iter_object(
+    f: IO[str], streamed_keys: Iterable[str] = ()
+) -> Iterator[tuple[str, Any]]:
+    """Read a JSON object one field at a time.
+
+    Args:
+        f: The file to read from.
+        streamed_keys: Fields whose values are arrays that should be read one
+            element at a time. For these, an iterator over the elements is yielded
+            instead of the value. It can only be used until the next field is
+            read, any elements that weren't consumed by then are skipped.
+
+    Yields:
+        (key, value) pairs in the order in which they appear in the file.
+    """
+    streamed_keys = set(streamed_keys)
+    tokens = _Tokenizer(f)
+
+    def iter_array() -> Iterator[Any]:
+        tokens.expect("[")
+        if tokens.peek() == "]":
+            tokens.pos += 1
+            return
+        while True:
+            yield tokens.value()
+            if tokens.peek() == "]":
+                tokens.pos += 1
+                return
+            tokens.expect(",")
+
+    tokens.expect("{")
+    if tokens.peek() == "}":
+        return
+
+    while True:
+        key = tokens.value()
+        tokens.expect(":")
+
+        if key in streamed_keys:
+            items = iter_array()
+            yield key, items
+            # Skip whatever the caller didn't read.
+            for _ in items:
+                pass
+        else:
+            yield key, tokens.value()
+
+        if tokens.peek() == "}":
+            return
+        tokens.expect(",")
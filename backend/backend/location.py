@@ -1,3 +1,4 @@
+import functools
 import math
 
 from pydantic import BaseModel
@@ -62,34 +63,162 @@ def get_mercator_scale_factor(lat: float):
     return 1 / math.cos(deg_to_rad(lat))
 
 
-def spherical_distance(location1: Location, location2: Location) -> float:
+# Earth's mean radius
+EARTH_RADIUS_METERS = 6371.0 * 1000
+
+# How many elements pairwise_spherical_distances() computes at once. Each one needs a
+# few temporaries of the same size.
+DEFAULT_MAX_CHUNK_ELEMENTS = 1 << 20
+
+
+def locations_to_array(locations: list[Location]) -> np.ndarray:
+    """Convert locations to an (n, 2) array of [lat, lng] rows."""
+    return np.array([[x.lat, x.lng] for x in locations], dtype=np.float64).reshape(
+        -1, 2
+    )
+
+
+def _haversine(
+    lat1: np.ndarray, lng1: np.ndarray, lat2: np.ndarray, lng2: np.ndarray
+) -> np.ndarray:
     # https://en.wikipedia.org/wiki/Haversine_formula
-    # Convert latitude and longitude from degrees to radians
-    lat1, lng1, lat2, lng2 = np.radians(
-        [location1.lat, location1.lng, location2.lat, location2.lng]
+    # The arguments are broadcast against each other. The trigonometry of the
+    # latitudes is done before broadcasting, so for an (n, 1) and a (1, m) input,
+    # only the differences are computed n * m times.
+    lat1, lng1, lat2, lng2 = (np.radians(x) for x in [lat1, lng1, lat2, lng2])
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
     )
+    return EARTH_RADIUS_METERS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def spherical_distances(
+    a: np.ndarray, b: np.ndarray, dtype: np.dtype = np.float64
+) -> np.ndarray:
+    """The great-circle distances between pairs of points, in meters.
+
+    Args:
+        a: (..., 2) array of [lat, lng] in degrees, e.g. from locations_to_array().
+        b: Array of the same shape as a, or one that broadcasts to it.
+        dtype: float64, or float32 to use half the memory. float32 is precise to
+            about a meter at the scale of a city.
+
+    Returns:
+        The distance between a[i] and b[i] for each i.
+    """
+    a = np.asarray(a, dtype=dtype)
+    b = np.asarray(b, dtype=dtype)
+    return _haversine(a[..., 0], a[..., 1], b[..., 0], b[..., 1])
+
+
+def pairwise_spherical_distances(
+    a: np.ndarray,
+    b: np.ndarray | None = None,
+    dtype: np.dtype = np.float64,
+    max_chunk_elements: int = DEFAULT_MAX_CHUNK_ELEMENTS,
+) -> np.ndarray:
+    """The great-circle distances between all pairs of points, in meters.
+
+    The matrix is computed a few rows at a time, so besides the result, only
+    max_chunk_elements-sized temporaries are needed.
+
+    Args:
+        a: (n, 2) array of [lat, lng] in degrees.
+        b: (m, 2) array of [lat, lng] in degrees. Defaults to a.
+        dtype: See spherical_distances().
+        max_chunk_elements: How many distances to compute at once.
+
+    Returns:
+        (n, m) array where [i, j] is the distance between a[i] and b[j].
+    """
+    a = np.asarray(a, dtype=dtype).reshape(-1, 2)
+    b = a if b is None else np.asarray(b, dtype=dtype).reshape(-1, 2)
+
+    distances = np.empty((len(a), len(b)), dtype=dtype)
+    rows_per_chunk = max(1, max_chunk_elements // max(1, len(b)))
+    for start in range(0, len(a), rows_per_chunk):
+        rows = a[start : start + rows_per_chunk]
+        distances[start : start + rows_per_chunk] = _haversine(
+            rows[:, 0, None], rows[:, 1, None], b[None, :, 0], b[None, :, 1]
+        )
 
-    # Radius of the Earth in meters
-    radius = 6371.0 * 1000  # Earth's mean radius
+    return distances
 
-    # Haversine formula
-    dlng = lng2 - lng1
-    dlat = lat2 - lat1
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    distance = radius * c
 
-    return distance
+def spherical_distance(location1: Location, location2: Location) -> float:
+    """The great-circle distance between two locations, in meters."""
+    return float(
+        spherical_distances(
+            [location1.lat, location1.lng], [location2.lat, location2.lng]
+        )
+    )
 
 
 class Polyline(BaseModel):
     points: list[Location]
 
+    @functools.cached_property
+    def coordinates(self) -> np.ndarray:
+        """The (n, 2) latitudes and longitudes of the points.
+
+        Computed on first use, so the points shouldn't be modified afterwards.
+        """
+        return locations_to_array(self.points)
+
+    @functools.cached_property
+    def cumulative_lengths(self) -> np.ndarray:
+        """The distance along the polyline from the start to each point, in meters.
+
+        Computed on first use, like coordinates.
+        """
+        coordinates = self.coordinates
+        segment_lengths = spherical_distances(coordinates[:-1], coordinates[1:])
+        return np.concatenate([[0.0], np.cumsum(segment_lengths)])
+
     def total_length(self) -> float:
-        total = 0
-        for i in range(len(self.points) - 1):
-            total += spherical_distance(self.points[i], self.points[i + 1])
-        return total
+        return float(self.cumulative_lengths[-1])
+
+    def sample_fractions(self, fractions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Get the points at the given fractions of the length of the polyline.
+
+        Args:
+            fractions: How far along the polyline, from 0 to 1.
+
+        Returns:
+            Arrays of the latitudes and longitudes of the points, with the same
+            shape as fractions.
+        """
+        fractions = np.asarray(fractions, dtype=np.float64)
+        if np.any((fractions < 0) | (fractions > 1)):
+            raise ValueError("Fractions must be between 0 and 1")
+
+        lat, lng = self.coordinates.T
+        if len(self.points) == 1:
+            return np.full_like(fractions, lat[0]), np.full_like(fractions, lng[0])
+
+        cumulative_lengths = self.cumulative_lengths
+        target_lengths = fractions * cumulative_lengths[-1]
+
+        # The first segment that ends at or after the target.
+        segment = np.searchsorted(cumulative_lengths[1:], target_lengths, side="left")
+        # Rounding can put the target past the last point.
+        past_end = segment == len(self.points) - 1
+        segment = np.minimum(segment, len(self.points) - 2)
+
+        segment_lengths = cumulative_lengths[segment + 1] - cumulative_lengths[segment]
+        remaining_lengths = target_lengths - cumulative_lengths[segment]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction_along_segment = np.where(
+                segment_lengths > 0, remaining_lengths / segment_lengths, 0.0
+            )
+        fraction_along_segment[past_end] = 1.0
+
+        return (
+            lat[segment] + fraction_along_segment * (lat[segment + 1] - lat[segment]),
+            lng[segment] + fraction_along_segment * (lng[segment + 1] - lng[segment]),
+        )
 
     def get_point_at_fraction(self, fraction: float) -> Location:
         """
@@ -97,24 +226,8 @@ class Polyline(BaseModel):
             fraction: How far along the polyline, from 0 to 1
         """
         assert 0 <= fraction <= 1
-        total_length = self.total_length()
-        target_length = fraction * total_length
-        current_length = 0
-        for i in range(len(self.points) - 1):
-            segment_length = spherical_distance(self.points[i], self.points[i + 1])
-            if current_length + segment_length >= target_length:
-                remaining_length = target_length - current_length
-                fraction_along_segment = remaining_length / segment_length
-                return Location(
-                    lat=self.points[i].lat
-                    + fraction_along_segment
-                    * (self.points[i + 1].lat - self.points[i].lat),
-                    lng=self.points[i].lng
-                    + fraction_along_segment
-                    * (self.points[i + 1].lng - self.points[i].lng),
-                )
-            current_length += segment_length
-        return self.points[-1]
+        lat, lng = self.sample_fractions(np.array([fraction]))
+        return Location(lat=lat[0].item(), lng=lng[0].item())
 
     @staticmethod
     def from_route_response(route_response: dict) -> "Polyline":
@@ -0,0 +1,333 @@
+"""Packing of the wanted origin/destination pairs into Routes API requests.
+
+A route matrix request is billed for every origin x destination element, so when only
+some pairs are wanted, the requests should cover them with rectangular blocks that
+contain as few unwanted pairs as possible, while keeping the number of requests low.
+"""
+
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+import heapq
+from itertools import chain
+from typing import NamedTuple
+
+import numpy as np
+
+
+class RequestLimits(NamedTuple):
+    max_elements: int
+    max_origins: int
+    max_destinations: int
+
+
+@dataclass
+class PlannedRequest:
+    origin_indices: list[int]
+    destination_indices: list[int]
+    # The pairs that this request is responsible for, as an (origins, destinations)
+    # boolean array. The other pairs are paid for, but not needed.
+    wanted: np.ndarray
+
+    @property
+    def n_billed_elements(self) -> int:
+        return len(self.origin_indices) * len(self.destination_indices)
+
+    @property
+    def n_wanted_elements(self) -> int:
+        return int(self.wanted.sum())
+
+
+@dataclass
+class RequestPlan:
+    requests: list[PlannedRequest]
+
+    @property
+    def n_requests(self) -> int:
+        return len(self.requests)
+
+    @property
+    def n_billed_elements(self) -> int:
+        return sum(x.n_billed_elements for x in self.requests)
+
+    @property
+    def n_wanted_elements(self) -> int:
+        return sum(x.n_wanted_elements for x in self.requests)
+
+    @property
+    def n_wasted_elements(self) -> int:
+        return self.n_billed_elements - self.n_wanted_elements
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_requests} requests, {self.n_billed_elements} billed elements, "
+            f"{self.n_wasted_elements} of them wasted"
+        )
+
+
+@dataclass
+class _Block:
+    origins: set[int]
+    destinations: set[int]
+    # (origin, destinations) pairs that this block is responsible for.
+    rows: list[tuple[int, list[int]]]
+    n_wanted: int
+
+    @property
+    def n_billed(self) -> int:
+        return len(self.origins) * len(self.destinations)
+
+    @property
+    def n_wasted(self) -> int:
+        return self.n_billed - self.n_wanted
+
+
+def _merge(a: _Block, b: _Block) -> _Block:
+    return _Block(
+        origins=a.origins | b.origins,
+        destinations=a.destinations | b.destinations,
+        rows=a.rows + b.rows,
+        n_wanted=a.n_wanted + b.n_wanted,
+    )
+
+
+def _get_merged_waste(
+    a: _Block,
+    b: _Block,
+    n_destinations: int,
+    limits: RequestLimits,
+    max_waste_fraction: float,
+) -> int | None:
+    """How many elements _merge(a, b) would waste, or None if it doesn't fit.
+
+    Most candidate merges don't fit, so this only counts instead of merging.
+
+    Args:
+        n_destinations: The number of destinations of the merged block.
+    """
+    n_origins = len(a.origins | b.origins)
+    n_billed = n_origins * n_destinations
+    n_wasted = n_billed - a.n_wanted - b.n_wanted
+    if (
+        n_origins > limits.max_origins
+        or n_destinations > limits.max_destinations
+        or n_billed > limits.max_elements
+        or n_wasted > max_waste_fraction * n_billed
+    ):
+        return None
+    return n_wasted
+
+
+def _get_row_blocks(pairs: np.ndarray, limits: RequestLimits) -> list[_Block]:
+    """One block per origin, split up if it has too many destinations.
+
+    Args:
+        pairs: (k, 2) array of unique pairs, sorted by origin and then destination.
+    """
+    max_row_length = min(limits.max_destinations, limits.max_elements)
+
+    row_origins, row_starts = np.unique(pairs[:, 0], return_index=True)
+    rows = np.split(pairs[:, 1], row_starts[1:])
+
+    blocks = []
+    for origin, row in zip(row_origins.tolist(), rows):
+        row = row.tolist()
+        for i in range(0, len(row), max_row_length):
+            chunk = row[i : i + max_row_length]
+            blocks.append(
+                _Block(
+                    origins={origin},
+                    destinations=set(chunk),
+                    rows=[(origin, chunk)],
+                    n_wanted=len(chunk),
+                )
+            )
+    return blocks
+
+
+def _get_max_destinations(limits: RequestLimits, n_origins: int) -> int:
+    return min(limits.max_destinations, limits.max_elements // n_origins)
+
+
+def _get_biclique_blocks(pairs: np.ndarray, limits: RequestLimits) -> list[_Block]:
+    """Blocks without waste for pairs that can be fetched in either orientation.
+
+    Once (i, j) can just as well be fetched as (j, i), the locations that are close
+    to each other form a graph and every block of wanted pairs is a biclique in it:
+    a set of origins that all want every destination of a set of destinations.
+    Repeatedly takes the location with the most pairs left as the first origin and
+    then keeps adding the origin that shares the most of the remaining destinations,
+    for as long as that increases the number of covered pairs.
+    """
+    neighbors: dict[int, set[int]] = defaultdict(set)
+    for i, j in pairs.tolist():
+        neighbors[i].add(j)
+        neighbors[j].add(i)
+
+    blocks = []
+    heap = [(-len(x), i) for i, x in neighbors.items()]
+    heapq.heapify(heap)
+    while heap:
+        negative_degree, seed = heapq.heappop(heap)
+        if not neighbors[seed]:
+            continue
+        if -negative_degree != len(neighbors[seed]):
+            # Outdated, some of its pairs were covered since it was pushed.
+            heapq.heappush(heap, (-len(neighbors[seed]), seed))
+            continue
+
+        origins = [seed]
+        destinations = set(neighbors[seed])
+        n_covered = min(len(destinations), _get_max_destinations(limits, 1))
+        while len(origins) < limits.max_origins:
+            # How many of the destinations each candidate origin wants.
+            n_shared = Counter(chain.from_iterable(neighbors[x] for x in destinations))
+            for x in chain(origins, destinations):
+                n_shared.pop(x, None)
+            if not n_shared:
+                break
+
+            origin, _ = min(n_shared.items(), key=lambda x: (-x[1], x[0]))
+            new_destinations = destinations & neighbors[origin]
+            new_n_covered = (len(origins) + 1) * min(
+                len(new_destinations),
+                _get_max_destinations(limits, len(origins) + 1),
+            )
+            if new_n_covered <= n_covered:
+                break
+            origins.append(origin)
+            destinations = new_destinations
+            n_covered = new_n_covered
+
+        destinations = sorted(destinations)[
+            : _get_max_destinations(limits, len(origins))
+        ]
+        for origin in origins:
+            neighbors[origin].difference_update(destinations)
+        for destination in destinations:
+            neighbors[destination].difference_update(origins)
+
+        blocks.append(
+            _Block(
+                origins=set(origins),
+                destinations=set(destinations),
+                rows=[(x, destinations) for x in origins],
+                n_wanted=len(origins) * len(destinations),
+            )
+        )
+        if neighbors[seed]:
+            heapq.heappush(heap, (-len(neighbors[seed]), seed))
+
+    return blocks
+
+
+def plan_requests(
+    pairs: np.ndarray,
+    limits: RequestLimits,
+    max_waste_fraction: float = 0.0,
+    symmetric: bool = False,
+) -> RequestPlan:
+    """Cover the wanted (origin, destination) pairs with origin x destination blocks.
+
+    Starts with one request per origin (split up if it has too many destinations)
+    and then greedily merges the two requests whose merge wastes the fewest elements,
+    until no more merges fit within the limits. Every merge saves one request. Only
+    requests that share a destination are considered for merging.
+
+    When only one orientation of each pair is wanted, origins rarely want the same
+    destinations, so merges without waste are rare. With symmetric, the starting
+    requests are packed without waste using both orientations instead, see
+    _get_biclique_blocks().
+
+    Args:
+        pairs: (k, 2) array of the wanted (origin index, destination index) pairs.
+        limits: Size limits of a single request.
+        max_waste_fraction: How much of each request can be spent on pairs that are
+            not wanted (or that are also fetched by another request). 0 means that
+            no unwanted pairs are ever paid for.
+        symmetric: Whether a pair can also be fetched as (destination, origin),
+            because routes are treated as symmetric. Then the pairs should only
+            contain one orientation of each pair.
+    """
+    # Also sorts the pairs by origin and then destination.
+    pairs = np.unique(np.asarray(pairs, dtype=np.int64).reshape(-1, 2), axis=0)
+
+    if symmetric:
+        initial_blocks = _get_biclique_blocks(pairs, limits)
+    else:
+        initial_blocks = _get_row_blocks(pairs, limits)
+    blocks: dict[int, _Block] = dict(enumerate(initial_blocks))
+
+    blocks_by_destination: dict[int, set[int]] = defaultdict(set)
+    for block_id, block in blocks.items():
+        for destination in block.destinations:
+            blocks_by_destination[destination].add(block_id)
+
+    heap = []
+
+    def push_merges(block_id: int):
+        block = blocks[block_id]
+        # How many destinations each of the blocks sharing some with this one shares.
+        n_shared = Counter(
+            chain.from_iterable(blocks_by_destination[d] for d in block.destinations)
+        )
+        n_block_destinations = len(block.destinations)
+        for other_id, n_shared_destinations in n_shared.items():
+            if other_id == block_id:
+                continue
+            other = blocks[other_id]
+            n_destinations = (
+                n_block_destinations + len(other.destinations) - n_shared_destinations
+            )
+            # Rules out most candidates, so it's checked before anything else.
+            if n_destinations > limits.max_destinations:
+                continue
+            n_wasted = _get_merged_waste(
+                block, other, n_destinations, limits, max_waste_fraction
+            )
+            if n_wasted is not None:
+                added_waste = n_wasted - block.n_wasted - other.n_wasted
+                heapq.heappush(
+                    heap,
+                    (added_waste, min(block_id, other_id), max(block_id, other_id)),
+                )
+
+    for block_id in list(blocks):
+        push_merges(block_id)
+
+    next_id = len(blocks)
+    while heap:
+        _, a_id, b_id = heapq.heappop(heap)
+        if a_id not in blocks or b_id not in blocks:
+            continue  # One of them was already merged into something else.
+
+        merged = _merge(blocks.pop(a_id), blocks.pop(b_id))
+        for destination in merged.destinations:
+            blocks_by_destination[destination] -= {a_id, b_id}
+            blocks_by_destination[destination].add(next_id)
+        blocks[next_id] = merged
+
+        push_merges(next_id)
+        next_id += 1
+
+    requests = []
+    for block in sorted(blocks.values(), key=lambda x: min(x.origins)):
+        origin_indices = sorted(block.origins)
+        destination_indices = sorted(block.destinations)
+        wanted = np.zeros((len(origin_indices), len(destination_indices)), dtype=bool)
+        origin_position = {x: i for i, x in enumerate(origin_indices)}
+        destination_position = {x: i for i, x in enumerate(destination_indices)}
+        for origin, destinations in block.rows:
+            wanted[
+                origin_position[origin],
+                [destination_position[x] for x in destinations],
+            ] = True
+
+        requests.append(
+            PlannedRequest(
+                origin_indices=origin_indices,
+                destination_indices=destination_indices,
+                wanted=wanted,
+            )
+        )
+
+    return RequestPlan(requests=requests)
@@ -0,0 +1,171 @@
+"""A compact, array-backed representation of a sparse route matrix.
+
+The Routes API returns one dict per origin/destination pair, with the duration as a
+string like "123s". Keeping a list of these around and re-parsing the durations
+whenever they're needed is slow and takes a lot of memory for large grids, so the
+entries are converted into parallel NumPy arrays once, when they're fetched or
+loaded. The dicts are only built again for the JSON output.
+"""
+
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Literal, TypedDict
+
+import numpy as np
+
+from backend import travel_times
+
+# distance_meters for entries without a distanceMeters field. The API leaves it out
+# when the distance is 0.
+MISSING_DISTANCE = -1
+
+
+class RouteMatrixEntry(TypedDict):
+    originIndex: int
+    destinationIndex: int
+    status: dict
+    distanceMeters: int
+    duration: str  # e.g. "123s"
+    condition: Literal["ROUTE_EXISTS"]
+
+
+@dataclass
+class RouteMatrix:
+    origin_index: np.ndarray
+    destination_index: np.ndarray
+    duration_seconds: np.ndarray
+    # MISSING_DISTANCE where the API didn't return a distance.
+    distance_meters: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.origin_index)
+
+    @staticmethod
+    def empty() -> "RouteMatrix":
+        return RouteMatrix(
+            origin_index=np.empty(0, dtype=np.int32),
+            destination_index=np.empty(0, dtype=np.int32),
+            duration_seconds=np.empty(0, dtype=np.int64),
+            distance_meters=np.empty(0, dtype=np.int64),
+        )
+
+    @staticmethod
+    def from_entries(entries: Iterable[dict]) -> "RouteMatrix":
+        """Convert route matrix entries as returned by the Routes API.
+
+        Only entries for which a route exists can be stored. Their status is
+        expected to be empty, which is what to_entries() writes back. The entries
+        can be a generator, they are only iterated over once.
+        """
+        origins, destinations, durations, distances = [], [], [], []
+        for entry in entries:
+            if entry.get("condition") != "ROUTE_EXISTS":
+                raise ValueError(f"Route matrix entry without a route: {entry}")
+
+            origins.append(entry["originIndex"])
+            destinations.append(entry["destinationIndex"])
+            durations.append(travel_times.parse_duration(entry["duration"]))
+            distances.append(entry.get("distanceMeters", MISSING_DISTANCE))
+
+        return RouteMatrix(
+            origin_index=np.array(origins, dtype=np.int32),
+            destination_index=np.array(destinations, dtype=np.int32),
+            duration_seconds=np.array(durations, dtype=np.int64),
+            distance_meters=np.array(distances, dtype=np.int64),
+        )
+
+    def iter_entries(self) -> Iterator[RouteMatrixEntry]:
+        """Convert back to the format returned by the Routes API, one at a time."""
+        for origin, destination, duration, distance in zip(
+            self.origin_index.tolist(),
+            self.destination_index.tolist(),
+            self.duration_seconds.tolist(),
+            self.distance_meters.tolist(),
+        ):
+            entry = {
+                "originIndex": origin,
+                "destinationIndex": destination,
+                "status": {},
+            }
+            if distance != MISSING_DISTANCE:
+                entry["distanceMeters"] = distance
+            entry["duration"] = f"{duration}s"
+            entry["condition"] = "ROUTE_EXISTS"
+            yield entry
+
+    def to_entries(self) -> list[RouteMatrixEntry]:
+        """Convert back to the format returned by the Routes API."""
+        return list(self.iter_entries())
+
+    @staticmethod
+    def concatenate(route_matrices: list["RouteMatrix"]) -> "RouteMatrix":
+        if not route_matrices:
+            return RouteMatrix.empty()
+
+        return RouteMatrix(
+            origin_index=np.concatenate([x.origin_index for x in route_matrices]),
+            destination_index=np.concatenate(
+                [x.destination_index for x in route_matrices]
+            ),
+            duration_seconds=np.concatenate(
+                [x.duration_seconds for x in route_matrices]
+            ),
+            distance_meters=np.concatenate([x.distance_meters for x in route_matrices]),
+        )
+
+    def sorted(self) -> "RouteMatrix":
+        """Sort by origin and then destination index.
+
+        The API returns entries in no particular order, and concurrent requests
+        finish in no particular order either. Sorting makes the output the same no
+        matter where the entries came from.
+        """
+        order = np.lexsort((self.destination_index, self.origin_index))
+        return RouteMatrix(
+            origin_index=self.origin_index[order],
+            destination_index=self.destination_index[order],
+            duration_seconds=self.duration_seconds[order],
+            distance_meters=self.distance_meters[order],
+        )
+
+    def deduplicated(self) -> "RouteMatrix":
+        """Keep only the last entry for each pair of locations.
+
+        Routes are treated as symmetric, so (i, j) and (j, i) count as the same
+        pair. This is the entry that wins in to_array() anyway, but the others would
+        still be written out.
+        """
+        if len(self) == 0:
+            return self
+
+        n_locations = self.get_n_locations()
+        low = np.minimum(self.origin_index, self.destination_index).astype(np.int64)
+        high = np.maximum(self.origin_index, self.destination_index).astype(np.int64)
+        keys = low * n_locations + high
+
+        # np.unique() returns the first occurrence, so search from the end.
+        _, first_from_end = np.unique(keys[::-1], return_index=True)
+        keep = np.sort(len(self) - 1 - first_from_end)
+        return RouteMatrix(
+            origin_index=self.origin_index[keep],
+            destination_index=self.destination_index[keep],
+            duration_seconds=self.duration_seconds[keep],
+            distance_meters=self.distance_meters[keep],
+        )
+
+    def get_n_locations(self) -> int:
+        """The number of locations implied by the largest index."""
+        if len(self) == 0:
+            return 0
+        return int(max(self.origin_index.max(), self.destination_index.max())) + 1
+
+    def to_array(self, n_locations: int | None = None) -> np.ndarray:
+        """An (n, n) array of direct travel times, see travel_times.edges_to_array()."""
+        if n_locations is None:
+            n_locations = self.get_n_locations()
+
+        return travel_times.edges_to_array(
+            self.origin_index,
+            self.destination_index,
+            self.duration_seconds,
+            n_locations,
+        )
@@ -0,0 +1,132 @@
+"""Radius and nearest neighbor queries over 2D points, e.g. grid locations.
+
+The points are put into square buckets whose side is the query radius, so everything
+within the radius of a point is in its own bucket or one of the 8 around it. Finding
+all close pairs then takes O(n * k) time and memory for n points with k neighbors
+each, instead of comparing all n^2 pairs. Nearest neighbors are found the same way,
+with buckets of about k points, widening the search around a bucket until it's
+guaranteed to contain the neighbors of its points.
+"""
+
+from collections import defaultdict
+import math
+
+import numpy as np
+
+
+def get_buckets(points: np.ndarray, bucket_size: float) -> dict[tuple, np.ndarray]:
+    """Group the indices of points by the square bucket they fall into."""
+    cells = np.floor(points / bucket_size).astype(np.int64)
+    buckets = defaultdict(list)
+    for i, cell in enumerate(cells.tolist()):
+        buckets[tuple(cell)].append(i)
+
+    return {cell: np.array(indices) for cell, indices in buckets.items()}
+
+
+def find_close_pairs(points: np.ndarray, radius: float) -> np.ndarray:
+    """Find all pairs of distinct points that are closer than radius to each other.
+
+    Args:
+        points: (n, 2) array of coordinates.
+        radius: The Euclidean distance below which a pair is included.
+
+    Returns:
+        (k, 2) array of index pairs (i, j), sorted by i and then j. Both (i, j) and
+        (j, i) are included.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0 or radius <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    buckets = get_buckets(points, radius)
+
+    found = []
+    for (cx, cy), members in buckets.items():
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                others = buckets.get((cx + dx, cy + dy))
+                if others is None:
+                    continue
+
+                delta = points[members, np.newaxis, :] - points[np.newaxis, others, :]
+                distance = np.hypot(delta[..., 0], delta[..., 1])
+                i, j = np.nonzero(distance < radius)
+                found.append(np.stack([members[i], others[j]], axis=1))
+
+    pairs = np.concatenate(found)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def find_nearest_pairs(points: np.ndarray, n_neighbors: int) -> np.ndarray:
+    """Pair each point with its n_neighbors nearest points.
+
+    Points at the same place as a point, including the point itself, are not its
+    neighbors. Ties are broken in favor of the lower index.
+
+    Args:
+        points: (n, 2) array of coordinates.
+        n_neighbors: How many neighbors to find for each point. A point gets fewer
+            only if there aren't enough points at other places.
+
+    Returns:
+        (k, 2) array of index pairs (i, j), where j is one of the neighbors of i,
+        sorted by i and then j.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    extent = points.max(axis=0, initial=0) - points.min(axis=0, initial=0)
+    if len(points) == 0 or n_neighbors <= 0 or extent.max() == 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # About n_neighbors points per bucket if they're spread evenly, also when
+    # they're all on a line.
+    n = len(points)
+    bucket_size = max(
+        math.sqrt(extent.prod() * n_neighbors / n), extent.max() * n_neighbors / n
+    )
+    buckets = get_buckets(points, bucket_size)
+    # Around any bucket, this many rings of buckets cover all of them.
+    max_rings = math.ceil(extent.max() / bucket_size) + 1
+
+    found = []
+    for (cx, cy), members in buckets.items():
+        n_rings = 1
+        while True:
+            others = [
+                buckets[(cx + dx, cy + dy)]
+                for dx in range(-n_rings, n_rings + 1)
+                for dy in range(-n_rings, n_rings + 1)
+                if (cx + dx, cy + dy) in buckets
+            ]
+            # Sorted, so that the stable sort below prefers lower indices.
+            candidates = np.sort(np.concatenate(others))
+            delta = points[members, np.newaxis, :] - points[np.newaxis, candidates, :]
+            distance = np.hypot(delta[..., 0], delta[..., 1])
+            distance[distance == 0] = np.inf
+
+            k = min(n_neighbors, len(candidates))
+            nearest = np.argsort(distance, axis=1, kind="stable")[:, :k]
+            nearest_distance = np.take_along_axis(distance, nearest, axis=1)
+            # Everything within n_rings * bucket_size of a point is among the
+            # candidates, so no point outside of them can be nearer.
+            if n_rings >= max_rings or (
+                k == n_neighbors
+                and np.all(nearest_distance[:, -1] <= n_rings * bucket_size)
+            ):
+                break
+            n_rings += 1
+
+        is_neighbor = np.isfinite(nearest_distance)
+        found.append(
+            np.stack(
+                [
+                    np.broadcast_to(members[:, np.newaxis], nearest.shape)[is_neighbor],
+                    candidates[nearest][is_neighbor],
+                ],
+                axis=1,
+            )
+        )
+
+    pairs = np.concatenate(found)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
@@ -0,0 +1,514 @@
+"""Precompute the layouts that the frontend's spring mesh settles into.
+
+The frontend (springs.ts, mesh.ts, SpacetimeMap.tsx) turns the travel times into
+springs between the grid points, plus an "anchor" spring pulling each point towards
+its place on the map, and relaxes the mesh in the browser on every frame. This
+module reproduces the same model with NumPy and runs it to equilibrium offline.
+
+The equilibrium only depends on the timeness (how strongly the travel time springs
+pull, from 0 to 1) and, with "focus on hover", on where the pointer is. For each
+focus point, either none or one of the grid points, and each of a few timeness
+levels, the displacement of every grid point from its place on the map is stored.
+The frontend can then interpolate between these instead of simulating.
+
+The result is written in the layout of binary_export.py, with the displacements as
+an (n_focus, n_levels, n_locations, 2) float16 array of normalized x, y offsets.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import json
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+import tqdm.auto as tqdm
+
+from backend import binary_export
+from backend.export import ASSETS_DIR
+from backend.grid import STATIC_MAP_SIZE_COEF
+from backend.location import spherical_distances
+
+MAGIC = b"STMLAYT\0"
+LAYOUTS_FILENAME = "layouts.bin"
+
+# The same as in frontend/src/settings.ts.
+USE_RELATIVE_STRENGTH = False
+SPEED_AVERAGING_TYPE = "median"
+QUADRATIC_PENALTY = False
+STRENGTH_MULTIPLIER = 30.0
+
+# The frontend steps the springs once per frame, at 60 fps.
+DELTA_SECONDS = 1 / 60
+
+# Springs near the focus point are strengthened by up to this factor, see step().
+MAX_FOCUS_COEF = 10
+
+DEFAULT_TIMENESS_LEVELS = [0.25, 0.5, 0.75, 1.0]
+# The most common maxTimeness in frontend/src/cityData.ts.
+DEFAULT_TIMENESS_SCALE = 0.15
+# Stop once no point moves by more than this in one step. In normalized
+# coordinates, so 1e-6 is well below a pixel.
+DEFAULT_TOLERANCE = 1e-6
+DEFAULT_MAX_STEPS = 20000
+
+# Set in each worker process by _init_worker().
+_worker_springs: "Springs | None" = None
+
+
+@dataclass
+class Springs:
+    """The springs of the mesh, as parallel arrays.
+
+    The mesh has 2 * n_locations vertices: the grid points, followed by a pinned
+    copy of each of them that its anchor spring is attached to.
+    """
+
+    from_index: np.ndarray
+    to_index: np.ndarray
+    length: np.ndarray
+    strength: np.ndarray
+    is_anchor: np.ndarray
+    # The positions of the grid points on the map, (n_locations, 2) of x, y.
+    initial_positions: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.from_index)
+
+    @property
+    def n_locations(self) -> int:
+        return len(self.initial_positions)
+
+
+def get_normalized_coordinates(grid_data: dict) -> np.ndarray:
+    """The snapped locations projected onto the map, as in locationToNormalized()."""
+    lat = np.array([x["snapped_location"]["lat"] for x in grid_data["locations"]])
+    lng = np.array([x["snapped_location"]["lng"] for x in grid_data["locations"]])
+    # The frontend assumes 400 for exports from before size_pixels was stored.
+    coef = STATIC_MAP_SIZE_COEF * grid_data.get("size_pixels", 400)
+    max_offset_lat = coef / 2 ** grid_data["zoom"] * np.cos(np.radians(lat))
+    max_offset_lng = coef / 2 ** grid_data["zoom"]
+
+    center = grid_data["center"]
+    x = (lng - center["lng"] + max_offset_lng) / (2 * max_offset_lng)
+    y = (-lat + center["lat"] + max_offset_lat) / (2 * max_offset_lat)
+    return np.stack([x, y], axis=1)
+
+
+def get_routes(grid_data: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The origins, destinations and durations that the frontend makes springs of.
+
+    Like getRouteMatrix() in gridData.ts, the dense travel times are used when they
+    are available. Each pair is only included once.
+    """
+    dense = grid_data.get("dense_travel_times")
+    if dense is not None:
+        durations = np.array(
+            [[0 if x is None else x for x in row] for row in dense], dtype=np.int64
+        ).reshape(len(dense), len(dense))
+        origin, destination = np.nonzero(np.triu(durations, k=1))
+        return origin, destination, durations[origin, destination]
+
+    entries = [
+        x
+        for x in grid_data["route_matrix"]
+        if x.get("condition") == "ROUTE_EXISTS"
+        and x["originIndex"] < x["destinationIndex"]
+    ]
+    origin = np.array([x["originIndex"] for x in entries], dtype=np.int64)
+    destination = np.array([x["destinationIndex"] for x in entries], dtype=np.int64)
+    duration = np.array(
+        [int(x.get("duration", "0s").removesuffix("s")) for x in entries],
+        dtype=np.int64,
+    )
+    keep = duration > 0
+    return origin[keep], destination[keep], duration[keep]
+
+
+def get_springs(grid_data: dict) -> Springs:
+    """Build the springs like routeMatrixToSprings() and SpacetimeMap.tsx do.
+
+    Args:
+        grid_data: The contents of grid_data.json.
+    """
+    positions = get_normalized_coordinates(grid_data)
+    n_locations = len(positions)
+
+    origin, destination, duration = get_routes(grid_data)
+    snapped = np.array(
+        [
+            [x["snapped_location"]["lat"], x["snapped_location"]["lng"]]
+            for x in grid_data["locations"]
+        ]
+    )
+    spherical_distance = spherical_distances(snapped[origin], snapped[destination])
+    # If two locations are snapped to the same point, skip the corresponding spring.
+    keep = spherical_distance > 0
+    origin, destination = origin[keep], destination[keep]
+    duration, spherical_distance = duration[keep], spherical_distance[keep]
+    if len(origin) == 0:
+        raise ValueError("There are no routes to make springs of")
+
+    meters_per_second = spherical_distance / duration
+    normalized_distance = np.hypot(*(positions[origin] - positions[destination]).T)
+    if SPEED_AVERAGING_TYPE == "median":
+        # Not np.median(), which averages the two middle values for an even count.
+        average_speed = np.sort(meters_per_second)[len(meters_per_second) // 2]
+    else:
+        average_speed = meters_per_second.mean()
+
+    anchors = np.arange(n_locations)
+    return Springs(
+        from_index=np.concatenate([anchors, origin]),
+        to_index=np.concatenate([anchors + n_locations, destination]),
+        length=np.concatenate(
+            [
+                np.zeros(n_locations),
+                normalized_distance * average_speed / meters_per_second,
+            ]
+        ),
+        strength=np.concatenate(
+            [
+                np.ones(n_locations),
+                (
+                    STRENGTH_MULTIPLIER / normalized_distance / n_locations
+                    if USE_RELATIVE_STRENGTH
+                    else np.full(len(origin), STRENGTH_MULTIPLIER / n_locations)
+                ),
+            ]
+        ),
+        is_anchor=np.arange(n_locations + len(origin)) < n_locations,
+        initial_positions=positions,
+    )
+
+
+def step(
+    positions: np.ndarray,
+    springs: Springs,
+    timeness: float,
+    timeness_scale: float,
+    focus: np.ndarray | None = None,
+    delta_seconds: float = DELTA_SECONDS,
+) -> tuple[np.ndarray, float]:
+    """Move the grid points by the forces of the springs, like stepSprings().
+
+    Args:
+        positions: (n_locations, 2) positions of the grid points. The pinned
+            vertices are always at springs.initial_positions.
+        springs: The springs, from get_springs().
+        timeness: How strongly the travel time springs pull, from 0 to 1.
+        timeness_scale: The city's maxTimeness, see cityData.ts.
+        focus: The hovered point in normalized coordinates, if any.
+        delta_seconds: The length of the step.
+
+    Returns:
+        The new positions and the loss, the sum of the squared forces.
+    """
+    n_vertices = 2 * len(positions)
+    # Separate x and y arrays are faster to index than (n, 2) ones.
+    x = np.concatenate([positions[:, 0], springs.initial_positions[:, 0]])
+    y = np.concatenate([positions[:, 1], springs.initial_positions[:, 1]])
+    from_x, from_y = x[springs.from_index], y[springs.from_index]
+    to_x, to_y = x[springs.to_index], y[springs.to_index]
+    offset_x, offset_y = to_x - from_x, to_y - from_y
+    distance = np.hypot(offset_x, offset_y)
+
+    force = distance - springs.length
+    if QUADRATIC_PENALTY:
+        force = np.sign(force) * force**2
+    loss = float(np.dot(force, force))
+
+    # As timeness increases, give anchor springs less weight and give more to the
+    # time constraint ones.
+    anchor_weight = 5 + (1.5 - 5) * timeness
+    force *= springs.strength * delta_seconds
+    force *= np.where(springs.is_anchor, anchor_weight, timeness * timeness_scale)
+    if focus is not None:
+        distance_from_focus = np.hypot(
+            (from_x + to_x) / 2 - focus[0], (from_y + to_y) / 2 - focus[1]
+        )
+        force *= np.minimum(MAX_FOCUS_COEF, 1 / (distance_from_focus + 0.01))
+
+    # The force along the spring is split into x and y like with Math.atan2() in
+    # the frontend, which gives an angle of 0 for coinciding vertices.
+    force_per_distance = np.divide(
+        force, distance, out=np.zeros_like(force), where=distance > 0
+    )
+    force_x = offset_x * force_per_distance
+    force_y = offset_y * force_per_distance
+    coinciding = distance == 0
+    force_x[coinciding] = force[coinciding]
+
+    moves = [
+        np.bincount(springs.from_index, f, minlength=n_vertices)
+        - np.bincount(springs.to_index, f, minlength=n_vertices)
+        for f in [force_x, force_y]
+    ]
+    # The pinned vertices don't move.
+    return positions + np.stack(moves, axis=1)[: len(positions)], loss
+
+
+def solve(
+    springs: Springs,
+    timeness: float,
+    timeness_scale: float,
+    focus: np.ndarray | None = None,
+    positions: np.ndarray | None = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    max_steps: int = DEFAULT_MAX_STEPS,
+) -> tuple[np.ndarray, int]:
+    """Step the springs until the grid points stop moving.
+
+    Args:
+        springs: The springs, from get_springs().
+        timeness: See step().
+        timeness_scale: See step().
+        focus: See step().
+        positions: Where to start. Defaults to springs.initial_positions. Starting
+            from a nearby equilibrium converges faster.
+        tolerance: Stop once no coordinate changes by more than this in a step.
+        max_steps: Give up after this many steps.
+
+    Returns:
+        The final positions and the number of steps taken.
+    """
+    if positions is None:
+        positions = springs.initial_positions
+
+    for n_steps in range(1, max_steps + 1):
+        new_positions, _ = step(positions, springs, timeness, timeness_scale, focus)
+        max_move = np.max(np.abs(new_positions - positions))
+        positions = new_positions
+        if not np.isfinite(max_move):
+            raise FloatingPointError("The springs diverged")
+        if max_move <= tolerance:
+            break
+
+    return positions, n_steps
+
+
+def solve_levels(
+    springs: Springs,
+    timeness_levels: list[float],
+    timeness_scale: float,
+    focus: np.ndarray | None = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    max_steps: int = DEFAULT_MAX_STEPS,
+) -> np.ndarray:
+    """The equilibrium positions for each timeness level, as (n_levels, n, 2).
+
+    The levels are solved in increasing order, each starting from the previous
+    equilibrium.
+    """
+    result = np.empty((len(timeness_levels), springs.n_locations, 2))
+    positions = springs.initial_positions
+    for i in np.argsort(timeness_levels):
+        positions, _ = solve(
+            springs,
+            timeness_levels[i],
+            timeness_scale,
+            focus,
+            positions=positions,
+            tolerance=tolerance,
+            max_steps=max_steps,
+        )
+        result[i] = positions
+    return result
+
+
+def _init_worker(springs: Springs):
+    global _worker_springs
+    _worker_springs = springs
+
+
+def _solve_focus_chunk(
+    focus_indices: list[int], solve_kwargs: dict
+) -> list[np.ndarray]:
+    assert _worker_springs is not None, "Worker not initialized"
+    springs = _worker_springs
+    return [
+        solve_levels(
+            springs,
+            focus=None if i < 0 else springs.initial_positions[i],
+            **solve_kwargs,
+        )
+        for i in focus_indices
+    ]
+
+
+def compute_layouts(
+    springs: Springs,
+    timeness_levels: list[float] = DEFAULT_TIMENESS_LEVELS,
+    timeness_scale: float = DEFAULT_TIMENESS_SCALE,
+    focus_indices: list[int] | None = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    max_steps: int = DEFAULT_MAX_STEPS,
+    max_workers: int | None = None,
+    progress: bool = True,
+) -> np.ndarray:
+    """Solve the equilibrium for each focus point and timeness level.
+
+    The focus points are split among a pool of processes.
+
+    Args:
+        springs: The springs, from get_springs().
+        timeness_levels: The timeness levels to solve for.
+        timeness_scale: The city's maxTimeness, see cityData.ts.
+        focus_indices: The grid points to use as the focus point, -1 for no
+            focus. Defaults to no focus and then each of the grid points.
+        tolerance: See solve().
+        max_steps: See solve().
+        max_workers: Number of processes to use. Defaults to the number of CPUs.
+        progress: Whether to show a progress bar.
+
+    Returns:
+        (n_focus, n_levels, n_locations, 2) displacements of the grid points from
+        springs.initial_positions.
+    """
+    if focus_indices is None:
+        focus_indices = [-1] + list(range(springs.n_locations))
+    solve_kwargs = dict(
+        timeness_levels=timeness_levels,
+        timeness_scale=timeness_scale,
+        tolerance=tolerance,
+        max_steps=max_steps,
+    )
+
+    n = len(focus_indices)
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = max(1, math.ceil(n / (max_workers * 4)))
+    chunks = [focus_indices[i : i + chunk_size] for i in range(0, n, chunk_size)]
+
+    result = np.empty((n, len(timeness_levels), springs.n_locations, 2))
+    with tqdm.tqdm(total=n, desc="Solving layouts", disable=not progress) as pbar:
+        if max_workers == 1:
+            _init_worker(springs)
+            chunk_results = (_solve_focus_chunk(x, solve_kwargs) for x in chunks)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(springs,),
+            )
+            chunk_results = executor.map(
+                _solve_focus_chunk, chunks, [solve_kwargs] * len(chunks)
+            )
+
+        try:
+            start = 0
+            for layouts in chunk_results:
+                result[start : start + len(layouts)] = layouts
+                start += len(layouts)
+                pbar.update(len(layouts))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    return result - springs.initial_positions
+
+
+def write(
+    path: str | Path,
+    displacements: np.ndarray,
+    timeness_levels: list[float],
+    timeness_scale: float,
+    focus_indices: list[int],
+    dtype: str = "float16",
+):
+    """Write the output of compute_layouts().
+
+    float16 is precise to about 1e-5 for the typical displacements of a few
+    percent of the map, a small fraction of a pixel.
+    """
+    binary_export.write_arrays(
+        path,
+        {
+            "timeness_levels": list(timeness_levels),
+            "timeness_scale": timeness_scale,
+        },
+        {
+            "focus_index": np.array(focus_indices, dtype=np.int32),
+            "displacements": displacements.astype(dtype),
+        },
+        magic=MAGIC,
+    )
+
+
+def read(path: str | Path) -> tuple[dict, dict[str, np.ndarray]]:
+    """Read a file written by write(), as a header and arrays."""
+    return binary_export.read_arrays(path, magic=MAGIC)
+
+
+def main(
+    input_file: Path,
+    timeness_levels: list[float] = DEFAULT_TIMENESS_LEVELS,
+    timeness_scale: float = DEFAULT_TIMENESS_SCALE,
+    with_focus: bool = True,
+    max_workers: int | None = None,
+):
+    with input_file.open() as f:
+        grid_data = json.load(f)
+
+    springs = get_springs(grid_data)
+    focus_indices = [-1] + (list(range(springs.n_locations)) if with_focus else [])
+    displacements = compute_layouts(
+        springs,
+        timeness_levels=timeness_levels,
+        timeness_scale=timeness_scale,
+        focus_indices=focus_indices,
+        max_workers=max_workers,
+    )
+
+    output_file = input_file.with_name(LAYOUTS_FILENAME)
+    write(output_file, displacements, timeness_levels, timeness_scale, focus_indices)
+    print(
+        f"Wrote {len(focus_indices)} x {len(timeness_levels)} layouts of "
+        f"{len(springs)} springs to {output_file} "
+        f"({output_file.stat().st_size / 1e6:.2f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "input_file",
+        type=Path,
+        help="The grid_data.json file. If it's just a name, it's treated as the name "
+        "of a city in the frontend assets dir.",
+    )
+    parser.add_argument(
+        "--timeness-levels",
+        type=float,
+        nargs="+",
+        default=DEFAULT_TIMENESS_LEVELS,
+        help="The timeness levels to solve for. The frontend can interpolate "
+        "linearly between them, and from the map itself at timeness 0.",
+    )
+    parser.add_argument(
+        "--timeness-scale",
+        type=float,
+        default=DEFAULT_TIMENESS_SCALE,
+        help="The city's maxTimeness in frontend/src/cityData.ts.",
+    )
+    parser.add_argument(
+        "--no-focus",
+        action="store_true",
+        help="Only solve without a focus point, not for hovering over each point.",
+    )
+    parser.add_argument("--max-workers", type=int)
+    args = parser.parse_args()
+
+    input_file = args.input_file
+    if "/" not in str(input_file):
+        input_file = ASSETS_DIR / input_file / "grid_data.json"
+
+    main(
+        input_file,
+        timeness_levels=args.timeness_levels,
+        timeness_scale=args.timeness_scale,
+        with_focus=not args.no_focus,
+        max_workers=args.max_workers,
+    )
@@ -0,0 +1,238 @@
+"""Lightweight tracing of where the time of an export goes.
+
+Code marks its stages with spans and reports counts, e.g. of billed elements:
+
+    with tracing.span("snap to roads"):
+        ...
+    tracing.count("bytes written", n_bytes)
+
+or trace whole functions with the @tracing.traced("name") decorator.
+
+Nothing is recorded unless tracing was enabled with enable(), and then the spans
+can be written as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev)
+and summarized as a table. When disabled, span() returns a shared no-op context
+manager, so instrumenting hot code costs about as much as a function call.
+
+Spans of the same name are aggregated in the summary, so e.g. the "routes request"
+spans, one per HTTP request to the Routes API, give the distribution of its
+latency.
+
+Only the standard library is imported here, since most modules import this one,
+including those that are kept light for a fast start, like http_client.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+import functools
+import json
+import math
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, ContextManager, TypeVar
+
+# Percentiles of the span durations shown in the summary.
+SUMMARY_PERCENTILES = [50, 90, 99]
+
+_NO_SPAN = nullcontext()
+
+F = TypeVar("F", bound=Callable)
+
+
+@dataclass
+class Span:
+    name: str
+    start_ns: int
+    duration_ns: int
+    thread_id: int
+    args: dict
+
+
+class Tracer:
+    def __init__(self):
+        """Records spans and counts. Safe to use from multiple threads."""
+        self.start_ns = time.perf_counter_ns()
+        self.spans: list[Span] = []
+        self.counts: dict[str, float] = defaultdict(float)
+        self._thread_names: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, args: dict):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration_ns = time.perf_counter_ns() - start_ns
+            thread = threading.current_thread()
+            with self._lock:
+                self.spans.append(
+                    Span(name, start_ns, duration_ns, thread.ident or 0, args)
+                )
+                self._thread_names[thread.ident or 0] = thread.name
+
+    def count(self, name: str, value: float):
+        with self._lock:
+            self.counts[name] += value
+
+    def get_span_stats(self) -> dict[str, dict]:
+        """Count, total and percentiles of the duration of the spans of each name."""
+        durations = defaultdict(list)
+        with self._lock:
+            for span in self.spans:
+                durations[span.name].append(span.duration_ns / 1e6)
+
+        stats = {}
+        for name, values in durations.items():
+            values.sort()
+            stats[name] = {
+                "count": len(values),
+                "total_ms": sum(values),
+                **{f"p{p}_ms": get_percentile(values, p) for p in SUMMARY_PERCENTILES},
+                "max_ms": values[-1],
+                "histogram": get_histogram(values),
+            }
+        return stats
+
+    def to_chrome_trace(self) -> dict:
+        """The spans in the Chrome trace event format, with the stats as metadata."""
+        pid = os.getpid()
+        with self._lock:
+            events = [
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start_ns - self.start_ns) / 1e3,
+                    "dur": span.duration_ns / 1e3,
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": span.args,
+                }
+                for span in self.spans
+            ]
+            events += [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": thread_id,
+                    "args": {"name": thread_name},
+                }
+                for thread_id, thread_name in self._thread_names.items()
+            ]
+            counts = dict(self.counts)
+
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"spans": self.get_span_stats(), "counts": counts},
+        }
+
+    def summary(self) -> str:
+        stats = self.get_span_stats()
+        percentiles = "".join(f"{f'p{p}':>10}" for p in SUMMARY_PERCENTILES)
+        lines = [f"{'span':<32} {'count':>7} {'total':>10}{percentiles} {'max':>9}"]
+        # The stages that took the longest first.
+        for name, x in sorted(stats.items(), key=lambda item: -item[1]["total_ms"]):
+            values = "".join(f"{x[f'p{p}_ms']:8.1f}ms" for p in SUMMARY_PERCENTILES)
+            lines.append(
+                f"{name:<32} {x['count']:>7} {x['total_ms'] / 1e3:9.2f}s"
+                f"{values} {x['max_ms']:7.1f}ms"
+            )
+
+        with self._lock:
+            counts = sorted(self.counts.items())
+        for name, value in counts:
+            lines.append(f"{name:<32} {value:>7g}")
+        return "\n".join(lines)
+
+
+def get_percentile(sorted_values: list[float], p: float) -> float:
+    """Like np.percentile(), interpolating linearly between the closest values."""
+    position = (len(sorted_values) - 1) * p / 100
+    low = math.floor(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    fraction = position - low
+    return sorted_values[low] * (1 - fraction) + sorted_values[high] * fraction
+
+
+def get_histogram(values_ms: list[float]) -> dict[str, int]:
+    """How many of the values fall into each power-of-two bucket of milliseconds.
+
+    The keys are the upper bounds of the buckets, e.g. "<=4ms".
+    """
+    histogram = defaultdict(int)
+    for value in values_ms:
+        upper = 2 ** max(0, math.ceil(math.log2(max(value, 1e-9))))
+        histogram[upper] += 1
+    return {f"<={upper}ms": histogram[upper] for upper in sorted(histogram)}
+
+
+_tracer: Tracer | None = None
+
+
+def enable() -> Tracer:
+    """Start recording, discarding anything recorded before."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **args) -> ContextManager:
+    """Record how long the body of a with statement takes, if tracing is enabled.
+
+    Args:
+        name: What's being done. Spans with the same name are aggregated in the
+            summary.
+        **args: Shown with the span in the trace viewer.
+    """
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, args)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator that records each call of a function as a span."""
+
+    def decorator(f: F) -> F:
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return f(*args, **kwargs)
+            with _tracer.span(name, {}):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1):
+    """Add to a count, e.g. of retries or bytes written, if tracing is enabled."""
+    if _tracer is not None:
+        _tracer.count(name, value)
+
+
+def write(path: str | Path):
+    """Write what was recorded as a Chrome trace, see Tracer.to_chrome_trace()."""
+    if _tracer is None:
+        raise RuntimeError("Tracing is not enabled")
+    with Path(path).open("w") as f:
+        json.dump(_tracer.to_chrome_trace(), f)
+
+
+def summary() -> str:
+    if _tracer is None:
+        raise RuntimeError("Tracing is not enabled")
+    return _tracer.summary()
@@ -0,0 +1,9 @@
+from enum import StrEnum
+
+
+# In its own module so that the export CLI can offer the choices without importing
+# gmaps and everything it depends on.
+class TravelMode(StrEnum):
+    DRIVE = "DRIVE"
+    TRANSIT = "TRANSIT"
+    WALK = "WALK"
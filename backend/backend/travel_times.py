@@ -0,0 +1,388 @@
+"""All-pairs shortest travel times, computed from a sparse route matrix.
+
+The route matrix returned by the Routes API only contains travel times between
+nearby points. The rest of the travel times are approximated as shortest paths
+through the graph formed by the known routes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import math
+import os
+from typing import Iterator, Literal
+
+import numpy as np
+
+# Marks pairs of locations with no known route between them. It's half of the int64
+# range so that adding two of them together can't overflow.
+INF = np.iinfo(np.int64).max // 2
+
+# Rough cost of one edge relaxation in Dijkstra (pure Python) relative to the cost of
+# one element of a Floyd-Warshall step (NumPy). Used to pick the faster method.
+DIJKSTRA_COST_RATIO = 8
+
+DenseMethod = Literal["auto", "floyd", "dijkstra"]
+
+
+def parse_duration(duration: str) -> int:
+    """Parse a duration as returned by the Routes API, e.g. "123s" -> 123."""
+    return int(duration[:-1])
+
+
+def get_n_locations(route_matrix: list[dict]) -> int:
+    return max(max(x["originIndex"], x["destinationIndex"]) for x in route_matrix) + 1
+
+
+def route_matrix_to_array(
+    route_matrix: list[dict], n_locations: int | None = None
+) -> np.ndarray:
+    """Convert a route matrix to an (n, n) array of direct travel times.
+
+    See edges_to_array() for details.
+    """
+    if n_locations is None:
+        n_locations = get_n_locations(route_matrix)
+
+    return edges_to_array(
+        np.array([x["originIndex"] for x in route_matrix], dtype=np.int64),
+        np.array([x["destinationIndex"] for x in route_matrix], dtype=np.int64),
+        np.array([parse_duration(x["duration"]) for x in route_matrix], dtype=np.int64),
+        n_locations,
+    )
+
+
+def edges_to_array(
+    origins: np.ndarray,
+    destinations: np.ndarray,
+    durations: np.ndarray,
+    n_locations: int,
+) -> np.ndarray:
+    """Convert routes to an (n, n) array of direct travel times.
+
+    Routes are treated as symmetric. Pairs with no route are set to INF. If a pair
+    appears multiple times, the last entry wins, same as when filling in a list of
+    lists entry by entry.
+    """
+    m = np.full((n_locations, n_locations), INF, dtype=np.int64)
+    np.fill_diagonal(m, 0)
+
+    if len(origins) == 0:
+        return m
+
+    origins = np.asarray(origins, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+    durations = np.asarray(durations, dtype=np.int64)
+
+    # Interleave (origin, destination) and (destination, origin) so that the order
+    # of the writes is the same as in a loop that sets both directions per route.
+    rows = np.stack([origins, destinations], axis=1).ravel()
+    cols = np.stack([destinations, origins], axis=1).ravel()
+    values = np.repeat(durations, 2)
+
+    # NumPy doesn't guarantee which write wins for repeated indices, so only keep
+    # the last write to each cell explicitly.
+    flat_index = rows * n_locations + cols
+    _, last_from_end = np.unique(flat_index[::-1], return_index=True)
+    keep = len(flat_index) - 1 - last_from_end
+    m.flat[flat_index[keep]] = values[keep]
+
+    return m
+
+
+def floyd_warshall(m: np.ndarray, progress: bool = True) -> np.ndarray:
+    """Run the Floyd-Warshall algorithm on an (n, n) array of travel times, in place.
+
+    Each step relaxes all pairs through one intermediate node k at once, as a
+    min-plus update of the whole matrix by column k and row k.
+    """
+    import tqdm.auto as tqdm
+
+    for k in tqdm.trange(len(m), desc="Computing dense matrix", disable=not progress):
+        via_k = m[:, k, np.newaxis] + m[np.newaxis, k, :]
+        np.minimum(m, via_k, out=m)
+
+    return m
+
+
+def to_nested_list(m: np.ndarray) -> list[list[int | None]]:
+    """Convert an array of travel times to a list of lists, with None for INF."""
+    return list(iter_nested_rows(m))
+
+
+def iter_nested_rows(m: np.ndarray) -> Iterator[list[int | None]]:
+    """to_nested_list(), one row at a time."""
+    for row in m:
+        yield [None if x >= INF else x for x in row.tolist()]
+
+
+def to_csr(m: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Convert an array of direct travel times to a sparse adjacency structure.
+
+    Returns:
+        (indptr, indices, weights) in the CSR layout: the neighbors of node i are
+        indices[indptr[i]:indptr[i + 1]], with the travel times in weights.
+        Self-loops and INF entries are left out.
+    """
+    mask = m < INF
+    np.fill_diagonal(mask, False)
+    rows, cols = np.nonzero(mask)
+
+    indptr = np.zeros(len(m) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(m)), out=indptr[1:])
+
+    return indptr, cols, m[rows, cols]
+
+
+# Set in each worker process by _init_dijkstra_worker() so that the graph is only
+# sent to each worker once.
+_worker_graph: tuple[list[int], list[int], list[int], list[int]] | None = None
+
+
+def _init_dijkstra_worker(
+    indptr: list[int], indices: list[int], weights: list[int], self_loops: list[int]
+):
+    global _worker_graph
+    _worker_graph = (indptr, indices, weights, self_loops)
+
+
+def _dijkstra(
+    source: int,
+    indptr: list[int],
+    indices: list[int],
+    weights: list[int],
+    self_loops: list[int],
+) -> list[int]:
+    n = len(indptr) - 1
+    dist = [INF] * n
+    dist[source] = 0
+    heap = [(0, source)]
+
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for e in range(indptr[u], indptr[u + 1]):
+            v = indices[e]
+            nd = d + weights[e]
+            if nd < dist[v]:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+
+    # Floyd-Warshall doesn't force the diagonal to 0: a node with a route to itself
+    # keeps the shorter of that route and the shortest round trip through a neighbor.
+    # Match that so that both methods give the same matrix. The graph is symmetric,
+    # so the way back from neighbor v costs the same as the edge to it.
+    if self_loops[source] != 0:
+        round_trip = min(
+            (
+                dist[indices[e]] + weights[e]
+                for e in range(indptr[source], indptr[source + 1])
+            ),
+            default=INF,
+        )
+        dist[source] = min(self_loops[source], round_trip)
+
+    return dist
+
+
+def _dijkstra_chunk(sources: list[int]) -> list[list[int]]:
+    assert _worker_graph is not None, "Worker not initialized"
+    return [_dijkstra(source, *_worker_graph) for source in sources]
+
+
+def dijkstra_all_pairs(
+    m: np.ndarray, max_workers: int | None = None, progress: bool = True
+) -> np.ndarray:
+    """Compute all-pairs shortest travel times by running Dijkstra from every node.
+
+    Much faster than Floyd-Warshall when each node only has routes to a few
+    neighbors. The origins are split among a pool of processes.
+
+    Args:
+        m: An (n, n) array of direct travel times, with INF where there's no route.
+            The routes are assumed to be symmetric. Not modified.
+        max_workers: Number of processes to use. Defaults to the number of CPUs.
+        progress: Whether to show a progress bar.
+    """
+    import tqdm.auto as tqdm
+
+    indptr, indices, weights = to_csr(m)
+    graph = (indptr.tolist(), indices.tolist(), weights.tolist(), m.diagonal().tolist())
+
+    n = len(m)
+    max_workers = max_workers or os.cpu_count() or 1
+    # Several chunks per worker so that the progress bar moves and the work stays
+    # balanced even if some origins are slower than others.
+    chunk_size = max(1, math.ceil(n / (max_workers * 4)))
+    chunks = [list(range(i, min(i + chunk_size, n))) for i in range(0, n, chunk_size)]
+
+    result = np.empty_like(m)
+    with tqdm.tqdm(
+        total=n, desc="Computing dense matrix", disable=not progress
+    ) as pbar:
+        if max_workers == 1:
+            _init_dijkstra_worker(*graph)
+            chunk_results = map(_dijkstra_chunk, chunks)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_dijkstra_worker,
+                initargs=graph,
+            )
+            chunk_results = executor.map(_dijkstra_chunk, chunks)
+
+        try:
+            for chunk, rows in zip(chunks, chunk_results):
+                result[chunk] = rows
+                pbar.update(len(chunk))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    return result
+
+
+def choose_method(m: np.ndarray, max_workers: int | None = None) -> DenseMethod:
+    """Guess whether Floyd-Warshall or Dijkstra will be faster for this graph."""
+    n = len(m)
+    n_edges = int(np.count_nonzero(m < INF)) - n
+    max_workers = max_workers or os.cpu_count() or 1
+
+    floyd_cost = n**3
+    dijkstra_cost = (
+        DIJKSTRA_COST_RATIO * n * max(n_edges, 1) * math.log2(max(n, 2)) / max_workers
+    )
+    return "dijkstra" if dijkstra_cost < floyd_cost else "floyd"
+
+
+def all_pairs(
+    m: np.ndarray,
+    method: DenseMethod = "auto",
+    max_workers: int | None = None,
+    progress: bool = True,
+) -> np.ndarray:
+    """Compute all-pairs shortest travel times from an array of direct travel times.
+
+    Args:
+        m: An (n, n) array of direct travel times, with INF where there's no route.
+        method: "floyd" for Floyd-Warshall, "dijkstra" for Dijkstra from each node,
+            or "auto" to pick based on the size and sparsity of the graph.
+        max_workers: Number of processes to use for "dijkstra".
+        progress: Whether to show a progress bar.
+    """
+    if method == "auto":
+        method = choose_method(m, max_workers=max_workers)
+
+    if method == "floyd":
+        return floyd_warshall(m.copy(), progress=progress)
+    elif method == "dijkstra":
+        return dijkstra_all_pairs(m, max_workers=max_workers, progress=progress)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+
+def from_nested_list(dense: list[list[int | None]]) -> np.ndarray:
+    """Inverse of to_nested_list()."""
+    return np.array(
+        [[INF if x is None else x for x in row] for row in dense], dtype=np.int64
+    ).reshape(len(dense), len(dense))
+
+
+def pad(m: np.ndarray, n_locations: int) -> np.ndarray:
+    """Extend an array of travel times with unconnected locations."""
+    if n_locations <= len(m):
+        return m
+
+    padded = np.full((n_locations, n_locations), INF, dtype=np.int64)
+    np.fill_diagonal(padded, 0)
+    padded[: len(m), : len(m)] = m
+    return padded
+
+
+def add_shorter_routes(
+    dist: np.ndarray, routes: list[tuple[int, int, int]]
+) -> np.ndarray:
+    """Update all-pairs shortest travel times after routes are added or shortened.
+
+    Takes O(n^2) per route, as opposed to recomputing everything from scratch. Only
+    correct if no route got longer - that can make other shortest paths longer too,
+    and then everything needs to be recomputed.
+
+    Args:
+        dist: An (n, n) array of shortest travel times. Modified in place.
+        routes: (origin, destination, duration) triples. Routes are symmetric.
+    """
+    for a, b, duration in routes:
+        # Paths through the new route can't make use of the diagonal, which might
+        # not be 0 if a location had a route to itself.
+        to_a = dist[:, a].copy()
+        to_a[a] = 0
+        to_b = dist[:, b].copy()
+        to_b[b] = 0
+
+        # dist is symmetric, so the way from b to j costs the same as from j to b.
+        # Clip so that INF + duration + INF can't overflow.
+        to_a_then_b = np.minimum(to_a + duration, INF)
+        via_ab = to_a_then_b[:, np.newaxis] + to_b[np.newaxis, :]
+        np.minimum(dist, via_ab, out=dist)
+        np.minimum(dist, via_ab.T, out=dist)
+
+    # A location with a route to itself keeps the shorter of that route and the
+    # shortest round trip through another location (see _dijkstra()). The round
+    # trip might have gotten shorter too.
+    for i in np.flatnonzero(dist.diagonal()):
+        round_trip = 2 * np.delete(dist[i], i).min(initial=INF)
+        dist[i, i] = min(dist[i, i], round_trip)
+
+    return dist
+
+
+def add_locations(
+    dist: np.ndarray, m: np.ndarray, new: np.ndarray, progress: bool = True
+) -> np.ndarray:
+    """Update all-pairs shortest travel times after locations are added.
+
+    Takes O(n^2) per new location, so when most of the locations are old, it's much
+    faster than recomputing everything from scratch.
+
+    Args:
+        dist: An (n, n) array with the shortest travel times between the old
+            locations, e.g. from pad(). The rows and columns of the new locations
+            are ignored. Modified in place.
+        m: An (n, n) array of direct travel times, with INF where there's no route.
+            Routes between old locations must not be shorter than their travel
+            times in dist.
+        new: The indices of the new locations.
+        progress: Whether to show a progress bar.
+    """
+    n = len(m)
+    is_new = np.zeros(n, dtype=bool)
+    is_new[new] = True
+    dist[is_new, :] = INF
+    dist[:, is_new] = INF
+    np.minimum(dist, m, out=dist)
+
+    # Shortest paths can alternate between runs of old locations, which dist
+    # already has the travel times through, and new locations. First, connect the
+    # new locations to everything through their old neighbors. The second pass
+    # connects pairs of new locations through a run of old ones in between.
+    for _ in range(2):
+        for a in new.tolist():
+            neighbors = np.flatnonzero((m[a] < INF) & ~is_new)
+            via = m[a, neighbors, np.newaxis] + dist[neighbors, :]
+            row = np.minimum(dist[a], via.min(axis=0, initial=INF))
+            np.minimum(row, INF, out=row)
+            dist[a, :] = row
+            dist[:, a] = row
+
+    import tqdm.auto as tqdm
+
+    # Then, Floyd-Warshall steps through the new locations only.
+    for k in tqdm.tqdm(
+        new.tolist(), desc="Computing dense matrix", disable=not progress
+    ):
+        via_k = dist[:, k, np.newaxis] + dist[np.newaxis, k, :]
+        np.minimum(dist, via_k, out=dist)
+
+    return dist
@@ -0,0 +1,103 @@
+import argparse
+from pathlib import Path
+
+from backend import benchmark
+
+DEFAULT_BASELINE_PATH = Path(__file__).parents[1] / "benchmark_baseline.json"
+
+
+def print_result(name: str, size: int, result: dict):
+    print(
+        f"{name} {size}x{size}: {result['seconds'] * 1000:.2f} ms, "
+        f"{result['peak_bytes'] / 1e6:.2f} MB"
+    )
+
+
+def main(
+    sizes: list[int],
+    names: list[str] | None,
+    baseline_path: Path,
+    save_baseline: bool,
+    check: bool,
+    threshold: float,
+    plot_path: Path | None,
+):
+    baseline = None
+    if check:
+        if not baseline_path.exists():
+            print(f"No baseline at {baseline_path}, create one with --save-baseline.")
+            exit(1)
+        baseline = benchmark.load(baseline_path)
+
+    run_results = benchmark.run(sizes=sizes, names=names, on_result=print_result)
+    print()
+    print(benchmark.format_report(run_results))
+
+    if save_baseline:
+        benchmark.save(run_results, baseline_path)
+        print(f"Saved baseline to {baseline_path}")
+
+    if plot_path is not None:
+        benchmark.plot_scaling(run_results, baseline).write_html(plot_path)
+        print(f"Wrote scaling curves to {plot_path}")
+
+    if check:
+        regressions = benchmark.find_regressions(run_results, baseline, threshold)
+        if regressions:
+            print(f"Slower than the baseline by more than {threshold:.0%}:")
+            for name, size, slowdown in regressions:
+                print(f"  {name} {size}x{size}: {slowdown:.2f}x")
+            exit(1)
+        print(f"No regressions compared to {baseline_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths of the export on synthetic grids."
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=benchmark.DEFAULT_SIZES,
+        help="Grid sizes to benchmark.",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=[b.name for b in benchmark.BENCHMARKS],
+        help="Only run these benchmarks.",
+    )
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the baseline for later --check runs.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with an error if any benchmark is slower than the baseline.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="With --check, how much slower than the baseline is still acceptable.",
+    )
+    parser.add_argument(
+        "--plot",
+        type=Path,
+        help="Write a plot of the scaling curves to this HTML file.",
+    )
+    args = parser.parse_args()
+
+    main(
+        sizes=args.sizes,
+        names=args.only,
+        baseline_path=args.baseline,
+        save_baseline=args.save_baseline,
+        check=args.check,
+        threshold=args.threshold,
+        plot_path=args.plot,
+    )
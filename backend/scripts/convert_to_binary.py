@@ -0,0 +1,52 @@
+import argparse
+import json
+from pathlib import Path
+
+from backend import binary_export
+from backend.export import ASSETS_DIR
+
+
+def main(
+    input_files: list[Path], coordinate_dtype: str = "float32", check: bool = True
+):
+    for input_file in input_files:
+        if "/" not in str(input_file):
+            input_file = ASSETS_DIR / input_file / "grid_data.json"
+
+        with input_file.open() as f:
+            json_data = json.load(f)
+
+        output_file = input_file.with_suffix(".bin")
+        binary_export.write(output_file, json_data, coordinate_dtype=coordinate_dtype)
+
+        if check and coordinate_dtype == "float64":
+            if binary_export.read(output_file).to_json() != json_data:
+                raise RuntimeError(f"{output_file} doesn't round-trip to {input_file}")
+
+        print(
+            f"{input_file} ({input_file.stat().st_size / 1e6:.2f} MB) -> "
+            f"{output_file} ({output_file.stat().st_size / 1e6:.2f} MB)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert grid_data.json files to the binary format, "
+        "see backend/binary_export.py."
+    )
+    parser.add_argument(
+        "input_files",
+        type=Path,
+        nargs="+",
+        help="The grid_data.json files to convert. If it's just a name, "
+        "it's treated as the name of a city in the frontend assets dir.",
+    )
+    parser.add_argument(
+        "--coordinate-dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="float64 stores the coordinates exactly, so that the file converts "
+        "back to the same JSON.",
+    )
+    args = parser.parse_args()
+    main(args.input_files, coordinate_dtype=args.coordinate_dtype)
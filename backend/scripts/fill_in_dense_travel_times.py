@@ -1,29 +1,96 @@
 import argparse
 import json
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from backend.export import ASSETS_DIR
-from backend.grid import get_dense_travel_times
 
+# The rest is imported in main(), so that --help doesn't wait for numpy and co.
+if TYPE_CHECKING:
+    from backend.travel_times import DenseMethod
+
+
+def main(
+    input_file: Path,
+    method: "DenseMethod" = "auto",
+    max_workers: int | None = None,
+    add_routes_file: Path | None = None,
+):
+    import numpy as np
+
+    from backend import json_stream, travel_times
+    from backend.grid import compute_dense_travel_times, update_dense_travel_times
+    from backend.route_matrix import RouteMatrix
 
-def main(input_file: Path):
     if "/" not in str(input_file):
         input_file = ASSETS_DIR / input_file
 
+    # Read the file field by field, so that the route matrix and the dense travel
+    # times go straight into arrays without building the lists in between.
+    fields = {}
+    route_matrix = None
+    dense_travel_times = None
     with input_file.open() as f:
-        json_data = json.load(f)
+        for key, value in json_stream.iter_object(
+            f, streamed_keys=["route_matrix", "dense_travel_times"]
+        ):
+            if key == "route_matrix":
+                route_matrix = RouteMatrix.from_entries(value)
+            elif key == "dense_travel_times":
+                for i, row in enumerate(value):
+                    if dense_travel_times is None:
+                        dense_travel_times = np.empty(
+                            (len(row), len(row)), dtype=np.int64
+                        )
+                    dense_travel_times[i] = [
+                        travel_times.INF if x is None else x for x in row
+                    ]
+            fields[key] = value
+
+    if add_routes_file is not None:
+        with add_routes_file.open() as f:
+            new_entries = RouteMatrix.from_entries(
+                [
+                    entry
+                    for entry in json.load(f)
+                    if entry["condition"] == "ROUTE_EXISTS"
+                ]
+            )
 
-    if "dense_travel_times" in json_data:
-        print(f"{input_file} already has dense travel times. Overwrite? [y/N]")
-        if input() != "y":
-            print("Aborting.")
-            exit(1)
+        if dense_travel_times is not None:
+            route_matrix, dense_travel_times = update_dense_travel_times(
+                route_matrix,
+                dense_travel_times,
+                new_entries,
+                method=method,
+                max_workers=max_workers,
+            )
+        else:
+            route_matrix = RouteMatrix.concatenate(
+                [route_matrix, new_entries]
+            ).deduplicated()
+            dense_travel_times = compute_dense_travel_times(
+                route_matrix, method=method, max_workers=max_workers
+            )
 
-    travel_times = get_dense_travel_times(json_data["route_matrix"])
-    json_data["dense_travel_times"] = travel_times
+        print(f"Added {len(new_entries)} route matrix entries.")
+    else:
+        if dense_travel_times is not None:
+            print(f"{input_file} already has dense travel times. Overwrite? [y/N]")
+            if input() != "y":
+                print("Aborting.")
+                exit(1)
 
-    with input_file.open("w") as f:
-        json.dump(json_data, f)
+        dense_travel_times = compute_dense_travel_times(
+            route_matrix, method=method, max_workers=max_workers
+        )
+
+    # The route matrix doesn't know about trailing locations without any routes.
+    dense_travel_times = travel_times.pad(dense_travel_times, len(fields["locations"]))
+
+    fields["route_matrix"] = route_matrix.iter_entries()
+    fields["dense_travel_times"] = travel_times.iter_nested_rows(dense_travel_times)
+    json_stream.write_object_file(input_file, fields)
 
     print(f"OK, written to {input_file}")
 
@@ -36,5 +103,32 @@ if __name__ == "__main__":
         help="The input file. If it's a relative path, "
         "it's treated as relative to the frontend assets dir.",
     )
+    parser.add_argument(
+        "--method",
+        choices=["auto", "floyd", "dijkstra"],
+        default="auto",
+        help="The all-pairs shortest path algorithm. "
+        "Dijkstra is faster for large grids with few routes per point.",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="Number of processes to use with --method dijkstra. "
+        "Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--add-routes",
+        type=Path,
+        default=None,
+        help="A JSON file with a list of route matrix entries to add, replacing "
+        "existing entries for the same pairs. The dense travel times are updated "
+        "incrementally if the routes only get shorter.",
+    )
     args = parser.parse_args()
-    main(args.input_file)
+    main(
+        args.input_file,
+        method=args.method,
+        max_workers=args.max_workers,
+        add_routes_file=args.add_routes,
+    )
@@ -0,0 +1,22 @@
+import pytest
+
+from backend.fake_gmaps_server import FakeGmapsServer, FakeServerSettings
+
+
+@pytest.fixture
+def start_server(monkeypatch):
+    """Start a fake server with the given settings and send all requests to it."""
+    servers = []
+
+    def start(settings: FakeServerSettings | None = None) -> FakeGmapsServer:
+        settings = settings or FakeServerSettings(latency_seconds=0.001)
+        server = FakeGmapsServer(settings).start()
+        servers.append(server)
+        monkeypatch.setenv("GMAPS_ROUTES_BASE_URL", server.url)
+        monkeypatch.setenv("GMAPS_MAPS_BASE_URL", server.url)
+        monkeypatch.setenv("GMAPS_API_KEY", "fake")
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
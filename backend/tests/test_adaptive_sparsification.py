@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from backend import adaptive_sparsification, travel_times
+from backend.benchmark import make_synthetic_grid
+from backend.location import pairwise_spherical_distances
+from backend.route_matrix import MISSING_DISTANCE, RouteMatrix
+
+SPEED_METERS_PER_SECOND = 10.0
+
+
+def get_grid_arrays(size: int) -> tuple[np.ndarray, np.ndarray]:
+    grid = make_synthetic_grid(size)
+    coordinates = grid.get_normalized_coordinates(
+        grid.locations.snapped_lat, grid.locations.snapped_lng
+    )
+    lat_lng = np.stack([grid.locations.snapped_lat, grid.locations.snapped_lng], 1)
+    return coordinates, lat_lng
+
+
+def make_fetch_routes(lat_lng: np.ndarray, fetched: list[np.ndarray]):
+    """Routes with a detour factor that varies smoothly across the map."""
+    distances = pairwise_spherical_distances(lat_lng)
+    detour = 1.2 + 0.5 * np.sin(lat_lng[:, 0] * 3000) ** 2
+
+    def fetch_routes(pairs: np.ndarray) -> RouteMatrix:
+        fetched.append(pairs)
+        i, j = pairs[:, 0], pairs[:, 1]
+        durations = distances[i, j] * (detour[i] + detour[j]) / 2
+        return RouteMatrix(
+            origin_index=i.astype(np.int32),
+            destination_index=j.astype(np.int32),
+            duration_seconds=np.maximum(1, durations / SPEED_METERS_PER_SECOND).astype(
+                np.int64
+            ),
+            distance_meters=np.full(len(pairs), MISSING_DISTANCE, dtype=np.int64),
+        )
+
+    return fetch_routes
+
+
+@pytest.mark.parametrize("n_neighbors", [1, 4, 8])
+def test_spanner_pairs(n_neighbors: int):
+    coordinates, _ = get_grid_arrays(9)
+    # Two locations at the same place are never paired.
+    coordinates[1] = coordinates[0]
+
+    pairs = adaptive_sparsification.get_spanner_pairs(coordinates, n_neighbors)
+
+    assert np.all(pairs[:, 0] < pairs[:, 1])
+    assert len(np.unique(pairs, axis=0)) == len(pairs)
+    assert not any(i == 0 and j == 1 for i, j in pairs.tolist())
+    # Every location is paired with at least its nearest neighbors.
+    degrees = np.bincount(pairs.ravel(), minlength=len(coordinates))
+    assert np.all(degrees >= n_neighbors)
+
+
+def test_select_and_fetch():
+    coordinates, lat_lng = get_grid_arrays(11)
+    n = len(coordinates)
+    fetched = []
+    target_elements = 500
+
+    route_matrix, rounds = adaptive_sparsification.select_and_fetch(
+        coordinates,
+        lat_lng,
+        make_fetch_routes(lat_lng, fetched),
+        target_elements=target_elements,
+        target_error=0.0,
+    )
+
+    fetched = np.concatenate(fetched)
+    assert len(fetched) == len(route_matrix) == sum(x.n_pairs for x in rounds)
+    assert target_elements - len(rounds) <= len(fetched) <= target_elements
+    assert np.all(fetched[:, 0] < fetched[:, 1])
+    assert len(np.unique(fetched, axis=0)) == len(fetched)
+    assert len(rounds) == 1 + adaptive_sparsification.DEFAULT_N_ROUNDS
+
+    # Compared to the travel times from routes between all pairs, the shortest
+    # paths through the fetched routes are a close overestimate, up to rounding.
+    all_pairs = np.argwhere(np.triu(np.ones((n, n), dtype=bool), k=1))
+    exact = travel_times.all_pairs(
+        make_fetch_routes(lat_lng, [])(all_pairs).to_array(n), progress=False
+    )
+    approximated = travel_times.all_pairs(route_matrix.to_array(n), progress=False)
+    off_diagonal = ~np.eye(n, dtype=bool)
+    errors = approximated[off_diagonal] / exact[off_diagonal] - 1
+    assert np.all(errors > -0.05)
+    assert np.percentile(errors, 90) < 0.2
+
+
+def test_select_and_fetch_stops_at_the_target_error():
+    coordinates, lat_lng = get_grid_arrays(11)
+
+    _, rounds = adaptive_sparsification.select_and_fetch(
+        coordinates,
+        lat_lng,
+        make_fetch_routes(lat_lng, []),
+        target_elements=2000,
+        target_error=1.0,
+    )
+
+    assert len(rounds) == 2
+    assert rounds[1].estimated_error <= 1.0
+
+
+def test_too_few_elements_for_the_spanner():
+    coordinates, lat_lng = get_grid_arrays(5)
+
+    with pytest.raises(ValueError):
+        adaptive_sparsification.select_and_fetch(
+            coordinates, lat_lng, make_fetch_routes(lat_lng, []), target_elements=10
+        )
@@ -0,0 +1,80 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from backend import api_cache
+from backend.api_cache import SnapCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A fake time.time() for the cache, advanced by setting clock.now."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(api_cache, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_get_and_put(tmp_path: Path):
+    path = tmp_path / "cache.sqlite"
+    cache = SnapCache(path)
+
+    assert cache.get((1, 2)) is None
+    cache.put_many([((1, 2), {"a": 1}), ((3, 4), {"b": [2]})])
+    assert cache.get((1, 2)) == {"a": 1}
+    assert cache.get((3, 4), count_miss=False) == {"b": [2]}
+    assert cache.get((5, 6), count_miss=False) is None
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache.close()
+
+    # Persisted across instances.
+    cache = SnapCache(path)
+    assert cache.get((3, 4)) == {"b": [2]}
+
+
+def test_expired_entries_are_ignored_and_deleted(tmp_path: Path, clock):
+    path = tmp_path / "cache.sqlite"
+    cache = SnapCache(path, ttl_seconds=100)
+    cache.put_many([((1, 2), {"a": 1})])
+    clock.now += 50
+    cache.put_many([((3, 4), {"b": 2})])
+
+    clock.now += 60
+    assert cache.get((1, 2)) is None
+    assert cache.get((3, 4)) == {"b": 2}
+    cache.close()
+
+    cache = SnapCache(path, ttl_seconds=100)
+    assert cache._n_entries == 1
+
+
+def test_least_recently_used_are_evicted(tmp_path: Path, clock):
+    cache = SnapCache(tmp_path / "cache.sqlite", max_entries=10)
+    for i in range(10):
+        clock.now += 1
+        cache.put_many([((i, 0), {"i": i})])
+    # Reading an entry makes it recently used.
+    clock.now += 1
+    assert cache.get((0, 0)) == {"i": 0}
+    assert cache._n_entries == 10
+
+    clock.now += 1
+    cache.put_many([((10, 0), {"i": 10})])
+
+    # Shrunk to 90% of max_entries, dropping the two least recently used.
+    assert cache._n_entries == int(10 * api_cache.EVICTION_TARGET_FRACTION)
+    kept = [i for i in range(11) if cache.get((i, 0)) is not None]
+    assert kept == [0, 3, 4, 5, 6, 7, 8, 9, 10]
+
+
+def test_running_count_only_overestimates(tmp_path: Path):
+    cache = SnapCache(tmp_path / "cache.sqlite", max_entries=3)
+    # Replacing an entry counts as a new one until the next eviction recounts.
+    cache.put_many([((0, 0), {}), ((1, 0), {}), ((1, 0), {"new": True})])
+    assert cache._n_entries == 3
+
+    cache.put_many([((1, 0), {"newer": True})])
+
+    assert cache._n_entries == 2
+    assert cache.get((0, 0)) == {}
+    assert cache.get((1, 0)) == {"newer": True}
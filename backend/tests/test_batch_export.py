@@ -0,0 +1,100 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from backend import batch_export, export, gmaps
+
+CITIES = [
+    {"name": "a", "center": [50.0755, 14.4378], "zoom": 14, "grid_size": 5},
+    {"name": "b", "center": [47.375, 8.5415], "zoom": 14, "grid_size": 5},
+]
+MAX_NORMALIZED_DISTANCE = 0.3
+
+
+@pytest.fixture
+def manifest_path(tmp_path: Path, monkeypatch) -> Path:
+    monkeypatch.setattr(export, "ASSETS_DIR", tmp_path / "assets")
+    (tmp_path / "assets").mkdir()
+    path = tmp_path / "cities.json"
+    cities = [
+        {**city, "max_normalized_distance": MAX_NORMALIZED_DISTANCE} for city in CITIES
+    ]
+    path.write_text(json.dumps({"cities": cities}))
+    return path
+
+
+def run(manifest_path: Path, max_dollars: float = 100.0):
+    return batch_export.main(manifest_path, max_dollars, parallel=1, use_cache=False)
+
+
+def test_batch_export(manifest_path: Path, start_server):
+    server = start_server()
+
+    results = run(manifest_path)
+
+    assert [x.status for x in results] == ["exported", "exported"]
+    stats = server.get_stats()
+    # Routes and geocoding are both charged.
+    assert stats["geocoding"]["units"] == 2 * 25
+    assert sum(x.dollars for x in results) == pytest.approx(
+        stats["routes"]["units"] * gmaps.DOLLARS_PER_ELEMENT
+        + stats["geocoding"]["units"] * gmaps.DOLLARS_PER_GEOCODING_REQUEST
+    )
+
+    server = start_server()
+    results = run(manifest_path)
+
+    assert [x.status for x in results] == ["skipped", "skipped"]
+    assert server.get_stats() == {}
+
+
+def test_geocoding_counts_towards_the_budget(manifest_path: Path, start_server):
+    server = start_server()
+
+    # Enough for the first city and only some of the snapping of the second one.
+    results = run(manifest_path, max_dollars=0.4)
+
+    assert [x.status for x in results] == ["exported", "over budget"]
+    assert sum(x.dollars for x in results) <= 0.4
+    assert 25 < server.get_stats()["geocoding"]["units"] < 2 * 25
+    assert "geocoding" in results[1].error
+
+
+def test_is_up_to_date_compares_all_params(manifest_path: Path):
+    city = batch_export.read_manifest(manifest_path)[0]
+    output_dir = export.ASSETS_DIR / city.name
+    output_dir.mkdir()
+    assert not batch_export.is_up_to_date(city)
+
+    params_path = output_dir / export.EXPORT_PARAMS_FILENAME
+    params_path.write_text(json.dumps(city.get_params()))
+    assert batch_export.is_up_to_date(city)
+
+    params_path.write_text(
+        json.dumps({**city.get_params(), "max_normalized_distance": 0.12})
+    )
+    assert not batch_export.is_up_to_date(city)
+
+
+@pytest.mark.parametrize("size_pixels", [640, 400])
+def test_is_up_to_date_legacy(manifest_path: Path, size_pixels: int):
+    # Made before there were export params, with the default distance.
+    city = batch_export.read_manifest(manifest_path)[0]
+    city.max_normalized_distance = None
+    output_dir = export.ASSETS_DIR / city.name
+    output_dir.mkdir()
+    grid_data = {
+        "center": city.center.model_dump(),
+        "zoom": city.zoom,
+        "size": city.grid_size,
+        "size_pixels": size_pixels,
+        "locations": [],
+        "route_matrix": [],
+    }
+    (output_dir / "grid_data.json").write_text(json.dumps(grid_data))
+
+    assert batch_export.is_up_to_date(city) == (size_pixels == export.SIZE_PIXELS)
+
+    city.max_normalized_distance = MAX_NORMALIZED_DISTANCE
+    assert not batch_export.is_up_to_date(city)
@@ -0,0 +1,99 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from backend import binary_export, travel_times
+from backend.benchmark import make_synthetic_grid
+from backend.grid import compute_dense_travel_times
+
+
+def get_grid_data(size: int = 7, with_dense: bool = True) -> dict:
+    """The contents of grid_data.json, as read back from the file."""
+    grid = make_synthetic_grid(size)
+    grid_data = json.loads(json.dumps(grid.to_json()))
+    if not with_dense:
+        del grid_data["dense_travel_times"]
+    return grid_data
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+@pytest.mark.parametrize("with_dense", [False, True])
+def test_round_trip(tmp_path: Path, mmap: bool, with_dense: bool):
+    grid_data = get_grid_data(with_dense=with_dense)
+    path = tmp_path / "grid_data.bin"
+
+    binary_export.write(path, grid_data, coordinate_dtype="float64")
+
+    assert binary_export.read(path, mmap=mmap).to_json() == grid_data
+
+
+def test_float32_coordinates(tmp_path: Path):
+    grid_data = get_grid_data()
+    path = tmp_path / "grid_data.bin"
+
+    binary_export.write(path, grid_data)
+    read = binary_export.read(path).to_json()
+
+    for location, read_location in zip(grid_data["locations"], read["locations"]):
+        for kind in ["raw_location", "snapped_location"]:
+            for coordinate in ["lat", "lng"]:
+                assert read_location[kind][coordinate] == pytest.approx(
+                    location[kind][coordinate], abs=1e-5
+                )
+    assert read["route_matrix"] == grid_data["route_matrix"]
+    assert read["dense_travel_times"] == grid_data["dense_travel_times"]
+
+
+def test_large_travel_times(tmp_path: Path):
+    # Too large for uint16, so they're stored as uint32.
+    grid = make_synthetic_grid(9)
+    grid.route_matrix.duration_seconds *= 1000
+    dense = compute_dense_travel_times(
+        grid.route_matrix, progress=False, n_locations=len(grid.locations)
+    )
+    dense[0, -1] = dense[-1, 0] = travel_times.INF
+    grid_data = json.loads(json.dumps(grid.to_json(dense)))
+    path = tmp_path / "grid_data.bin"
+
+    binary_export.write(path, grid_data, coordinate_dtype="float64")
+    read = binary_export.read(path)
+
+    assert read.arrays["dense_travel_times"].dtype == np.uint32
+    assert read.to_json() == grid_data
+    assert read.get_dense_travel_times()[0][-1] is None
+
+
+def test_dense_travel_times_for_fewer_locations(tmp_path: Path):
+    # As before fill_in_dense_travel_times.py, or when seeded from a smaller export.
+    grid_data = get_grid_data()
+    n_locations = len(grid_data["locations"])
+    dense = grid_data["dense_travel_times"]
+    grid_data["dense_travel_times"] = [row[:-2] for row in dense[:-2]]
+    path = tmp_path / "grid_data.bin"
+
+    binary_export.write(path, grid_data, coordinate_dtype="float64")
+    read = binary_export.read(path).get_dense_travel_times()
+
+    assert len(read) == n_locations
+    assert [row[:-2] for row in read[:-2]] == grid_data["dense_travel_times"]
+    assert read[-1] == [None] * (n_locations - 1) + [0]
+
+
+class FailingArray(np.ndarray):
+    def tobytes(self, *args, **kwargs):
+        raise OSError("No space left on device")
+
+
+def test_failed_write_keeps_the_old_file(tmp_path: Path):
+    path = tmp_path / "grid_data.bin"
+    path.write_bytes(b"old")
+    arrays = {"a": np.arange(3), "b": np.arange(3).view(FailingArray)}
+
+    with pytest.raises(OSError):
+        binary_export.write_arrays(path, {}, arrays)
+
+    assert path.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["grid_data.bin"]
@@ -0,0 +1,116 @@
+from pathlib import Path
+
+import numpy as np
+
+from backend import http_client
+from backend.export_journal import ExportJournal
+from backend.fake_gmaps_server import FakeGmapsServer, FakeServerSettings
+from backend.gmaps import Budget
+from backend.grid import Grid
+from backend.location import Location
+
+CENTER = Location(lat=50.0755, lng=14.4378)
+PARAMS = {"center": [CENTER.lat, CENTER.lng], "zoom": 13, "grid_size": 7}
+MAX_NORMALIZED_DISTANCE = 0.25
+
+
+def run_export(journal: ExportJournal) -> Grid:
+    grid = Grid(CENTER, zoom=13, size=7, journal=journal)
+    grid.compute_sparsified_distance_matrix(
+        max_normalized_distance=MAX_NORMALIZED_DISTANCE,
+        journal=journal,
+        budget=Budget(),
+    )
+    return grid
+
+
+def get_count(server: FakeGmapsServer, endpoint: str, key: str) -> int:
+    return int(server.get_stats().get(endpoint, {}).get(key, 0))
+
+
+def interrupt(path: Path, n_records: int):
+    """Keep the first n_records records, as if the export died while writing more."""
+    lines = path.read_bytes().splitlines(keepends=True)
+    path.write_bytes(b"".join(lines[:n_records]) + lines[n_records][:20])
+
+
+def test_resume(tmp_path: Path, start_server):
+    start_server()
+    path = tmp_path / "export_journal.jsonl"
+    journal = ExportJournal(path, PARAMS)
+    complete = run_export(journal)
+    journal.close()
+    n_locations = len(complete.locations)
+    n_pairs = len(complete.route_matrix)
+
+    # The params, all but the last few snapping results and nothing else.
+    interrupt(path, n_records=n_locations - 5)
+    server = start_server()
+    journal = ExportJournal(path, PARAMS, resume=True)
+    assert len(journal.snap_results) == n_locations - 6
+    resumed = run_export(journal)
+    journal.close()
+
+    assert get_count(server, "geocoding", "requests") == 6
+    assert get_count(server, "routes", "units") == n_pairs
+    np.testing.assert_array_equal(
+        resumed.locations.snapped_lat, complete.locations.snapped_lat
+    )
+    np.testing.assert_array_equal(
+        resumed.route_matrix.to_array(n_locations),
+        complete.route_matrix.to_array(n_locations),
+    )
+
+    # All the snapping results and some of the route matrix entries.
+    n_records = len(path.read_bytes().splitlines())
+    interrupt(path, n_records=n_records - 3)
+    server = start_server()
+    journal = ExportJournal(path, PARAMS, resume=True)
+    n_replayed = len(
+        {
+            tuple(sorted([x["originIndex"], x["destinationIndex"]]))
+            for x in journal.route_entries
+        }
+    )
+    assert 0 < n_replayed < n_pairs
+    resumed = run_export(journal)
+    journal.close()
+
+    assert get_count(server, "geocoding", "requests") == 0
+    assert get_count(server, "routes", "units") == n_pairs - n_replayed
+    assert len(resumed.route_matrix) == n_pairs
+    np.testing.assert_array_equal(
+        resumed.route_matrix.to_array(n_locations),
+        complete.route_matrix.to_array(n_locations),
+    )
+
+
+def test_only_definitive_snap_failures_are_journaled(
+    tmp_path: Path, start_server, monkeypatch
+):
+    # Fail right away instead of retrying.
+    monkeypatch.setattr(http_client.GEOCODING_SETTINGS, "max_retries", 0)
+    path = tmp_path / "export_journal.jsonl"
+    settings = FakeServerSettings(
+        latency_seconds=0.001, error_rate=0.3, zero_results_rate=0.2, seed=1
+    )
+    server = start_server(settings)
+    journal = ExportJournal(path, PARAMS)
+    Grid(CENTER, zoom=13, size=7, journal=journal)
+    journal.close()
+
+    n_errors = get_count(server, "geocoding", "errors")
+    assert n_errors > 0
+    assert len(journal.snap_results) == 49 - n_errors
+    n_no_road = sum(x is None for x in journal.snap_results.values())
+    assert n_no_road > 0
+
+    server = start_server()
+    journal = ExportJournal(path, PARAMS, resume=True)
+    Grid(CENTER, zoom=13, size=7, journal=journal)
+    journal.close()
+
+    # Only the transient failures are retried.
+    assert get_count(server, "geocoding", "requests") == n_errors
+    assert len(journal.snap_results) == 49
+    assert sum(x is None for x in journal.snap_results.values()) == n_no_road
@@ -0,0 +1,70 @@
+import functools
+from pathlib import Path
+import time
+
+import pytest
+
+from backend import api_cache, gmaps
+from backend.api_cache import RouteCache
+from backend.location import Location
+from backend.travel_mode import TravelMode
+
+
+def sleep_and_return(seconds: float, items: list[int]) -> list[int]:
+    time.sleep(seconds)
+    return items
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_fetch_concurrently_ordered(max_in_flight: int):
+    # The first jobs take the longest, so they finish last.
+    jobs = [
+        functools.partial(sleep_and_return, 0.02 * (5 - i), [2 * i, 2 * i + 1])
+        for i in range(5)
+    ]
+
+    results = gmaps.fetch_concurrently(jobs, max_in_flight=max_in_flight)
+
+    assert list(results) == list(range(10))
+
+
+def test_fetch_concurrently_unordered():
+    jobs = [functools.partial(sleep_and_return, 0.05 * (3 - i), [i]) for i in range(3)]
+
+    results = gmaps.fetch_concurrently(jobs, max_in_flight=3, ordered=False)
+
+    assert list(results) == [2, 1, 0]
+
+
+def test_route_matrix_entries_only_fetch_missing_pairs(tmp_path: Path, start_server):
+    server = start_server()
+    cache = RouteCache(tmp_path / "cache.sqlite")
+    locations = [Location(lat=50.0 + 0.01 * i, lng=14.4) for i in range(3)]
+    routing_preference = gmaps.get_routing_preference(TravelMode.DRIVE)
+    # Each origin and each destination has a pair missing, but most are cached.
+    cached_pairs = [(0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1)]
+    cache.put_many(
+        [
+            (
+                api_cache.make_route_key(
+                    locations[i], locations[j], TravelMode.DRIVE, routing_preference
+                ),
+                {"duration": "123s", "condition": "ROUTE_EXISTS"},
+            )
+            for i, j in cached_pairs
+        ]
+    )
+    budget = gmaps.Budget()
+
+    entries = gmaps.get_route_matrix_entries(
+        locations, locations, cache=cache, budget=budget
+    )
+
+    assert server.get_stats()["routes"]["units"] == 3
+    assert budget.spent_dollars == pytest.approx(3 * gmaps.DOLLARS_PER_ELEMENT)
+    assert sorted((x["originIndex"], x["destinationIndex"]) for x in entries) == [
+        (i, j) for i in range(3) for j in range(3)
+    ]
+    for entry in entries:
+        is_cached = (entry["originIndex"], entry["destinationIndex"]) in cached_pairs
+        assert (entry["duration"] == "123s") == is_cached
@@ -0,0 +1,10 @@
+from backend.benchmark import make_synthetic_grid
+
+
+def test_grid_locations_to_json_is_like_the_models():
+    locations = make_synthetic_grid(5).locations
+    locations.snap_result_types[3] = None
+    locations.snap_result_place_id[3] = None
+
+    assert locations.to_json() == [x.model_dump(mode="json") for x in locations]
+    assert locations[3].snapped_location.lat == locations.snapped_lat[3]
@@ -0,0 +1,50 @@
+import numpy as np
+
+from backend import hierarchical, travel_times
+from backend.grid import compute_dense_travel_times
+from backend.route_matrix import MISSING_DISTANCE, RouteMatrix
+
+INF = travel_times.INF
+
+
+def make_route_matrix(routes: list[tuple[int, int, int]]) -> RouteMatrix:
+    origins, destinations, durations = zip(*routes)
+    return RouteMatrix(
+        origin_index=np.array(origins, dtype=np.int32),
+        destination_index=np.array(destinations, dtype=np.int32),
+        duration_seconds=np.array(durations, dtype=np.int64),
+        distance_meters=np.full(len(routes), MISSING_DISTANCE, dtype=np.int64),
+    )
+
+
+def test_local_travel_times_are_hop_limited():
+    route_matrix = make_route_matrix([(0, 1, 10), (1, 2, 10), (2, 3, 10)])
+
+    local = hierarchical.get_local_travel_times(route_matrix, 5, max_hops=2)
+
+    np.testing.assert_array_equal(local[0], [0, 10, 20, INF, INF])
+    np.testing.assert_array_equal(local[:, 2], [20, 10, 0, 10, INF])
+    np.testing.assert_array_equal(
+        hierarchical.get_local_travel_times(route_matrix, 5, max_hops=10),
+        compute_dense_travel_times(route_matrix, progress=False, n_locations=5),
+    )
+
+
+def test_combine_with_coarse():
+    # A chain 0-1-2-3 where the local paths are single routes, and two isolated
+    # locations that can't reach anything.
+    route_matrix = make_route_matrix([(0, 1, 10), (1, 2, 10), (2, 3, 10)])
+    local = route_matrix.to_array(6)
+    coarse = np.array([[0, 30], [30, 0]], dtype=np.int64)
+
+    combined = hierarchical.combine_with_coarse(local, coarse, portals=np.array([0, 3]))
+
+    assert np.all(combined >= 0)
+    np.testing.assert_array_equal(np.diag(combined), 0)
+    # Through the portals at 0 and 3.
+    assert combined[0, 3] == combined[3, 0] == 30
+    assert combined[1, 3] == 40
+    assert combined[1, 2] == 10
+    np.testing.assert_array_equal(combined[4:, :4], INF)
+    np.testing.assert_array_equal(combined[:4, 4:], INF)
+    np.testing.assert_array_equal(combined[4:, 4:], [[0, INF], [INF, 0]])
@@ -0,0 +1,173 @@
+import email.utils
+import subprocess
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from backend import http_client
+from backend.fake_gmaps_server import FakeServerSettings
+from backend.http_client import (
+    AimdConcurrencyLimit,
+    ApiClient,
+    ClientSettings,
+    TokenBucket,
+)
+
+SETTINGS = ClientSettings(
+    rate=1000, burst=1000, max_concurrency=4, max_retries=3, base_backoff_seconds=0.1
+)
+
+
+class ScriptedSession:
+    """Returns the given responses in order, or raises them if they're exceptions."""
+
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.n_requests = 0
+
+    def request(self, method: str, url: str, **kwargs):
+        self.n_requests += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_response(status_code: int, retry_after: str | None = None):
+    headers = {} if retry_after is None else {"Retry-After": retry_after}
+    return SimpleNamespace(status_code=status_code, headers=headers)
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list[float]:
+    """Record the sleeps of http_client instead of sleeping."""
+    sleeps = []
+    monkeypatch.setattr(
+        http_client,
+        "time",
+        SimpleNamespace(monotonic=time.monotonic, time=time.time, sleep=sleeps.append),
+    )
+    return sleeps
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(rate=100, capacity=10)
+
+    start = time.monotonic()
+    bucket.acquire(10)
+    assert time.monotonic() - start < 0.02
+
+    # Empty now, so this waits for 5 tokens at 100 per second.
+    bucket.acquire(5)
+    assert time.monotonic() - start == pytest.approx(0.05, abs=0.02)
+
+    # More than the capacity only waits for a full bucket.
+    bucket.acquire(1000)
+    assert time.monotonic() - start == pytest.approx(0.15, abs=0.03)
+
+
+def test_aimd_decreases_on_throttling_and_increases_on_success():
+    limit = AimdConcurrencyLimit(max_limit=8, decrease_cooldown_seconds=60)
+
+    limit.on_throttle()
+    assert limit.limit == 4
+    # Within the cooldown, further 429s belong to the same overload.
+    limit.on_throttle()
+    assert limit.limit == 4
+
+    for _ in range(4):
+        limit.on_success()
+    assert 4.9 < limit.limit < 5
+
+    for _ in range(100):
+        limit.on_success()
+    assert limit.limit == 8
+
+
+def test_aimd_limits_requests_in_flight():
+    limit = AimdConcurrencyLimit(max_limit=2)
+    entered = threading.Event()
+
+    def third_request():
+        with limit.slot():
+            entered.set()
+
+    with limit.slot(), limit.slot():
+        thread = threading.Thread(target=third_request)
+        thread.start()
+        assert not entered.wait(0.05)
+    assert entered.wait(1)
+    thread.join()
+
+
+def test_get_retry_after():
+    retry_at = email.utils.formatdate(time.time() + 30, usegmt=True)
+
+    assert http_client.get_retry_after(make_response(429, "2.5")) == 2.5
+    assert http_client.get_retry_after(make_response(429, retry_at)) == pytest.approx(
+        30, abs=2
+    )
+    assert http_client.get_retry_after(make_response(429, "soon")) is None
+    assert http_client.get_retry_after(make_response(429)) is None
+
+
+def test_request_retries(sleeps: list[float]):
+    session = ScriptedSession(
+        [
+            make_response(429, retry_after="3"),
+            make_response(503),
+            requests.ConnectionError(),
+            make_response(200),
+        ]
+    )
+    client = ApiClient(session, SETTINGS)
+
+    response = client.get("http://example.com")
+
+    assert response.status_code == 200
+    assert (client.n_requests, client.n_retries, client.n_throttled) == (4, 3, 1)
+    # Retry-After is respected, otherwise it's an exponential backoff with jitter.
+    assert sleeps[0] == 3
+    assert 0.1 <= sleeps[1] <= 0.2
+    assert 0.2 <= sleeps[2] <= 0.4
+
+
+def test_request_gives_up_when_throttled(sleeps: list[float]):
+    session = ScriptedSession([make_response(429)] * 4)
+    client = ApiClient(session, SETTINGS)
+
+    with pytest.raises(RuntimeError):
+        client.get("http://example.com")
+
+    assert session.n_requests == SETTINGS.max_retries + 1
+    assert client.concurrency.limit < SETTINGS.max_concurrency
+
+
+def test_request_against_fake_server(start_server):
+    server = start_server(
+        FakeServerSettings(latency_seconds=0.001, throttle_rate=0.3, seed=0)
+    )
+    settings = ClientSettings(
+        rate=1000, burst=1000, max_concurrency=4, base_backoff_seconds=0.001
+    )
+    client = ApiClient(requests.Session(), settings)
+
+    for _ in range(20):
+        response = client.get(f"{server.url}/maps/api/geocode/json?latlng=50,14")
+        assert response.status_code == 200
+
+    stats = server.get_stats()["geocoding"]
+    assert client.n_throttled == stats["throttled"] > 0
+    assert client.n_requests == stats["requests"]
+
+
+def test_import_does_not_load_numpy():
+    # Keeps the CLI fast to start, see export.py.
+    code = "import backend.http_client, sys; print('numpy' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+
+    assert output.strip() == "False"
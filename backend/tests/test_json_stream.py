@@ -0,0 +1,119 @@
+import io
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from backend import json_stream
+from backend.benchmark import make_synthetic_grid
+
+FIELDS = {
+    "name": "test",
+    "size": 3,
+    "nested": {"a": [1, 2.5, None], "b": 'é"\\'},
+    "empty": [],
+    "rows": [[1, None, 3], [], [-4.25e-10, 123456789012345]],
+}
+
+
+def write_to_string(fields: dict) -> str:
+    f = io.StringIO()
+    json_stream.write_object(f, fields)
+    return f.getvalue()
+
+
+def test_write_object_is_like_json_dumps():
+    streamed = {k: iter(v) if isinstance(v, list) else v for k, v in FIELDS.items()}
+
+    assert write_to_string(streamed) == json.dumps(FIELDS)
+    assert write_to_string({}) == json.dumps({})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1 << 16])
+def test_iter_object_round_trip(monkeypatch, chunk_size: int):
+    # Small chunks split values, including numbers, across reads.
+    monkeypatch.setattr(json_stream, "CHUNK_SIZE", chunk_size)
+    text = json.dumps(FIELDS, indent=2)
+
+    read = {}
+    for key, value in json_stream.iter_object(io.StringIO(text), ["rows", "empty"]):
+        read[key] = list(value) if key in ["rows", "empty"] else value
+
+    assert read == FIELDS
+
+
+def test_iter_object_skips_unread_elements(monkeypatch):
+    monkeypatch.setattr(json_stream, "CHUNK_SIZE", 5)
+    text = json.dumps(FIELDS)
+
+    read = {}
+    for key, value in json_stream.iter_object(io.StringIO(text), ["rows"]):
+        read[key] = next(value) if key == "rows" else value
+
+    assert read == {**FIELDS, "rows": FIELDS["rows"][0]}
+
+
+class CountingDecoder(json.JSONDecoder):
+    def __init__(self):
+        super().__init__()
+        self.n_calls = 0
+
+    def raw_decode(self, s: str, idx: int = 0):
+        self.n_calls += 1
+        return super().raw_decode(s, idx)
+
+
+def test_large_values_are_decoded_once(monkeypatch):
+    monkeypatch.setattr(json_stream, "CHUNK_SIZE", 64)
+    decoder = CountingDecoder()
+    monkeypatch.setattr(json_stream, "_decoder", decoder)
+    fields = {
+        "locations": [{"lat": i / 7, "name": f'"{i}\\'} for i in range(1000)],
+        "size": 1000,
+    }
+
+    read = dict(json_stream.iter_object(io.StringIO(json.dumps(fields))))
+
+    assert read == fields
+    # The keys and the values, and a retry for the number at the end.
+    assert decoder.n_calls <= 5
+
+
+def test_iter_object_rejects_invalid_json():
+    with pytest.raises(ValueError):
+        list(json_stream.iter_object(io.StringIO('{"a": 1 "b": 2}')))
+    with pytest.raises(ValueError):
+        list(json_stream.iter_object(io.StringIO('{"a": [1, {"b": "]"}')))
+
+
+def test_grid_json_round_trip(tmp_path: Path):
+    grid = make_synthetic_grid(7)
+    path = tmp_path / "grid_data.json"
+
+    grid.write_json(path)
+
+    with path.open() as f:
+        assert dict(json_stream.iter_object(f)) == json.loads(
+            json.dumps(grid.to_json())
+        )
+
+
+def test_atomic_write(tmp_path: Path):
+    path = tmp_path / "data.json"
+    path.write_text("old")
+
+    with pytest.raises(RuntimeError):
+        with json_stream.atomic_write(path) as f:
+            f.write("partial")
+            raise RuntimeError("Interrupted")
+
+    assert path.read_text() == "old"
+    assert os.listdir(tmp_path) == ["data.json"]
+
+    with json_stream.atomic_write(path) as f:
+        f.write("new")
+
+    assert path.read_text() == "new"
+    assert os.listdir(tmp_path) == ["data.json"]
+    assert path.stat().st_mode & 0o777 == 0o666 & ~json_stream._UMASK
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from backend import request_planner
+from backend.benchmark import MAX_NORMALIZED_DISTANCE, make_synthetic_grid
+from backend.request_planner import RequestLimits, RequestPlan
+
+DRIVE_LIMITS = RequestLimits(max_elements=625, max_origins=25, max_destinations=25)
+TRANSIT_LIMITS = RequestLimits(max_elements=100, max_origins=25, max_destinations=25)
+
+
+def get_grid_pairs(size: int) -> np.ndarray:
+    pairs = make_synthetic_grid(size).get_close_pairs(MAX_NORMALIZED_DISTANCE)
+    return pairs[pairs[:, 0] < pairs[:, 1]]
+
+
+def get_random_pairs(n_locations: int, n_pairs: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, n_locations, size=(n_pairs, 2))
+    pairs = np.sort(pairs, axis=1)
+    return np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+
+
+def check_plan(
+    plan: RequestPlan,
+    pairs: np.ndarray,
+    limits: RequestLimits,
+    max_waste_fraction: float,
+    symmetric: bool,
+):
+    """Every pair is fetched exactly once and every request is within the limits."""
+    fetched = []
+    for request in plan.requests:
+        assert len(request.origin_indices) <= limits.max_origins
+        assert len(request.destination_indices) <= limits.max_destinations
+        assert request.n_billed_elements <= limits.max_elements
+        assert request.wanted.shape == (
+            len(request.origin_indices),
+            len(request.destination_indices),
+        )
+        n_wasted = request.n_billed_elements - request.n_wanted_elements
+        assert n_wasted <= max_waste_fraction * request.n_billed_elements
+
+        for i, j in zip(*np.nonzero(request.wanted)):
+            pair = (request.origin_indices[i], request.destination_indices[j])
+            fetched.append(tuple(sorted(pair)) if symmetric else pair)
+
+    expected = [tuple(x) for x in pairs.tolist()]
+    assert sorted(fetched) == sorted(expected)
+    assert plan.n_wanted_elements == len(expected)
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+@pytest.mark.parametrize("max_waste_fraction", [0.0, 0.2, 0.5])
+@pytest.mark.parametrize("limits", [DRIVE_LIMITS, TRANSIT_LIMITS])
+def test_grid_pairs(symmetric: bool, max_waste_fraction: float, limits):
+    pairs = get_grid_pairs(15)
+
+    plan = request_planner.plan_requests(
+        pairs, limits, max_waste_fraction, symmetric=symmetric
+    )
+
+    check_plan(plan, pairs, limits, max_waste_fraction, symmetric)
+    if max_waste_fraction == 0:
+        assert plan.n_wasted_elements == 0
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("symmetric", [False, True])
+@pytest.mark.parametrize("max_waste_fraction", [0.0, 0.3])
+def test_random_pairs(seed: int, symmetric: bool, max_waste_fraction: float):
+    # Dense enough that some origins have more destinations than fit in a request.
+    pairs = get_random_pairs(60, 1500, seed)
+
+    plan = request_planner.plan_requests(
+        pairs, DRIVE_LIMITS, max_waste_fraction, symmetric=symmetric
+    )
+
+    check_plan(plan, pairs, DRIVE_LIMITS, max_waste_fraction, symmetric)
+
+
+def test_duplicate_pairs_are_fetched_once():
+    pairs = np.array([[0, 1], [0, 1], [0, 2], [1, 2], [0, 2]])
+
+    plan = request_planner.plan_requests(pairs, DRIVE_LIMITS)
+
+    check_plan(plan, np.unique(pairs, axis=0), DRIVE_LIMITS, 0.0, symmetric=False)
+
+
+def test_symmetric_needs_fewer_requests():
+    pairs = get_grid_pairs(19)
+
+    one_orientation = request_planner.plan_requests(pairs, DRIVE_LIMITS)
+    symmetric = request_planner.plan_requests(pairs, DRIVE_LIMITS, symmetric=True)
+
+    assert symmetric.n_billed_elements == one_orientation.n_billed_elements
+    assert symmetric.n_requests < one_orientation.n_requests
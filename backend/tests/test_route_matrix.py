@@ -0,0 +1,42 @@
+import numpy as np
+
+from backend.route_matrix import RouteMatrix
+
+
+def make_route_matrix(routes: list[tuple[int, int, int]]) -> RouteMatrix:
+    origins, destinations, durations = zip(*routes)
+    return RouteMatrix(
+        origin_index=np.array(origins, dtype=np.int32),
+        destination_index=np.array(destinations, dtype=np.int32),
+        duration_seconds=np.array(durations, dtype=np.int64),
+        distance_meters=np.array(durations, dtype=np.int64) * 10,
+    )
+
+
+def test_entries_round_trip():
+    route_matrix = make_route_matrix([(0, 1, 10), (1, 2, 20), (3, 0, 5)])
+
+    converted = RouteMatrix.from_entries(route_matrix.to_entries())
+
+    assert converted.to_entries() == route_matrix.to_entries()
+
+
+def test_deduplicated_keeps_the_last_entry():
+    route_matrix = RouteMatrix.concatenate(
+        [
+            make_route_matrix([(0, 1, 10), (1, 2, 20), (2, 3, 30)]),
+            make_route_matrix([(2, 1, 15), (0, 1, 12), (0, 1, 11)]),
+        ]
+    )
+
+    deduplicated = route_matrix.deduplicated()
+
+    assert [
+        (x["originIndex"], x["destinationIndex"], x["duration"])
+        for x in deduplicated.to_entries()
+    ] == [(2, 3, "30s"), (2, 1, "15s"), (0, 1, "11s")]
+    np.testing.assert_array_equal(deduplicated.to_array(), route_matrix.to_array())
+
+
+def test_deduplicated_empty():
+    assert len(RouteMatrix.empty().deduplicated()) == 0
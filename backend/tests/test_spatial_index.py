@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from backend import spatial_index
+from backend.benchmark import make_synthetic_grid
+
+
+def find_close_pairs_brute_force(points: np.ndarray, radius: float) -> np.ndarray:
+    delta = points[:, np.newaxis, :] - points[np.newaxis, :, :]
+    distance = np.hypot(delta[..., 0], delta[..., 1])
+    close = distance < radius
+    np.fill_diagonal(close, False)
+    return np.argwhere(close)
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("radius", [0.01, 0.05, 0.2, 2.0])
+def test_find_close_pairs(seed: int, radius: float):
+    points = np.random.default_rng(seed).uniform(0, 1, size=(300, 2))
+
+    pairs = spatial_index.find_close_pairs(points, radius)
+
+    # np.argwhere() is sorted by i and then j too.
+    np.testing.assert_array_equal(pairs, find_close_pairs_brute_force(points, radius))
+
+
+def test_find_close_pairs_on_bucket_boundaries():
+    # A regular grid puts many points exactly on the bucket boundaries, and many
+    # pairs exactly at the radius, which are not close.
+    x, y = np.meshgrid(np.linspace(0, 1, 11), np.linspace(0, 1, 11))
+    points = np.stack([x.ravel(), y.ravel()], axis=1)
+
+    for radius in [0.1, 0.1 + 1e-9, 0.25]:
+        np.testing.assert_array_equal(
+            spatial_index.find_close_pairs(points, radius),
+            find_close_pairs_brute_force(points, radius),
+        )
+
+
+def test_find_close_pairs_empty():
+    assert spatial_index.find_close_pairs(np.empty((0, 2)), 0.1).shape == (0, 2)
+    assert spatial_index.find_close_pairs(np.zeros((3, 2)), 0).shape == (0, 2)
+
+
+@pytest.mark.parametrize("max_normalized_distance", [0.05, 0.12, 0.3])
+def test_grid_close_pairs(max_normalized_distance: float):
+    grid = make_synthetic_grid(9)
+    # Two locations that snapped to the same place don't need a route.
+    grid.locations.snapped_lat[1] = grid.locations.snapped_lat[0]
+    grid.locations.snapped_lng[1] = grid.locations.snapped_lng[0]
+    coordinates = grid.get_normalized_coordinates(
+        grid.locations.snapped_lat, grid.locations.snapped_lng
+    )
+
+    pairs = grid.get_close_pairs(max_normalized_distance)
+
+    expected = find_close_pairs_brute_force(coordinates, max_normalized_distance)
+    same_place = np.all(
+        coordinates[expected[:, 0]] == coordinates[expected[:, 1]], axis=1
+    )
+    np.testing.assert_array_equal(pairs, expected[~same_place])
+    assert not any((i, j) in {(0, 1), (1, 0)} for i, j in pairs.tolist())
+
+
+def find_nearest_pairs_brute_force(points: np.ndarray, n_neighbors: int) -> np.ndarray:
+    delta = points[:, np.newaxis, :] - points[np.newaxis, :, :]
+    distance = np.hypot(delta[..., 0], delta[..., 1])
+    distance[distance == 0] = np.inf
+    nearest = np.argsort(distance, axis=1, kind="stable")[:, :n_neighbors]
+    pairs = [
+        (i, j)
+        for i, row in enumerate(nearest.tolist())
+        for j in row
+        if np.isfinite(distance[i, j])
+    ]
+    return np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("n_neighbors", [1, 4, 7])
+def test_find_nearest_pairs(seed: int, n_neighbors: int):
+    rng = np.random.default_rng(seed)
+    # Clustered, with some points at the same place and a far away outlier.
+    points = np.concatenate(
+        [
+            rng.normal(0, 0.05, size=(150, 2)),
+            np.round(rng.uniform(0, 1, size=(100, 2)) * 4) / 4,
+            [[10, 10]],
+        ]
+    )
+
+    np.testing.assert_array_equal(
+        spatial_index.find_nearest_pairs(points, n_neighbors),
+        find_nearest_pairs_brute_force(points, n_neighbors),
+    )
+
+
+def test_find_nearest_pairs_on_a_grid():
+    # Many ties, which go to the lower index.
+    x, y = np.meshgrid(np.linspace(0, 1, 11), np.linspace(0, 1, 11))
+    points = np.stack([x.ravel(), y.ravel()], axis=1)
+
+    for n_neighbors in [4, 5, 8]:
+        np.testing.assert_array_equal(
+            spatial_index.find_nearest_pairs(points, n_neighbors),
+            find_nearest_pairs_brute_force(points, n_neighbors),
+        )
+
+
+def test_find_nearest_pairs_edge_cases():
+    assert spatial_index.find_nearest_pairs(np.empty((0, 2)), 3).shape == (0, 2)
+    assert spatial_index.find_nearest_pairs(np.zeros((3, 2)), 3).shape == (0, 2)
+    # On a line, and with fewer points than neighbors.
+    points = np.array([[0, 0], [0, 1], [0, 3]])
+    np.testing.assert_array_equal(
+        spatial_index.find_nearest_pairs(points, 5),
+        [[0, 1], [0, 2], [1, 0], [1, 2], [2, 0], [2, 1]],
+    )
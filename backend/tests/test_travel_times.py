@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+
+from backend import travel_times
+from backend.grid import (
+    compute_dense_travel_times,
+    get_dense_travel_times,
+    get_dense_travel_times_reference,
+    update_dense_travel_times,
+)
+from backend.route_matrix import MISSING_DISTANCE, RouteMatrix
+
+
+def make_random_route_matrix(
+    n_locations: int, n_routes: int, seed: int, max_duration: int = 1000
+) -> RouteMatrix:
+    """Routes between random pairs of locations, which may leave some unreachable."""
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, n_locations, size=(n_routes, 2))
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return RouteMatrix(
+        origin_index=pairs[:, 0].astype(np.int32),
+        destination_index=pairs[:, 1].astype(np.int32),
+        duration_seconds=rng.integers(1, max_duration, len(pairs)),
+        distance_meters=np.full(len(pairs), MISSING_DISTANCE, dtype=np.int64),
+    ).deduplicated()
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("n_locations,n_routes", [(4, 8), (10, 8), (25, 60)])
+def test_floyd_agrees_with_reference(seed: int, n_locations: int, n_routes: int):
+    route_matrix = make_random_route_matrix(n_locations, n_routes, seed)
+    n_locations = route_matrix.get_n_locations()
+
+    floyd = travel_times.all_pairs(
+        route_matrix.to_array(), method="floyd", progress=False
+    )
+    reference = get_dense_travel_times_reference(route_matrix.to_entries())
+
+    assert travel_times.to_nested_list(floyd) == reference
+    assert floyd.shape == (n_locations, n_locations)
+
+
+def test_unreachable_is_none():
+    route_matrix = RouteMatrix.from_entries(
+        [
+            {
+                "originIndex": 0,
+                "destinationIndex": 1,
+                "duration": "10s",
+                "condition": "ROUTE_EXISTS",
+            },
+            {
+                "originIndex": 2,
+                "destinationIndex": 3,
+                "duration": "5s",
+                "condition": "ROUTE_EXISTS",
+            },
+        ]
+    )
+
+    dense = get_dense_travel_times(route_matrix, progress=False)
+
+    assert dense[0][1] == dense[1][0] == 10
+    assert dense[0][2] is None
+    assert dense[3][1] is None
+
+
+def test_dense_travel_times_accepts_entries():
+    route_matrix = make_random_route_matrix(12, 30, seed=0)
+
+    assert get_dense_travel_times(
+        route_matrix.to_entries(), progress=False
+    ) == get_dense_travel_times(route_matrix, progress=False)
+
+
+def test_dense_travel_times_size():
+    # The last location has no routes, but it still gets a row and a column.
+    route_matrix = make_random_route_matrix(10, 20, seed=0)
+    n_locations = route_matrix.get_n_locations() + 1
+
+    dense = compute_dense_travel_times(
+        route_matrix, progress=False, n_locations=n_locations
+    )
+
+    assert dense.shape == (n_locations, n_locations)
+    assert dense[-1, -1] == 0
+    assert np.all(dense[-1, :-1] == travel_times.INF)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_dijkstra_agrees_with_floyd(seed: int, max_workers: int):
+    m = make_random_route_matrix(40, 100, seed).to_array()
+
+    floyd = travel_times.all_pairs(m, method="floyd", progress=False)
+    dijkstra = travel_times.all_pairs(
+        m, method="dijkstra", max_workers=max_workers, progress=False
+    )
+
+    np.testing.assert_array_equal(dijkstra, floyd)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_add_locations(seed: int):
+    n_locations = 30
+    rng = np.random.default_rng(seed)
+    m = make_random_route_matrix(n_locations, 90, seed).to_array(n_locations)
+    new = np.sort(rng.choice(n_locations, size=5, replace=False))
+
+    # The travel times before the new locations had any routes.
+    m_old = m.copy()
+    m_old[new, :] = travel_times.INF
+    m_old[:, new] = travel_times.INF
+    np.fill_diagonal(m_old, 0)
+    dist = travel_times.all_pairs(m_old, method="floyd", progress=False)
+
+    updated = travel_times.add_locations(dist, m, new, progress=False)
+
+    expected = travel_times.all_pairs(m, method="floyd", progress=False)
+    np.testing.assert_array_equal(updated, expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("longer", [False, True])
+def test_update_dense_travel_times(seed: int, longer: bool):
+    rng = np.random.default_rng(seed)
+    route_matrix = make_random_route_matrix(20, 40, seed)
+    n_locations = route_matrix.get_n_locations()
+    dense = compute_dense_travel_times(
+        route_matrix, progress=False, n_locations=n_locations
+    )
+
+    # Some routes between new pairs, and some replacing existing routes, which
+    # either only get shorter or, to force a recompute, also get longer.
+    new_entries = make_random_route_matrix(n_locations, 10, seed + 100)
+    replaced = rng.choice(len(route_matrix), size=5, replace=False)
+    factor = rng.uniform(0.5, 2.0 if longer else 0.9, len(replaced))
+    new_entries = RouteMatrix.concatenate(
+        [
+            new_entries,
+            RouteMatrix(
+                # The other orientation, which replaces the same route.
+                origin_index=route_matrix.destination_index[replaced],
+                destination_index=route_matrix.origin_index[replaced],
+                duration_seconds=np.maximum(
+                    1, route_matrix.duration_seconds[replaced] * factor
+                ).astype(np.int64),
+                distance_meters=route_matrix.distance_meters[replaced],
+            ),
+        ]
+    )
+
+    new_route_matrix, new_dense = update_dense_travel_times(
+        route_matrix, dense, new_entries
+    )
+
+    expected_route_matrix = RouteMatrix.concatenate(
+        [route_matrix, new_entries]
+    ).deduplicated()
+    assert len(new_route_matrix) == len(expected_route_matrix)
+    np.testing.assert_array_equal(
+        new_route_matrix.to_array(n_locations),
+        expected_route_matrix.to_array(n_locations),
+    )
+    np.testing.assert_array_equal(
+        new_dense,
+        compute_dense_travel_times(
+            expected_route_matrix, progress=False, n_locations=n_locations
+        ),
+    )
@@ -0,0 +1,162 @@
+import { GridData, RouteMatrixAPIEntry } from "./gridData";
+
+// Reader for grid_data.bin, the binary version of grid_data.json.
+// See backend/backend/binary_export.py for the layout.
+// Not used by fetchCity() yet: all the maps in assets/ are JSON.
+
+const MAGIC = "STMGRID\0";
+const VERSION = 1;
+// The magic, the version and the header length.
+const PREAMBLE_BYTES = 16;
+const MISSING_DISTANCE = -1;
+
+type TypedArray =
+  | Float32Array
+  | Float64Array
+  | Uint16Array
+  | Uint32Array
+  | Int32Array;
+
+type ArrayInfo = {
+  dtype: "float32" | "float64" | "uint16" | "uint32" | "int32";
+  shape: number[];
+  // Relative to the end of the header.
+  offset: number;
+};
+
+type Header = {
+  keys: string[];
+  metadata: Omit<GridData, "locations" | "route_matrix" | "dense_travel_times">;
+  snap_result_types: (string[] | null)[];
+  snap_result_place_id: (string | null)[];
+  arrays: { [name: string]: ArrayInfo };
+};
+
+const makeTypedArray = (
+  buffer: ArrayBuffer,
+  byteOffset: number,
+  info: ArrayInfo
+): TypedArray => {
+  const length = info.shape.reduce((a, b) => a * b, 1);
+  switch (info.dtype) {
+    case "float32":
+      return new Float32Array(buffer, byteOffset, length);
+    case "float64":
+      return new Float64Array(buffer, byteOffset, length);
+    case "uint16":
+      return new Uint16Array(buffer, byteOffset, length);
+    case "uint32":
+      return new Uint32Array(buffer, byteOffset, length);
+    case "int32":
+      return new Int32Array(buffer, byteOffset, length);
+  }
+};
+
+export type BinaryGridData = {
+  header: Header;
+  // Views into the buffer, no data is copied. Matrices are stored row by row.
+  arrays: { [name: string]: TypedArray };
+};
+
+/**
+ * Parse grid_data.bin into typed arrays that share memory with the buffer.
+ * The data is little-endian, like all the platforms that browsers run on.
+ */
+export const parseBinaryGridData = (buffer: ArrayBuffer): BinaryGridData => {
+  const preamble = new DataView(buffer, 0, PREAMBLE_BYTES);
+  const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 8));
+  if (magic !== MAGIC) {
+    throw new Error("Not a grid data file");
+  }
+  const version = preamble.getUint32(8, true);
+  if (version !== VERSION) {
+    throw new Error(`Unsupported grid data version: ${version}`);
+  }
+  const headerLength = preamble.getUint32(12, true);
+  const header: Header = JSON.parse(
+    new TextDecoder().decode(
+      new Uint8Array(buffer, PREAMBLE_BYTES, headerLength)
+    )
+  );
+
+  const dataStart = PREAMBLE_BYTES + headerLength;
+  const arrays: { [name: string]: TypedArray } = {};
+  for (const [name, info] of Object.entries(header.arrays)) {
+    arrays[name] = makeTypedArray(buffer, dataStart + info.offset, info);
+  }
+
+  return { header, arrays };
+};
+
+/**
+ * Convert to the same structure as grid_data.json.
+ * Unlike parseBinaryGridData(), this copies everything into JS objects.
+ */
+export const binaryGridDataToGridData = ({
+  header,
+  arrays,
+}: BinaryGridData): GridData => {
+  const nLocations = arrays.raw_lat.length;
+
+  const locations = [];
+  for (let i = 0; i < nLocations; i++) {
+    locations.push({
+      raw_location: { lat: arrays.raw_lat[i], lng: arrays.raw_lng[i] },
+      snapped_location: {
+        lat: arrays.snapped_lat[i],
+        lng: arrays.snapped_lng[i],
+      },
+      grid_x: arrays.grid_x[i],
+      grid_y: arrays.grid_y[i],
+      snap_result_types: header.snap_result_types[i],
+      snap_result_place_id: header.snap_result_place_id[i],
+    });
+  }
+
+  const routeMatrix: RouteMatrixAPIEntry[] = [];
+  for (let i = 0; i < arrays.origin_index.length; i++) {
+    const distanceMeters = arrays.distance_meters[i];
+    routeMatrix.push({
+      originIndex: arrays.origin_index[i],
+      destinationIndex: arrays.destination_index[i],
+      status: {},
+      ...(distanceMeters !== MISSING_DISTANCE ? { distanceMeters } : {}),
+      duration: arrays.duration_seconds[i] + "s",
+      condition: "ROUTE_EXISTS",
+    });
+  }
+
+  const gridData: GridData = {
+    ...header.metadata,
+    locations,
+    route_matrix: routeMatrix,
+  };
+
+  const dense = arrays.dense_travel_times;
+  if (dense) {
+    // The largest value of the type means there is no route, which is null in
+    // grid_data.json.
+    const noRoute = dense instanceof Uint16Array ? 0xffff : 0xffffffff;
+    gridData.dense_travel_times = [];
+    for (let i = 0; i < nLocations; i++) {
+      const row = Array.from(
+        dense.subarray(i * nLocations, (i + 1) * nLocations)
+      );
+      gridData.dense_travel_times.push(
+        row.map((x) => (x === noRoute ? null : x)) as number[]
+      );
+    }
+  }
+
+  return gridData;
+};
+
+export const fetchBinaryGridData = async (url: string): Promise<GridData> => {
+  const response = await fetch(url);
+  if (!response.ok) {
+    throw new Error(`Failed to fetch ${url}: ${response.status}`);
+  }
+  return binaryGridDataToGridData(
+    parseBinaryGridData(await response.arrayBuffer())
+  );
+};